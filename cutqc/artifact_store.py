@@ -0,0 +1,120 @@
+import os, json, pickle, subprocess
+import numpy as np
+
+from cutqc.helper_fun import save_arrays, load_arrays
+
+class ArtifactStore:
+    '''
+    Indexed store of the artifacts of one CutQC folder
+    manifest.json lists every artifact with its kind, the shape and dtype of its arrays and its metadata,
+    so a run can be inspected without unpickling anything.
+
+    kinds:
+    record: dict of NumPy arrays and JSON fields. Arrays are saved as name.key.npy files, as save_arrays does,
+    and memory-mapped on get. Fields are kept in the manifest.
+    pickle: any other object, saved as name.pckl
+    Folders written before the manifest existed are read through the same file names.
+    '''
+    def __init__(self, folder):
+        self.folder = folder
+        self.manifest_file = '%s/manifest.json'%folder
+        if os.path.isfile(self.manifest_file):
+            self.manifest = json.load(open(self.manifest_file,'r'))
+        else:
+            self.manifest = {}
+
+    def __contains__(self, name):
+        return name in self.manifest or os.path.isfile('%s/%s.pckl'%(self.folder,name))
+
+    def names(self):
+        return list(self.manifest.keys())
+
+    def reset(self):
+        '''
+        Delete every artifact of the folder
+        '''
+        if os.path.exists(self.folder):
+            subprocess.run(['rm','-r',self.folder])
+        os.makedirs(self.folder)
+        self.manifest = {}
+
+    def put(self, name, value, metadata=None):
+        '''
+        metadata: JSON serializable dict recorded in the manifest, e.g. eval_mode or precision
+        '''
+        entry = {'metadata':metadata if metadata is not None else {}}
+        fields = self._get_fields(value)
+        if fields is None:
+            entry['kind'] = 'pickle'
+            pickle.dump(value, open('%s/%s.pckl'%(self.folder,name),'wb'))
+        else:
+            arrays = {key:value[key] for key in value if key not in fields}
+            entry['kind'] = 'record'
+            entry['fields'] = fields
+            entry['arrays'] = {key:{'shape':list(arrays[key].shape),'dtype':arrays[key].dtype.str} for key in arrays}
+            save_arrays(folder=self.folder,name=name,arrays=arrays)
+        self.manifest[name] = entry
+        self._write_manifest()
+
+    def get(self, name, keys=None):
+        '''
+        keys: only load these arrays of a record
+        '''
+        if name not in self.manifest:
+            return self._get_legacy(name)
+        entry = self.manifest[name]
+        if entry['kind']=='pickle':
+            return pickle.load(open('%s/%s.pckl'%(self.folder,name),'rb'))
+        value = dict(entry['fields'])
+        for key in entry['arrays']:
+            if keys is None or key in keys:
+                value[key] = np.load('%s/%s.%s.npy'%(self.folder,name,key),mmap_mode='r')
+        return value
+
+    def get_metadata(self, name):
+        '''
+        Manifest entry of an artifact, read without loading it
+        '''
+        if name not in self.manifest:
+            raise KeyError('No %s in the manifest of %s'%(name,self.folder))
+        return self.manifest[name]
+
+    def get_array_filename(self, name, key):
+        return '%s/%s.%s.npy'%(self.folder,name,key)
+
+    def _get_fields(self, value):
+        '''
+        JSON fields of a record, None if value cannot be stored as one
+        '''
+        if not isinstance(value,dict) or not all([isinstance(key,str) for key in value]):
+            return None
+        fields = {key:value[key] for key in value if not isinstance(value[key],np.ndarray)}
+        try:
+            json_fields = json.loads(json.dumps(fields,default=lambda x:x.item()))
+        except (TypeError, ValueError, AttributeError):
+            return None
+        # Tuples, non-string keys etc. do not survive JSON
+        if json_fields!=fields:
+            return None
+        return json_fields
+
+    def _get_legacy(self, name):
+        if os.path.isfile('%s/%s.pckl'%(self.folder,name)):
+            return pickle.load(open('%s/%s.pckl'%(self.folder,name),'rb'))
+        return load_arrays(folder=self.folder,name=name)
+
+    def _write_manifest(self):
+        # Write then rename so that readers never see a partial manifest
+        tmp_file = '%s.%d.tmp'%(self.manifest_file,os.getpid())
+        json.dump(self.manifest, open(tmp_file,'w'), indent=1)
+        os.replace(tmp_file,self.manifest_file)
+
+def get_cut_solution_metadata(cut_solution):
+    '''
+    Manifest metadata of a cut solution, to inspect a run without unpickling its circuits
+    '''
+    return {'circuit_name':cut_solution['circuit_name'],
+    'num_qubits':cut_solution['circuit'].num_qubits,
+    'max_subcircuit_qubit':cut_solution['max_subcircuit_qubit'],
+    'num_subcircuits':len(cut_solution['subcircuits']),
+    'num_cuts':len(cut_solution['positions'])}
@@ -1,188 +1,278 @@
+// Reconstruction kernel, compiled to a shared library and called in-process through cutqc/build_kernel.py
+// Compile with -DUSE_MKL to use MKL for the Kronecker products and accumulation
+// The kernel runs inside the Python process, so failures are returned as error codes and never abort
+
+#define BUILD_OK 0
+#define BUILD_ERROR_MEMORY 1
+#define BUILD_ERROR_CHECKPOINT 2
+#define BUILD_ERROR_PROGRESS 3
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
 #include <math.h>
-#include <assert.h>
 #include <stdbool.h>
 #include <sys/time.h>
 #include <unistd.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#ifdef USE_MKL
 #include "mkl.h"
+#endif
 
-#include <immintrin.h>
-#include "omp.h"
-
-float* build(char* eval_folder, int reconstruction_len, int num_subcircuits, int* subcircuit_indices, int* subcircuit_entry_indices, long long int* subcircuit_prob_lengths);
-void print_float_arr(float *arr, long long int num_elements);
-void print_int_arr(int *arr, int num_elements);
-float print_log(double log_time, double elapsed_time, int num_finished_jobs, int num_total_jobs, double log_frequency, int rank);
+void kron(float* summation_term, long long int summation_term_len, float* subcircuit_entry, long long int subcircuit_entry_len);
+void accumulate(float* reconstructed_prob, float* summation_term, long long int reconstruction_len, float weight);
+float* map_checkpoint(char* dest_folder, int rank, int slot, long long int reconstruction_len);
+int write_checkpoint(char* dest_folder, int rank, float** checkpoints, int slot, float* reconstructed_prob, long long int reconstruction_len,
+int num_built, double remaining_bound, double elapsed);
+char* get_checkpoint_file(char* dest_folder, int rank, char* suffix);
+void get_output_tables(int* bit_map, int num_qubits, long long int output_tables[][256]);
 double get_sec();
 
-int main(int argc, char** argv) {
-    int rank = atoi(argv[1]);
-    char *eval_folder = argv[2];
-    char *dest_folder = argv[3];
-    long long int reconstruction_len = atoi(argv[4]);
-    int num_cuts = atoi(argv[5]);
-    int num_summation_terms = atoi(argv[6]);
-    int num_subcircuits = atoi(argv[7]);
-    int num_samples = atoi(argv[8]);
-    
-    char *build_command_file = malloc(256*sizeof(char));
-    sprintf(build_command_file, "%s/build_command_%d.txt", dest_folder, rank);
-    FILE* build_command_fptr = fopen(build_command_file, "r");
-
-    int summation_term_ctr;
+int build(int rank, int num_subcircuits, float** entry_probs, long long int* entry_lengths,
+int num_summation_terms, long long int* term_rows, double* weights, double* remaining_bounds,
+float* reconstructed_prob, long long int reconstruction_len,
+char* dest_folder, double checkpoint_interval, double tolerance, int resume, int verbose, double* progress) {
+    // Accumulate sum_t weights[t] * Kron(entry_probs[0][term_rows[t,0]], entry_probs[1][term_rows[t,1]], ...) into reconstructed_prob
+    // entry_probs[j]: row major (#entries, entry_lengths[j]) matrix of the subcircuit j in the kron order
+    // remaining_bounds[t]: L1 bound of the terms after t. Stop once within tolerance, if tolerance>0
+    // Anytime build: snapshot every checkpoint_interval seconds to dest_folder, if checkpoint_interval>0
+    // Progress is printed only if verbose
+    // progress = {terms built, remaining L1 bound, build time}
+    // Returns BUILD_OK, or the BUILD_ERROR_* code of the failure
     double total_build_time = 0;
     double log_time = 0;
-    float *reconstructed_prob = (float*) calloc(reconstruction_len,sizeof(float));
-    for (summation_term_ctr=0; summation_term_ctr<num_summation_terms; summation_term_ctr++) {
+
+    // Two checkpoint slots written alternately, so that one is always complete
+    float *checkpoints[2] = {NULL, NULL};
+    int checkpoint_slot = 0;
+    int num_resumed = 0;
+    double remaining_bound = 0;
+    int status = BUILD_OK;
+    if (checkpoint_interval>0) {
+        if (resume) {
+            char *progress_file = get_checkpoint_file(dest_folder, rank, ".txt");
+            if (progress_file==NULL) {
+                return BUILD_ERROR_MEMORY;
+            }
+            FILE *progress_fptr = fopen(progress_file, "r");
+            free(progress_file);
+            if (progress_fptr!=NULL) {
+                int resumed_slot;
+                int num_read = fscanf(progress_fptr,"%d %le %le %d",&num_resumed,&remaining_bound,&total_build_time,&resumed_slot);
+                fclose(progress_fptr);
+                if (num_read!=4 || num_resumed<0 || num_resumed>num_summation_terms || (resumed_slot!=0 && resumed_slot!=1)) {
+                    return BUILD_ERROR_PROGRESS;
+                }
+                float *resumed_checkpoint = map_checkpoint(dest_folder, rank, resumed_slot, reconstruction_len);
+                if (resumed_checkpoint==NULL) {
+                    return BUILD_ERROR_CHECKPOINT;
+                }
+                memcpy(reconstructed_prob, resumed_checkpoint, reconstruction_len*sizeof(float));
+                munmap(resumed_checkpoint, reconstruction_len*sizeof(float));
+                checkpoint_slot = 1-resumed_slot;
+                if (verbose) {
+                    printf("Rank %d resumed after %d/%d summation terms\n",rank,num_resumed,num_summation_terms);
+                    fflush(stdout);
+                }
+            }
+        }
+        checkpoints[0] = map_checkpoint(dest_folder, rank, 0, reconstruction_len);
+        checkpoints[1] = map_checkpoint(dest_folder, rank, 1, reconstruction_len);
+        if (checkpoints[0]==NULL || checkpoints[1]==NULL) {
+            status = BUILD_ERROR_CHECKPOINT;
+        }
+    }
+    int num_built = num_resumed;
+    // One buffer per rank, the Kronecker products are taken in place
+    float *summation_term = NULL;
+    if (status==BUILD_OK) {
+        summation_term = (float*) malloc(reconstruction_len*sizeof(float));
+        if (summation_term==NULL) {
+            status = BUILD_ERROR_MEMORY;
+        }
+    }
+    int summation_term_ctr;
+    for (summation_term_ctr=num_resumed; status==BUILD_OK && summation_term_ctr<num_summation_terms; summation_term_ctr++) {
         double build_begin = get_sec();
+        long long int summation_term_len = 1;
+        summation_term[0] = 1;
         int subcircuit_ctr;
-        int *subcircuit_indices = (int *) calloc(num_subcircuits,sizeof(int));
-        int *subcircuit_entry_indices = (int *) calloc(num_subcircuits,sizeof(int));
-        long long int *subcircuit_prob_lengths = (long long int *) calloc(num_subcircuits,sizeof(long long int));
-        float sampling_prob;
-        int frequency;
-        fscanf(build_command_fptr,"%f ",&sampling_prob);
-        fscanf(build_command_fptr,"%d ",&frequency);
         for (subcircuit_ctr=0; subcircuit_ctr<num_subcircuits; subcircuit_ctr++) {
-            fscanf(build_command_fptr,"%d ",&subcircuit_indices[subcircuit_ctr]);
-            fscanf(build_command_fptr,"%d ",&subcircuit_entry_indices[subcircuit_ctr]);
-            fscanf(build_command_fptr,"%lld ",&subcircuit_prob_lengths[subcircuit_ctr]);
+            long long int entry_row = term_rows[(long long int)summation_term_ctr*num_subcircuits+subcircuit_ctr];
+            kron(summation_term, summation_term_len, entry_probs[subcircuit_ctr]+entry_row*entry_lengths[subcircuit_ctr], entry_lengths[subcircuit_ctr]);
+            summation_term_len *= entry_lengths[subcircuit_ctr];
         }
-        float* summation_term = build(eval_folder, reconstruction_len, num_subcircuits, subcircuit_indices, subcircuit_entry_indices, subcircuit_prob_lengths);
-        cblas_sscal(reconstruction_len, frequency/sampling_prob/num_samples, summation_term, 1);
-        vsAdd(reconstruction_len, reconstructed_prob, summation_term, reconstructed_prob);
+        accumulate(reconstructed_prob, summation_term, reconstruction_len, (float) weights[summation_term_ctr]);
+        num_built++;
+        remaining_bound = remaining_bounds[summation_term_ctr];
         double build_time = get_sec() - build_begin;
         log_time += build_time;
         total_build_time += build_time;
-        if (log_time>300.0) {
-            double eta = total_build_time/(summation_term_ctr+1)*num_summation_terms-total_build_time;
-            printf("Rank %d built %d/%d summation terms, elapsed = %.3f, ETA = %.3f\n",rank,summation_term_ctr+1,num_summation_terms,total_build_time,eta);
+        if (checkpoint_interval>0 && log_time>checkpoint_interval) {
+            status = write_checkpoint(dest_folder, rank, checkpoints, checkpoint_slot, reconstructed_prob, reconstruction_len, num_built, remaining_bound, total_build_time);
+            checkpoint_slot = 1-checkpoint_slot;
+            if (verbose) {
+                printf("Rank %d built %d/%d summation terms, elapsed = %.3f, remaining L1 bound = %e\n",rank,num_built,num_summation_terms,total_build_time,remaining_bound);
+                fflush(stdout);
+            }
             log_time = 0.0;
         }
+        else if (checkpoint_interval<=0 && log_time>300.0) {
+            if (verbose) {
+                double eta = total_build_time/(summation_term_ctr+1)*num_summation_terms-total_build_time;
+                printf("Rank %d built %d/%d summation terms, elapsed = %.3f, ETA = %.3f\n",rank,summation_term_ctr+1,num_summation_terms,total_build_time,eta);
+                fflush(stdout);
+            }
+            log_time = 0.0;
+        }
+        if (tolerance>0 && remaining_bound<=tolerance) {
+            break;
+        }
     }
-    cblas_sscal(reconstruction_len, pow(0.5,num_cuts), reconstructed_prob, 1);
-    // print_float_arr(reconstructed_prob,reconstruction_len);
-
-    fclose(build_command_fptr);
-    free(build_command_file);
+    free(summation_term);
+    if (checkpoint_interval>0) {
+        if (status==BUILD_OK) {
+            status = write_checkpoint(dest_folder, rank, checkpoints, checkpoint_slot, reconstructed_prob, reconstruction_len, num_built, remaining_bound, total_build_time);
+        }
+        int slot;
+        for (slot=0;slot<2;slot++) {
+            if (checkpoints[slot]!=NULL) {
+                munmap(checkpoints[slot], reconstruction_len*sizeof(float));
+            }
+        }
+    }
+    progress[0] = num_built;
+    progress[1] = remaining_bound;
+    progress[2] = total_build_time;
+    return status;
+}
 
-    char *build_file = malloc(256*sizeof(char));
-    sprintf(build_file, "%s/build_%d.txt", dest_folder, rank);
-    FILE *build_fptr = fopen(build_file, "w");
+void reorder(float* raw_prob, double* ordered_prob, long long int reconstruction_len, int* bit_map) {
+    // Gather the raw kron order output in circuit qubit order, straight into the float64 output
+    // bit_map[b] = bit of the kron order holding bit b of the circuit order
+    int num_qubits = (int) round(log2((double) reconstruction_len));
+    int num_bytes = (num_qubits+7)/8;
+    // At most 63 qubits, i.e. 8 bytes
+    long long int output_tables[8][256];
+    get_output_tables(bit_map, num_qubits, output_tables);
     long long int state_ctr;
     for (state_ctr=0;state_ctr<reconstruction_len;state_ctr++) {
-        fprintf(build_fptr,"%e ",reconstructed_prob[state_ctr]);
+        long long int raw_state = 0;
+        int byte_ctr;
+        for (byte_ctr=0;byte_ctr<num_bytes;byte_ctr++) {
+            raw_state |= output_tables[byte_ctr][(state_ctr>>(8*byte_ctr))&255];
+        }
+        ordered_prob[state_ctr] = raw_prob[raw_state];
     }
-    fprintf(build_fptr,"\n");
-    fclose(build_fptr);
-    free(build_file);
-
-    char *summary_file = malloc(256*sizeof(char));
-    sprintf(summary_file, "%s/rank_%d_summary.txt", dest_folder, rank);
-    FILE *summary_fptr = fopen(summary_file, "a");
-    fprintf(summary_fptr,"Total build time = %e\n",total_build_time);
-    fprintf(summary_fptr,"DONE\n");
-    fclose(summary_fptr);
-    free(summary_file);
-    free(reconstructed_prob);
-    return 0;
 }
 
-float* build(char* eval_folder, int reconstruction_len, int num_subcircuits, int* subcircuit_indices, int* subcircuit_entry_indices, long long int* subcircuit_prob_lengths) {
-    // Calculate Kronecker product for one summation_term
-    // cblas_sger parameters:
-    MKL_INT incx, incy;
-    CBLAS_LAYOUT layout = CblasRowMajor;
-    float alpha = 1;
-    incx = 1;
-    incy = 1;
-
-    int subcircuit_ctr;
-    long long int summation_term_accumulated_len = 0;
-    float *summation_term = (float*) calloc(reconstruction_len,sizeof(float));
-    for (subcircuit_ctr=0;subcircuit_ctr<num_subcircuits;subcircuit_ctr++) {
-        int subcircuit_idx = subcircuit_indices[subcircuit_ctr];
-        int subcircuit_entry_idx = subcircuit_entry_indices[subcircuit_ctr];
-        long long int subcircuit_prob_length = subcircuit_prob_lengths[subcircuit_ctr];
+void kron(float* summation_term, long long int summation_term_len, float* subcircuit_entry, long long int subcircuit_entry_len) {
+    // summation_term = Kron(summation_term, subcircuit_entry) in place
+    // Row i of the product only overwrites elements >= i, so rows are filled from the last one
+    long long int row;
+    for (row=summation_term_len-1;row>=0;row--) {
+        float factor = summation_term[row];
+#ifdef USE_MKL
+        cblas_scopy(subcircuit_entry_len, subcircuit_entry, 1, summation_term+row*subcircuit_entry_len, 1);
+        cblas_sscal(subcircuit_entry_len, factor, summation_term+row*subcircuit_entry_len, 1);
+#else
+        long long int state_ctr;
+        for (state_ctr=subcircuit_entry_len-1;state_ctr>=0;state_ctr--) {
+            summation_term[row*subcircuit_entry_len+state_ctr] = factor*subcircuit_entry[state_ctr];
+        }
+#endif
+    }
+}
 
-        char *subcircuit_entry_file = malloc(256*sizeof(char));
-        sprintf(subcircuit_entry_file, "%s/%d_%d.txt", eval_folder, subcircuit_idx, subcircuit_entry_idx);
-        FILE* subcircuit_entry_fptr = fopen(subcircuit_entry_file, "r");
+void accumulate(float* reconstructed_prob, float* summation_term, long long int reconstruction_len, float weight) {
+#ifdef USE_MKL
+    cblas_saxpy(reconstruction_len, weight, summation_term, 1, reconstructed_prob, 1);
+#else
+    long long int state_ctr;
+    for (state_ctr=0;state_ctr<reconstruction_len;state_ctr++) {
+        reconstructed_prob[state_ctr] += weight*summation_term[state_ctr];
+    }
+#endif
+}
 
-        if (summation_term_accumulated_len==0) {
-            long long int state_ctr;
-            for (state_ctr=0;state_ctr<subcircuit_prob_length;state_ctr++) {
-                fscanf(subcircuit_entry_fptr,"%f ",&summation_term[state_ctr]);
-            }
-            summation_term_accumulated_len = subcircuit_prob_length;
-        }
-        else {
-            long long int state_ctr;
-            float *subcircuit_kron_term = (float*) calloc(subcircuit_prob_length,sizeof(float));
-            for (state_ctr=0;state_ctr<subcircuit_prob_length;state_ctr++) {
-                fscanf(subcircuit_entry_fptr,"%f ",&subcircuit_kron_term[state_ctr]);
-            }
-            float *dummy_summation_term = (float*) calloc(summation_term_accumulated_len*subcircuit_prob_length,sizeof(float));
-            cblas_sger(layout, summation_term_accumulated_len, subcircuit_prob_length, alpha, summation_term, incx, subcircuit_kron_term, incy, dummy_summation_term, subcircuit_prob_length);
-            summation_term_accumulated_len *= subcircuit_prob_length;
-            cblas_scopy(summation_term_accumulated_len, dummy_summation_term, 1, summation_term, 1);
-            free(dummy_summation_term);
-            free(subcircuit_kron_term);
-        }
-        fclose(subcircuit_entry_fptr);
-        free(subcircuit_entry_file);
+char* get_checkpoint_file(char* dest_folder, int rank, char* suffix) {
+    // dest_folder/checkpoint_<rank><suffix>, NULL if out of memory
+    size_t length = strlen(dest_folder)+strlen(suffix)+64;
+    char *checkpoint_file = malloc(length*sizeof(char));
+    if (checkpoint_file!=NULL) {
+        snprintf(checkpoint_file, length, "%s/checkpoint_%d%s", dest_folder, rank, suffix);
     }
-    return summation_term;
+    return checkpoint_file;
 }
 
-void print_int_arr(int *arr, int num_elements) {
-    int ctr;
-    if (num_elements<=10) {
-        for (ctr=0;ctr<num_elements;ctr++) {
-            printf("%d ",arr[ctr]);
-        }
+float* map_checkpoint(char* dest_folder, int rank, int slot, long long int reconstruction_len) {
+    // Memory map checkpoint slot of this rank, created if missing. NULL on failure
+    char *checkpoint_file = get_checkpoint_file(dest_folder, rank, slot==0 ? "_0.bin" : "_1.bin");
+    if (checkpoint_file==NULL) {
+        return NULL;
     }
-    else {
-        for (ctr=0;ctr<5;ctr++) {
-            printf("%d ",arr[ctr]);
-        }
-        printf(" ... ");
-        for (ctr=num_elements-5;ctr<num_elements;ctr++) {
-            printf("%d ",arr[ctr]);
-        }
+    int fd = open(checkpoint_file, O_RDWR|O_CREAT, 0644);
+    free(checkpoint_file);
+    if (fd<0) {
+        return NULL;
+    }
+    if (ftruncate(fd, reconstruction_len*sizeof(float))!=0) {
+        close(fd);
+        return NULL;
     }
-    printf(" = %d elements\n",num_elements);
+    float *checkpoint = (float*) mmap(NULL, reconstruction_len*sizeof(float), PROT_READ|PROT_WRITE, MAP_SHARED, fd, 0);
+    close(fd);
+    if (checkpoint==MAP_FAILED) {
+        return NULL;
+    }
+    return checkpoint;
 }
 
-void print_float_arr(float *arr, long long int num_elements) {
-    long long int ctr;
-    if (num_elements<=10) {
-        for (ctr=0;ctr<num_elements;ctr++) {
-            printf("%e ",arr[ctr]);
-        }
+int write_checkpoint(char* dest_folder, int rank, float** checkpoints, int slot, float* reconstructed_prob, long long int reconstruction_len,
+int num_built, double remaining_bound, double elapsed) {
+    // Sync the slot first, then atomically point the progress file at it
+    memcpy(checkpoints[slot], reconstructed_prob, reconstruction_len*sizeof(float));
+    if (msync(checkpoints[slot], reconstruction_len*sizeof(float), MS_SYNC)!=0) {
+        return BUILD_ERROR_CHECKPOINT;
+    }
+    char *progress_file = get_checkpoint_file(dest_folder, rank, ".txt");
+    char *tmp_progress_file = get_checkpoint_file(dest_folder, rank, ".txt.tmp");
+    int status = BUILD_OK;
+    if (progress_file==NULL || tmp_progress_file==NULL) {
+        status = BUILD_ERROR_MEMORY;
     }
     else {
-        for (ctr=0;ctr<5;ctr++) {
-            printf("%e ",arr[ctr]);
+        FILE *progress_fptr = fopen(tmp_progress_file, "w");
+        if (progress_fptr==NULL) {
+            status = BUILD_ERROR_PROGRESS;
         }
-        printf(" ... ");
-        for (ctr=num_elements-5;ctr<num_elements;ctr++) {
-            printf("%e ",arr[ctr]);
+        else {
+            int num_written = fprintf(progress_fptr,"%d %e %e %d\n",num_built,remaining_bound,elapsed,slot);
+            if (fclose(progress_fptr)!=0 || num_written<0 || rename(tmp_progress_file, progress_file)!=0) {
+                status = BUILD_ERROR_PROGRESS;
+            }
         }
     }
-    printf(" = %lld elements\n",num_elements);
+    free(progress_file);
+    free(tmp_progress_file);
+    return status;
 }
 
-float print_log(double log_time, double elapsed_time, int num_finished_jobs, int num_total_jobs, double log_frequency, int rank) {
-    if (log_time>log_frequency) {
-        double eta = elapsed_time/num_finished_jobs*num_total_jobs - elapsed_time;
-        printf("Rank %d finished building %d/%d, elapsed = %e, ETA = %e\n",rank,num_finished_jobs,num_total_jobs,elapsed_time,eta);
-        return 0;
-    }
-    else {
-        return log_time;
+void get_output_tables(int* bit_map, int num_qubits, long long int output_tables[][256]) {
+    // output_tables[k][v] = kron order bits of the circuit order bits 8k..8k+7 set as in v
+    int num_bytes = (num_qubits+7)/8;
+    int byte_ctr;
+    for (byte_ctr=0;byte_ctr<num_bytes;byte_ctr++) {
+        int value;
+        for (value=0;value<256;value++) {
+            output_tables[byte_ctr][value] = 0;
+            int bit_ctr;
+            for (bit_ctr=0;bit_ctr<8 && 8*byte_ctr+bit_ctr<num_qubits;bit_ctr++) {
+                if ((value>>bit_ctr)&1) {
+                    output_tables[byte_ctr][value] |= 1LL<<bit_map[8*byte_ctr+bit_ctr];
+                }
+            }
+        }
     }
 }
 
@@ -0,0 +1,165 @@
+import os, ctypes, hashlib, subprocess, threading, time, pickle, socket
+import numpy as np
+
+_kernel = None
+_kernel_lock = threading.Lock()
+# Error codes returned by build in build.c
+_build_errors = {1:'out of memory',2:'cannot map the checkpoints',3:'cannot read or write the checkpoint progress file'}
+
+def get_compile_command():
+    '''
+    gcc command compiling build.c to a shared library, with MKL if it is installed
+    MKLROOT defaults to /opt/intel/mkl
+    '''
+    mkl_root = os.environ.get('MKLROOT','/opt/intel/mkl')
+    if os.path.isfile('%s/include/mkl.h'%mkl_root):
+        return 'gcc -O3 -shared -fPIC {source} -L %s/lib/intel64/ -I %s/include/ -lmkl_intel_ilp64 -lmkl_gnu_thread -lmkl_core -lgomp -lpthread -lm -ldl -DMKL_ILP64 -DUSE_MKL -m64 -o {library}'%(mkl_root,mkl_root)
+    else:
+        return 'gcc -O3 -shared -fPIC {source} -lm -o {library}'
+
+def get_kernel():
+    '''
+    The compiled build.c, loaded once per process
+    The library is cached in CUTQC_KERNEL_DIR, ~/.cache/cutqc by default, by the hash of the source and compile command,
+    so it is only compiled again when either changes.
+    '''
+    global _kernel
+    with _kernel_lock:
+        if _kernel is not None:
+            return _kernel
+        source_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),'build.c')
+        compile_command = get_compile_command()
+        source_hash = hashlib.sha256(open(source_file,'rb').read()+compile_command.encode()).hexdigest()[:16]
+        kernel_dir = os.environ.get('CUTQC_KERNEL_DIR',os.path.expanduser('~/.cache/cutqc'))
+        library_file = '%s/build_%s.so'%(kernel_dir,source_hash)
+        if not os.path.isfile(library_file):
+            os.makedirs(kernel_dir,exist_ok=True)
+            # Compile then rename so that concurrent processes never load a partial library
+            tmp_library_file = '%s.%d.tmp'%(library_file,os.getpid())
+            compile_result = subprocess.run(compile_command.format(source=source_file,library=tmp_library_file).split(' '),capture_output=True,text=True)
+            if compile_result.returncode!=0:
+                raise Exception('Failed to compile %s:\n%s'%(source_file,compile_result.stderr))
+            os.replace(tmp_library_file,library_file)
+        kernel = ctypes.CDLL(library_file)
+        float_ptr = np.ctypeslib.ndpointer(dtype=np.float32,flags='C_CONTIGUOUS')
+        int64_ptr = np.ctypeslib.ndpointer(dtype=np.int64,flags='C_CONTIGUOUS')
+        double_ptr = np.ctypeslib.ndpointer(dtype=np.float64,flags='C_CONTIGUOUS')
+        kernel.build.argtypes = [ctypes.c_int,ctypes.c_int,ctypes.POINTER(ctypes.POINTER(ctypes.c_float)),int64_ptr,
+        ctypes.c_int,int64_ptr,double_ptr,double_ptr,
+        float_ptr,ctypes.c_longlong,
+        ctypes.c_char_p,ctypes.c_double,ctypes.c_double,ctypes.c_int,ctypes.c_int,double_ptr]
+        kernel.build.restype = ctypes.c_int
+        kernel.reorder.argtypes = [float_ptr,double_ptr,ctypes.c_longlong,np.ctypeslib.ndpointer(dtype=np.int32,flags='C_CONTIGUOUS')]
+        kernel.reorder.restype = None
+        _kernel = kernel
+        return _kernel
+
+def build_terms(entry_probs, term_rows, weights, remaining_bounds=None, rank=0, dest_folder=None, checkpoint_interval=None, tolerance=None, resume=False,
+reconstructed_prob=None, verbose=False):
+    '''
+    Raw kron order output of the summation terms, see query.get_reconstruction_terms
+    Releases the GIL, so ranks can build concurrently in threads.
+
+    entry_probs[j]: (#entries, 2^effective) matrix of the j-th subcircuit in the kron order
+    term_rows: (#terms, #subcircuits) row of every factor in entry_probs
+    weights: weight of every term
+    remaining_bounds: L1 bound of the terms after every term, for tolerance
+    Anytime build: checkpoint_interval and resume snapshot to, and continue from, the checkpoints of rank in dest_folder.
+    reconstructed_prob: float32 array to accumulate the terms into, instead of a new one
+    verbose: print the progress of long builds and of every checkpoint
+    Returns the float32 output and progress = {'num_built', 'remaining_bound', 'elapsed'}
+    '''
+    kernel = get_kernel()
+    entry_probs = [np.ascontiguousarray(entry_prob,dtype=np.float32) for entry_prob in entry_probs]
+    if any([entry_prob.ndim!=2 for entry_prob in entry_probs]):
+        raise ValueError('entry_probs must be (#entries, 2^effective) matrices')
+    entry_lengths = np.array([entry_prob.shape[1] for entry_prob in entry_probs],dtype=np.int64)
+    entry_pointers = (ctypes.POINTER(ctypes.c_float)*len(entry_probs))(*[entry_prob.ctypes.data_as(ctypes.POINTER(ctypes.c_float)) for entry_prob in entry_probs])
+    term_rows = np.ascontiguousarray(term_rows,dtype=np.int64)
+    weights = np.ascontiguousarray(weights,dtype=np.float64)
+    if remaining_bounds is None:
+        remaining_bounds = np.zeros(len(weights))
+    remaining_bounds = np.ascontiguousarray(remaining_bounds,dtype=np.float64)
+    # The kernel trusts every row, check them before handing it the pointers
+    if term_rows.ndim!=2 or term_rows.shape[1]!=len(entry_probs):
+        raise ValueError('term_rows must be a (#terms, %d) matrix, got shape %s'%(len(entry_probs),term_rows.shape))
+    if len(weights)!=len(term_rows) or len(remaining_bounds)!=len(term_rows):
+        raise ValueError('Expecting %d weights and remaining_bounds, got %d and %d'%(len(term_rows),len(weights),len(remaining_bounds)))
+    for subcircuit_ctr, entry_prob in enumerate(entry_probs):
+        if len(term_rows)>0 and (term_rows[:,subcircuit_ctr].min()<0 or term_rows[:,subcircuit_ctr].max()>=entry_prob.shape[0]):
+            raise ValueError('term_rows of subcircuit %d out of range of its %d entries'%(subcircuit_ctr,entry_prob.shape[0]))
+    if checkpoint_interval is not None:
+        if dest_folder is None:
+            raise ValueError('Checkpoints require a dest_folder')
+        if not os.path.isdir(dest_folder):
+            raise FileNotFoundError('Checkpoint folder %s does not exist'%dest_folder)
+    reconstruction_len = int(np.prod(entry_lengths))
+    if reconstructed_prob is None:
+        reconstructed_prob = np.zeros(reconstruction_len,dtype=np.float32)
+    elif reconstructed_prob.dtype!=np.float32 or len(reconstructed_prob)!=reconstruction_len or not reconstructed_prob.flags['C_CONTIGUOUS']:
+        raise ValueError('reconstructed_prob must be a contiguous float32 array of %d states'%reconstruction_len)
+    progress = np.zeros(3,dtype=np.float64)
+    status = kernel.build(rank,len(entry_probs),entry_pointers,entry_lengths,
+    len(weights),term_rows,weights,remaining_bounds,
+    reconstructed_prob,reconstruction_len,
+    (dest_folder if dest_folder is not None else '').encode(),
+    checkpoint_interval if checkpoint_interval is not None else 0,tolerance if tolerance is not None else 0,1 if resume else 0,1 if verbose else 0,progress)
+    if status!=0:
+        raise OSError('Build rank %d failed after %d summation terms: %s in %s'%(rank,int(progress[0]),_build_errors.get(status,'error %d'%status),dest_folder))
+    return reconstructed_prob, {'num_built':int(progress[0]),'remaining_bound':float(progress[1]),'elapsed':float(progress[2])}
+
+def sum_outputs(raw_probs, raw_qubit_order=None):
+    '''
+    float64 sum of the float32 raw outputs of the ranks, in the circuit qubit order unless raw_qubit_order is None
+    The outputs are summed into the first one, then gathered once into the result.
+    '''
+    raw_prob = raw_probs[0]
+    for rank_raw_prob in raw_probs[1:]:
+        raw_prob += rank_raw_prob
+    if raw_qubit_order is None:
+        return raw_prob.astype(np.float64)
+    return reorder_output(raw_prob=raw_prob,raw_qubit_order=raw_qubit_order)
+
+def reorder_output(raw_prob, raw_qubit_order):
+    '''
+    float64 raw kron order output in the circuit qubit order, gathered by the kernel
+    raw_qubit_order: circuit qubit of every raw bit, most significant bit first
+    '''
+    num_qubits = len(raw_qubit_order)
+    if num_qubits>63 or len(raw_prob)!=2**num_qubits:
+        raise ValueError('Expecting %d probabilities for %d qubits, got %d'%(2**num_qubits,num_qubits,len(raw_prob)))
+    # Circuit order bit b (least significant first) is held by raw bit num_qubits-1-raw_qubit_order.index(qubit b)
+    qubit_order = sorted(raw_qubit_order,reverse=True)
+    bit_map = np.array([num_qubits-1-raw_qubit_order.index(qubit) for qubit in qubit_order[::-1]],dtype=np.int32)
+    raw_prob = np.ascontiguousarray(raw_prob,dtype=np.float32)
+    ordered_prob = np.empty(len(raw_prob),dtype=np.float64)
+    get_kernel().reorder(raw_prob,ordered_prob,len(raw_prob),bit_map)
+    return ordered_prob
+
+def calibrate_build_constants(cache_folder='./cutqc_data/calibration', repeats=5):
+    '''
+    Fit build time = term*4^K + element*cost_estimate on this host
+    by timing the build kernel on summation terms of several sizes.
+    The constants are cached per host.
+    '''
+    cache_file = '%s/build_kernel_constants_%s.pckl'%(cache_folder,socket.gethostname())
+    if os.path.isfile(cache_file):
+        return pickle.load(open(cache_file,'rb'))
+    sizes = []
+    times = []
+    for num_qubits in range(4,21,2):
+        for first in [1,num_qubits//2]:
+            entry_probs = [np.random.rand(1,2**first),np.random.rand(1,2**(num_qubits-first))]
+            elapsed = []
+            for repeat in range(repeats):
+                begin = time.perf_counter()
+                build_terms(entry_probs=entry_probs,term_rows=np.zeros((1,2),dtype=np.int64),weights=np.ones(1))
+                elapsed.append(time.perf_counter()-begin)
+            sizes.append(2**num_qubits)
+            times.append(min(elapsed))
+    A = np.stack([np.ones(len(sizes)),np.array(sizes,dtype=float)],axis=1)
+    (term, element), _, _, _ = np.linalg.lstsq(A,np.array(times),rcond=None)
+    build_constants = {'term':max(float(term),1e-9),'element':max(float(element),1e-12)}
+    os.makedirs(cache_folder,exist_ok=True)
+    pickle.dump(build_constants,open(cache_file,'wb'))
+    return build_constants
@@ -0,0 +1,127 @@
+import os, pickle, hashlib
+from collections import OrderedDict
+
+class ResultCache:
+    '''
+    Persistent on-disk cache of subcircuit simulation results
+    Every entry is a pickle file named by a content hash of its simulation inputs.
+    Least recently used entries are evicted once the cache grows beyond max_size (GB).
+    '''
+    def __init__(self, cache_dir, max_size, seed=None):
+        '''
+        Args:
+        cache_dir: directory holding the cache, shared across runs
+        max_size: size limit of the cache in GB
+        seed: seed of the qasm samples, recorded in every key. Change it to force fresh qasm samples.
+        Unseeded qasm results are never cached, see simulate_subcircuit.
+        '''
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size*2**30)
+        self.seed = seed
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.cache_dir,exist_ok=True)
+        self.total_size = sum([entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.name.endswith('.pckl')])
+
+    def get_key(self, fingerprint, init, meas, eval_mode, shots):
+        '''
+        Canonical key of one simulation
+        fingerprint: circuit_fingerprint of the subcircuit instance
+        '''
+        return self.get_fields_key(fingerprint,tuple(init),tuple(tuple(m) for m in meas),eval_mode,shots,self.seed)
+
+    def get_fields_key(self, *fields):
+        '''
+        Canonical key of any fields with a stable repr, e.g. to cache results other than simulations
+        '''
+        return hashlib.sha256(repr(fields).encode()).hexdigest()
+
+    def get(self, key):
+        filename = '%s/%s.pckl'%(self.cache_dir,key)
+        try:
+            value = pickle.load(open(filename,'rb'))
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        try:
+            # Touch the entry to mark it as recently used
+            os.utime(filename)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        filename = '%s/%s.pckl'%(self.cache_dir,key)
+        # Write then rename so that concurrent readers never see a partial entry
+        tmp_filename = '%s.%d.tmp'%(filename,os.getpid())
+        pickle.dump(value, open(tmp_filename,'wb'))
+        self.total_size += os.path.getsize(tmp_filename)
+        if os.path.isfile(filename):
+            # Overwritten entries no longer count
+            self.total_size -= os.path.getsize(filename)
+        os.replace(tmp_filename,filename)
+        if self.total_size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.pckl')]
+        entries = sorted(entries,key=lambda entry:entry.stat().st_mtime)
+        self.total_size = sum([entry.stat().st_size for entry in entries])
+        for entry in entries:
+            if self.total_size <= self.max_size:
+                break
+            entry_size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self.total_size -= entry_size
+            self.evictions += 1
+
+    def get_stats(self):
+        num_lookups = self.hits + self.misses
+        return {'hits':self.hits,'misses':self.misses,'evictions':self.evictions,
+        'hit_rate':self.hits/num_lookups if num_lookups>0 else 0.0,
+        'size':self.total_size}
+
+class MemoryResultCache(ResultCache):
+    '''
+    In-memory cache of subcircuit simulation results, kept by CutQC across evaluations of rebound circuits
+    Same keys as ResultCache. Least recently used entries are evicted once the cache grows beyond max_size (GB).
+    seed may change between evaluations, entries of other seeds are then simply not matched.
+    '''
+    def __init__(self, max_size, seed=None):
+        self.max_size = int(max_size*2**30)
+        self.seed = seed
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.total_size = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key]
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.total_size -= self.get_entry_size(self.entries[key])
+        self.entries[key] = value
+        self.total_size += self.get_entry_size(value)
+        if self.total_size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        while self.total_size > self.max_size and len(self.entries)>0:
+            _, value = self.entries.popitem(last=False)
+            self.total_size -= self.get_entry_size(value)
+            self.evictions += 1
+
+    def get_entry_size(self, value):
+        return sum([getattr(value[meas],'nbytes',8) for meas in value])
@@ -0,0 +1,96 @@
+from qiskit.converters import circuit_to_dag
+import rustworkx as rx
+import numpy as np
+
+class CircuitIR(object):
+    '''
+    Integer-indexed circuit representation shared by the cut front end
+    Built from a single DAG conversion per circuit.
+    ops: DAG op nodes in topological order
+    vertices: two-qubit gates in topological order, i.e. the vertices of the MIP gate graph
+    '''
+    def __init__(self, circuit):
+        self.circuit = circuit
+        self.dag = circuit_to_dag(circuit)
+        self.qubits = list(self.dag.qubits)
+        self.qubit_names = ['%s[%d]'%(qubit.register.name,qubit.index) for qubit in self.qubits]
+        qubit_indices = {qubit:qubit_idx for qubit_idx, qubit in enumerate(self.qubits)}
+
+        self.ops = list(self.dag.topological_op_nodes())
+        self.op_names = [op_node.op.name for op_node in self.ops]
+        # op_qubits[op] = qubit indices of the op in qargs order
+        # op_wire_positions[op] = position of the op among all ops on each of its qubits
+        self.op_qubits = []
+        self.op_wire_positions = []
+        self.wire_ops = [[] for qubit in self.qubits]
+        # op_vertex[op] = vertex of a two-qubit gate, -1 otherwise
+        self.op_vertex = np.full(len(self.ops),-1,dtype=np.int64)
+        self.wire_vertices = [[] for qubit in self.qubits]
+        vertex_ops = []
+        vertex_qubits = []
+        vertex_wire_positions = []
+        for op_idx, op_node in enumerate(self.ops):
+            op_qubits = tuple([qubit_indices[qarg] for qarg in op_node.qargs])
+            self.op_qubits.append(op_qubits)
+            self.op_wire_positions.append(tuple([len(self.wire_ops[qubit]) for qubit in op_qubits]))
+            for qubit in op_qubits:
+                self.wire_ops[qubit].append(op_idx)
+            if len(op_qubits)==2 and op_node.op.name!='barrier':
+                vertex = len(vertex_ops)
+                self.op_vertex[op_idx] = vertex
+                vertex_ops.append(op_idx)
+                vertex_qubits.append(op_qubits)
+                # Position among the two-qubit gates on each qubit, as in the vertex names
+                vertex_wire_positions.append(tuple([len(self.wire_vertices[qubit]) for qubit in op_qubits]))
+                for qubit in op_qubits:
+                    self.wire_vertices[qubit].append(vertex)
+        self.n_vertices = len(vertex_ops)
+        self.vertex_ops = np.array(vertex_ops,dtype=np.int64)
+        self.vertex_qubits = np.array(vertex_qubits,dtype=np.int64).reshape(self.n_vertices,2)
+        self.vertex_wire_positions = np.array(vertex_wire_positions,dtype=np.int64).reshape(self.n_vertices,2)
+
+        self.edges = []
+        for vertex in range(self.n_vertices):
+            for qubit, wire_position in zip(self.vertex_qubits[vertex],self.vertex_wire_positions[vertex]):
+                if wire_position>0:
+                    self.edges.append((self.wire_vertices[qubit][wire_position-1],vertex))
+        self.number_vertices()
+        self.id_vertices = {vertex:self.get_vertex_name(vertex) for vertex in range(self.n_vertices)}
+        self.vertex_ids = {self.id_vertices[vertex]:vertex for vertex in range(self.n_vertices)}
+
+    def number_vertices(self):
+        '''
+        Number the vertices in the topological order of the DAG with only the two-qubit gates,
+        the vertex ids of read_circ on the stripped circuit.
+        Gate graph edges connect consecutive two-qubit gates on every qubit,
+        ordered by source vertex then descending destination vertex as in read_circ.
+        '''
+        num_qubits = len(self.qubits)
+        sort_keys = [self.dag.input_map[qubit].sort_key for qubit in self.qubits]
+        sort_keys += [self.ops[op_idx].sort_key for op_idx in self.vertex_ops]
+        graph = rx.PyDiGraph()
+        graph.add_nodes_from(range(len(sort_keys)))
+        graph.add_edges_from_no_data([(num_qubits+u,num_qubits+v) for u, v in self.edges])
+        graph.add_edges_from_no_data([(qubit,num_qubits+self.wire_vertices[qubit][0]) for qubit in range(num_qubits) if len(self.wire_vertices[qubit])>0])
+        order = [node-num_qubits for node in rx.lexicographical_topological_sort(graph,key=lambda node:sort_keys[node]) if node>=num_qubits]
+        new_ids = np.empty(self.n_vertices,dtype=np.int64)
+        new_ids[order] = np.arange(self.n_vertices)
+        self.vertex_ops = self.vertex_ops[order]
+        self.vertex_qubits = self.vertex_qubits[order]
+        self.vertex_wire_positions = self.vertex_wire_positions[order]
+        self.op_vertex[self.vertex_ops] = np.arange(self.n_vertices)
+        self.wire_vertices = [[int(new_ids[vertex]) for vertex in wire_vertices] for wire_vertices in self.wire_vertices]
+        self.edges = sorted([(int(new_ids[u]),int(new_ids[v])) for u, v in self.edges],key=lambda edge:(edge[0],-edge[1]))
+
+    def get_vertex_name(self, vertex):
+        '''
+        'q[3]5 q[7]2' = the 6th two-qubit gate on q[3] and the 3rd two-qubit gate on q[7]
+        '''
+        return ' '.join(['%s%d'%(self.qubit_names[qubit],wire_position)
+        for qubit, wire_position in zip(self.vertex_qubits[vertex],self.vertex_wire_positions[vertex])])
+
+    def get_gate_graph(self):
+        '''
+        Same outputs as read_circ
+        '''
+        return self.n_vertices, self.edges, self.vertex_ids, self.id_vertices
@@ -1,13 +1,37 @@
 from qiskit.dagcircuit.dagcircuit import DAGCircuit
 from qiskit.converters import circuit_to_dag, dag_to_circuit
-import gurobipy as gp
 import numpy as np
-import math
+import math, random, time, os, pickle
+import multiprocessing as mp
 from qiskit import QuantumCircuit, QuantumRegister
+from cutqc.helper_fun import circuit_fingerprint
+from cutqc.circuit_ir import CircuitIR
+try:
+    import gurobipy as gp
+except ImportError:
+    gp = None
+
+def get_vertex_weight(vertex_name):
+    '''
+    Number of circuit input qubits a vertex carries,
+    i.e. the qargs where the vertex is the first two-qubit gate of the qubit
+    '''
+    num_in_qubits = 0
+    for qarg in vertex_name.split(' '):
+        if int(qarg.split(']')[1]) == 0:
+            num_in_qubits += 1
+    return num_in_qubits
 
 class MIP_Model(object):
-    def __init__(self, n_vertices, edges, vertex_ids, id_vertices, num_subcircuit, max_subcircuit_qubit, num_qubits, max_cuts):
-        self.check_graph(n_vertices, edges)
+    def __init__(self, n_vertices, edges, vertex_ids, id_vertices, num_subcircuit, max_subcircuit_qubit, num_qubits, max_cuts,
+    build_constants=None, vertex_weights=None):
+        '''
+        build_constants: if given, minimize the estimated build time instead of the number of cuts.
+        See build_kernel.calibrate_build_constants.
+        vertex_weights: number of input qubits of every vertex, for coarsened graphs.
+        Defaults to get_vertex_weight of the vertex names.
+        '''
+        self.check_graph(n_vertices, edges, coarse=vertex_weights is not None)
         self.n_vertices = n_vertices
         self.edges = edges
         self.n_edges = len(edges)
@@ -17,18 +41,16 @@ class MIP_Model(object):
         self.max_subcircuit_qubit = max_subcircuit_qubit
         self.num_qubits = num_qubits
         self.max_cuts = max_cuts
+        self.build_constants = build_constants
 
+        if gp is None:
+            raise ImportError('The MIP cut searcher requires gurobipy. Use solver=\'heuristic\' instead.')
         self.model = gp.Model(name='cut_searching')
         self.model.params.OutputFlag = 0
 
-        self.vertex_weight = {}
-        for node in self.vertex_ids:
-            qargs = node.split(' ')
-            num_in_qubits = 0
-            for qarg in qargs:
-                if int(qarg.split(']')[1]) == 0:
-                    num_in_qubits += 1
-            self.vertex_weight[node] = num_in_qubits
+        if vertex_weights is None:
+            vertex_weights = [get_vertex_weight(id_vertices[i]) for i in range(n_vertices)]
+        self.vertex_weight = vertex_weights
 
         # Indicate if a vertex is in some subcircuit
         self.vertex_var = []
@@ -70,8 +92,10 @@ class MIP_Model(object):
         #     v1: in c0 or c1
         #     v2: in c0 or c1 or c2
         #     ....
-        for vertex in range(num_subcircuit):
-            self.model.addConstr(gp.quicksum([self.vertex_var[subcircuit][vertex] for subcircuit in range(vertex+1,num_subcircuit)]) == 0)
+        #   Not compatible with the build time objective, which orders subcircuits by effective qubits instead
+        if self.build_constants is None:
+            for vertex in range(num_subcircuit):
+                self.model.addConstr(gp.quicksum([self.vertex_var[subcircuit][vertex] for subcircuit in range(vertex+1,num_subcircuit)]) == 0)
         
         # NOTE: add 0.1 for numerical stability
         self.num_cuts = self.model.addVar(lb=0, ub=self.max_cuts+0.1, vtype=gp.GRB.INTEGER, name='num_cuts')
@@ -84,7 +108,7 @@ class MIP_Model(object):
         for subcircuit in range(num_subcircuit):
             subcircuit_original_qubit = self.model.addVar(lb=0, ub=self.max_subcircuit_qubit, vtype=gp.GRB.INTEGER, name='subcircuit_input_%d'%subcircuit)
             self.model.addConstr(subcircuit_original_qubit ==
-            gp.quicksum([self.vertex_weight[id_vertices[i]]*self.vertex_var[subcircuit][i]
+            gp.quicksum([self.vertex_weight[i]*self.vertex_var[subcircuit][i]
             for i in range(self.n_vertices)]))
             
             subcircuit_rho_qubits = self.model.addVar(lb=0, ub=self.max_subcircuit_qubit, vtype=gp.GRB.INTEGER, name='subcircuit_rho_qubits_%d'%subcircuit)
@@ -109,13 +133,21 @@ class MIP_Model(object):
             
             if subcircuit>0:
                 lb = 0
-                ub = self.num_qubits+2*20
+                ub = self.num_qubits+2*self.max_cuts
                 ptx, ptf = self.pwl_exp(lb=lb,ub=ub,base=2,integer_only=True)
                 build_cost_exponent = self.model.addVar(lb=lb, ub=ub, vtype=gp.GRB.INTEGER, name='build_cost_exponent_%d'%subcircuit)
                 self.model.addConstr(build_cost_exponent == gp.quicksum(num_effective_qubits)+2*self.num_cuts)
-            #     self.model.setPWLObj(build_cost_exponent, ptx, ptf)
+                if self.build_constants is not None:
+                    # Subcircuits are built in the smart_order of cost_estimate, i.e. ascending effective qubits
+                    self.model.addConstr(num_effective_qubits[subcircuit-1] <= num_effective_qubits[subcircuit])
+                    # Kronecker product of the first subcircuit+1 subcircuits in all 4^num_cuts summation terms
+                    self.model.setPWLObj(build_cost_exponent, ptx, [self.build_constants['element']*y for y in ptf])
 
-        self.model.setObjective(self.num_cuts,gp.GRB.MINIMIZE)
+        if self.build_constants is None:
+            self.model.setObjective(self.num_cuts,gp.GRB.MINIMIZE)
+        else:
+            ptx, ptf = self.pwl_exp(lb=0,ub=self.max_cuts,base=4,integer_only=True)
+            self.model.setPWLObj(self.num_cuts, ptx, [self.build_constants['term']*y for y in ptf])
         self.model.update()
     
     def pwl_exp(self, lb, ub, base, integer_only):
@@ -131,27 +163,88 @@ class MIP_Model(object):
             ptf.append(y)
         return ptx, ptf
     
-    def check_graph(self, n_vertices, edges):
+    def check_graph(self, n_vertices, edges, coarse=False):
         # 1. edges must include all vertices
         # 2. all u,v must be ordered and smaller than n_vertices
+        # Coarsened graphs may have isolated clusters and edges against the cluster order
         vertices = set([i for (i, _) in edges])
         vertices |= set([i for (_, i) in edges])
-        assert(vertices == set(range(n_vertices)))
+        if coarse:
+            assert(vertices <= set(range(n_vertices)))
+        else:
+            assert(vertices == set(range(n_vertices)))
         for u, v in edges:
-            assert(u < v)
+            if coarse:
+                assert(u != v)
+            else:
+                assert(u < v)
             assert(u < n_vertices)
     
-    def solve(self,min_postprocessing_cost):
+    def set_start(self, partition):
+        '''
+        Warm start the MIP from a partition, partition[vertex] = subcircuit
+        '''
+        if self.build_constants is None:
+            partition = canonical_partition(partition)
+        else:
+            partition = effective_order_partition(partition=partition,edges=self.edges,
+            vertex_weight=self.vertex_weight)
+        for i in range(self.num_subcircuit):
+            for j in range(self.n_vertices):
+                self.vertex_var[i][j].Start = int(partition[j]==i)
+            for j in range(self.n_edges):
+                u, v = self.edges[j]
+                self.edge_var[i][j].Start = int((partition[u]==i)!=(partition[v]==i))
+
+    def solve(self,min_postprocessing_cost,shared_incumbent=None,threads=None,
+    time_limit=300,warm_start=None,incumbent_callback=None):
+        '''
+        min_postprocessing_cost: cost of the best solution known so far.
+        shared_incumbent: optional mp.Value holding the best cost found by concurrent searches.
+        The search stops early once it cannot beat the incumbent.
+        time_limit: time budget of the search in seconds
+        warm_start: optional partition to start the search from
+        incumbent_callback: called with every improving solution found during the search
+        '''
         # print('solving for %d subcircuits'%self.num_subcircuit)
         # print('model has %d variables, %d linear constraints,%d quadratic constraints, %d general constraints'
         # % (self.model.NumVars,self.model.NumConstrs, self.model.NumQConstrs, self.model.NumGenConstrs))
-        try:
-            self.model.Params.TimeLimit = 300
+        best_objective = [float('inf')]
+        def search_callback(model, where):
+            if where == gp.GRB.Callback.MIP and shared_incumbent is not None:
+                objective_bound = model.cbGet(gp.GRB.Callback.MIP_OBJBND)
+                if self.build_constants is None:
+                    # The bound is infinite before the root relaxation is solved
+                    min_num_cuts = min(objective_bound-1e-6,self.max_cuts+1)
+                    objective_bound = min_reconstruction_cost(num_cuts=math.ceil(min_num_cuts),num_qubits=self.num_qubits)
+                if objective_bound >= shared_incumbent.value:
+                    model.terminate()
+            elif where == gp.GRB.Callback.MIPSOL and incumbent_callback is not None:
+                objective = model.cbGet(gp.GRB.Callback.MIPSOL_OBJ)
+                if objective >= best_objective[0]:
+                    return
+                best_objective[0] = objective
+                num_cuts = round(model.cbGetSolution(self.num_cuts))
+                partition = [None]*self.n_vertices
+                for i in range(self.num_subcircuit):
+                    for j, y in enumerate(model.cbGetSolution(self.vertex_var[i])):
+                        if y > 0.5:
+                            partition[j] = i
+                incumbent_callback(get_incumbent(id_vertices=self.id_vertices,num_subcircuit=self.num_subcircuit,
+                partition=partition,num_cuts=num_cuts,
+                runtime=model.cbGet(gp.GRB.Callback.RUNTIME)))
+        # Gurobi errors propagate, so that a failed search is not mistaken for an infeasible one
+        self.model.Params.TimeLimit = max(time_limit,0)
+        if threads is not None:
+            self.model.Params.Threads = threads
+        if self.build_constants is None:
+            self.model.Params.cutoff = get_cuts_cutoff(min_postprocessing_cost=min_postprocessing_cost,num_qubits=self.num_qubits)
+        else:
             self.model.Params.cutoff = min_postprocessing_cost
-            self.model.optimize()
-        except (gp.GurobiError, AttributeError, Exception) as e:
-            print('Caught: ' + e.message)
-        
+        if warm_start is not None:
+            self.set_start(partition=warm_start)
+        self.model.optimize(search_callback)
+
         if self.model.solcount > 0:
             self.objective = None
             self.subcircuits = []
@@ -161,11 +254,13 @@ class MIP_Model(object):
             self.mip_gap = self.model.mipgap
             self.objective = self.model.ObjVal
 
+            self.partition = [None]*self.n_vertices
             for i in range(self.num_subcircuit):
                 subcircuit = []
                 for j in range(self.n_vertices):
                     if abs(self.vertex_var[i][j].x) > 1e-4:
                         subcircuit.append(self.id_vertices[j])
+                        self.partition[j] = i
                 self.subcircuits.append(subcircuit)
             assert sum([len(subcircuit) for subcircuit in self.subcircuits])==self.n_vertices
 
@@ -183,163 +278,341 @@ class MIP_Model(object):
             # print('Infeasible')
             return False
 
+class Heuristic_Model(object):
+    '''
+    Gurobi-free cut searcher with the same interface as MIP_Model
+    Subcircuits are first grown greedily over the gate graph,
+    then refined by simulated annealing and a final greedy descent over single vertex moves.
+    A subcircuit width is counted as in MIP_Model: input qubits + \u03C1 qubits
+    '''
+    def __init__(self, n_vertices, edges, vertex_ids, id_vertices, num_subcircuit, max_subcircuit_qubit, num_qubits, max_cuts,
+    build_constants=None, vertex_weights=None, time_limit=10, num_restarts=4, seed=0):
+        '''
+        build_constants: only used to discard solutions dominated by the incumbent,
+        the search itself minimizes the number of cuts
+        vertex_weights: same as in MIP_Model
+        '''
+        self.n_vertices = n_vertices
+        self.edges = edges
+        self.n_edges = len(edges)
+        self.vertex_ids = vertex_ids
+        self.id_vertices = id_vertices
+        self.num_subcircuit = num_subcircuit
+        self.max_subcircuit_qubit = max_subcircuit_qubit
+        self.num_qubits = num_qubits
+        self.max_cuts = max_cuts
+        self.build_constants = build_constants
+        self.time_limit = time_limit
+        self.num_restarts = num_restarts
+        self.seed = seed
+
+        if vertex_weights is None:
+            vertex_weights = [get_vertex_weight(id_vertices[vertex]) for vertex in range(n_vertices)]
+        self.vertex_weight = vertex_weights
+        self.out_neighbors = [[] for vertex in range(n_vertices)]
+        self.in_neighbors = [[] for vertex in range(n_vertices)]
+        for u, v in edges:
+            self.out_neighbors[u].append(v)
+            self.in_neighbors[v].append(u)
+        # Violations are weighted above any possible saving in cuts
+        self.penalty = self.n_edges+1
+
+    def initialize(self, rng):
+        '''
+        Greedily grow num_subcircuit-1 subcircuits from the earliest unassigned vertex.
+        The last subcircuit takes the remaining vertices.
+        '''
+        self.partition = [-1]*self.n_vertices
+        self.subcircuit_d = [0]*self.num_subcircuit
+        self.subcircuit_sizes = [0]*self.num_subcircuit
+        self.num_cuts = 0
+        unassigned = set(range(self.n_vertices))
+        for subcircuit in range(self.num_subcircuit-1):
+            target_size = len(unassigned)/(self.num_subcircuit-subcircuit)
+            seed_vertex = min(unassigned)
+            frontier = {seed_vertex}
+            while len(frontier)>0 and self.subcircuit_sizes[subcircuit]<target_size:
+                best_vertex, best_gain = None, None
+                for vertex in frontier:
+                    neighbors = self.out_neighbors[vertex]+self.in_neighbors[vertex]
+                    gain = 2*sum([self.partition[x]==subcircuit for x in neighbors])-len(neighbors)+rng.random()*0.1
+                    if best_gain is None or gain>best_gain:
+                        best_vertex, best_gain = vertex, gain
+                frontier.remove(best_vertex)
+                delta_d, delta_cuts = self.move_delta(vertex=best_vertex,target=subcircuit)
+                if self.subcircuit_d[subcircuit]+delta_d.get(subcircuit,0)>self.max_subcircuit_qubit:
+                    continue
+                self.apply_move(vertex=best_vertex,target=subcircuit,delta_d=delta_d,delta_cuts=delta_cuts)
+                unassigned.remove(best_vertex)
+                for x in self.out_neighbors[best_vertex]+self.in_neighbors[best_vertex]:
+                    if self.partition[x]==-1:
+                        frontier.add(x)
+        for vertex in sorted(unassigned):
+            delta_d, delta_cuts = self.move_delta(vertex=vertex,target=self.num_subcircuit-1)
+            self.apply_move(vertex=vertex,target=self.num_subcircuit-1,delta_d=delta_d,delta_cuts=delta_cuts)
+
+    def set_partition(self, partition):
+        '''
+        Start from a given partition instead of growing one
+        '''
+        self.partition = [-1]*self.n_vertices
+        self.subcircuit_d = [0]*self.num_subcircuit
+        self.subcircuit_sizes = [0]*self.num_subcircuit
+        self.num_cuts = 0
+        for vertex in range(self.n_vertices):
+            delta_d, delta_cuts = self.move_delta(vertex=vertex,target=partition[vertex])
+            self.apply_move(vertex=vertex,target=partition[vertex],delta_d=delta_d,delta_cuts=delta_cuts)
+
+    def move_delta(self, vertex, target):
+        '''
+        Change of the subcircuit widths and of the number of cuts when moving vertex into target.
+        Unassigned vertices have partition -1.
+        '''
+        source = self.partition[vertex]
+        delta_d = {}
+        delta_cuts = 0
+        if source!=-1:
+            delta_d[source] = -self.vertex_weight[vertex]
+        delta_d[target] = delta_d.get(target,0)+self.vertex_weight[vertex]
+        for x in self.out_neighbors[vertex]:
+            # vertex is the O side of this edge, x gains a \u03C1 qubit if they are apart
+            x_subcircuit = self.partition[x]
+            if x_subcircuit==-1:
+                continue
+            before = source!=-1 and x_subcircuit!=source
+            after = x_subcircuit!=target
+            delta_d[x_subcircuit] = delta_d.get(x_subcircuit,0)+int(after)-int(before)
+            delta_cuts += int(after)-int(before)
+        for x in self.in_neighbors[vertex]:
+            # vertex is the \u03C1 side of this edge
+            x_subcircuit = self.partition[x]
+            if x_subcircuit==-1:
+                continue
+            if source!=-1 and x_subcircuit!=source:
+                delta_d[source] = delta_d.get(source,0)-1
+                delta_cuts -= 1
+            if x_subcircuit!=target:
+                delta_d[target] = delta_d.get(target,0)+1
+                delta_cuts += 1
+        return delta_d, delta_cuts
+
+    def apply_move(self, vertex, target, delta_d, delta_cuts):
+        source = self.partition[vertex]
+        if source!=-1:
+            self.subcircuit_sizes[source] -= 1
+        self.subcircuit_sizes[target] += 1
+        self.partition[vertex] = target
+        for subcircuit in delta_d:
+            self.subcircuit_d[subcircuit] += delta_d[subcircuit]
+        self.num_cuts += delta_cuts
+
+    def violation(self, subcircuit_d, num_cuts):
+        excess_width = sum([max(0,d-self.max_subcircuit_qubit) for d in subcircuit_d])
+        return excess_width + max(0,num_cuts-self.max_cuts)
+
+    def move_cost(self, delta_d, delta_cuts):
+        '''
+        Change of the penalized objective = num_cuts + penalty*violation
+        '''
+        violation_before = 0
+        violation_after = 0
+        for subcircuit in delta_d:
+            violation_before += max(0,self.subcircuit_d[subcircuit]-self.max_subcircuit_qubit)
+            violation_after += max(0,self.subcircuit_d[subcircuit]+delta_d[subcircuit]-self.max_subcircuit_qubit)
+        violation_before += max(0,self.num_cuts-self.max_cuts)
+        violation_after += max(0,self.num_cuts+delta_cuts-self.max_cuts)
+        return delta_cuts + self.penalty*(violation_after-violation_before)
+
+    def propose(self, rng):
+        vertex = rng.randrange(self.n_vertices)
+        neighbors = self.out_neighbors[vertex]+self.in_neighbors[vertex]
+        target = self.partition[rng.choice(neighbors)] if len(neighbors)>0 else self.partition[vertex]
+        if target==self.partition[vertex]:
+            target = rng.randrange(self.num_subcircuit)
+        if target==self.partition[vertex] or self.subcircuit_sizes[self.partition[vertex]]==1:
+            return None
+        return vertex, target
+
+    def refine(self, rng, num_iterations, deadline):
+        '''
+        Simulated annealing over single vertex moves, then greedy descent
+        '''
+        temperature = 2.0
+        cooling = math.pow(0.01/temperature,1/max(num_iterations,1))
+        self.record_best()
+        for iteration in range(num_iterations):
+            if iteration%1000==0 and time.time()>deadline:
+                break
+            temperature *= cooling
+            move = self.propose(rng)
+            if move is None:
+                continue
+            vertex, target = move
+            delta_d, delta_cuts = self.move_delta(vertex=vertex,target=target)
+            delta_cost = self.move_cost(delta_d=delta_d,delta_cuts=delta_cuts)
+            if delta_cost<=0 or rng.random()<math.exp(-delta_cost/temperature):
+                self.apply_move(vertex=vertex,target=target,delta_d=delta_d,delta_cuts=delta_cuts)
+                if delta_cost<0:
+                    self.record_best()
+        self.restore_best()
+        improved = True
+        while improved and time.time()<=deadline:
+            improved = False
+            for vertex in range(self.n_vertices):
+                if self.subcircuit_sizes[self.partition[vertex]]==1:
+                    continue
+                for target in range(self.num_subcircuit):
+                    if target==self.partition[vertex]:
+                        continue
+                    delta_d, delta_cuts = self.move_delta(vertex=vertex,target=target)
+                    if self.move_cost(delta_d=delta_d,delta_cuts=delta_cuts)<0:
+                        self.apply_move(vertex=vertex,target=target,delta_d=delta_d,delta_cuts=delta_cuts)
+                        improved = True
+                        break
+        self.record_best()
+        self.restore_best()
+
+    def record_best(self):
+        cost = self.num_cuts + self.penalty*self.violation(subcircuit_d=self.subcircuit_d,num_cuts=self.num_cuts)
+        if self.best is None or cost<self.best[0]:
+            self.best = (cost,list(self.partition),list(self.subcircuit_d),list(self.subcircuit_sizes),self.num_cuts)
+
+    def restore_best(self):
+        _, partition, subcircuit_d, subcircuit_sizes, num_cuts = self.best
+        self.partition, self.subcircuit_d, self.subcircuit_sizes, self.num_cuts = list(partition), list(subcircuit_d), list(subcircuit_sizes), num_cuts
+
+    def solve(self, min_postprocessing_cost, shared_incumbent=None, threads=None,
+    time_limit=None, warm_start=None, incumbent_callback=None):
+        '''
+        Same arguments as MIP_Model.solve
+        time_limit: defaults to the time_limit given at construction
+        warm_start: partition refined by the first restart
+        '''
+        begin = time.time()
+        deadline = begin + (self.time_limit if time_limit is None else time_limit)
+        num_iterations = max(20000,200*self.n_vertices)
+        best_partition = None
+        for restart in range(self.num_restarts):
+            if restart>0 and time.time()>deadline:
+                break
+            rng = random.Random(self.seed+restart)
+            self.best = None
+            if restart==0 and warm_start is not None:
+                self.set_partition(partition=warm_start)
+            else:
+                self.initialize(rng)
+            self.refine(rng=rng,num_iterations=num_iterations,deadline=deadline)
+            feasible = self.violation(subcircuit_d=self.subcircuit_d,num_cuts=self.num_cuts)==0 and min(self.subcircuit_sizes)>0
+            if shared_incumbent is not None:
+                min_postprocessing_cost = min(min_postprocessing_cost,shared_incumbent.value)
+            # Solutions with too many cuts cannot beat the incumbent
+            feasible = feasible and self.num_cuts<get_cuts_cutoff(min_postprocessing_cost=min_postprocessing_cost,num_qubits=self.num_qubits,
+            build_constants=self.build_constants)
+            if feasible and (best_partition is None or self.num_cuts<best_partition[1]):
+                best_partition = (list(self.partition),self.num_cuts)
+                if incumbent_callback is not None:
+                    incumbent_callback(get_incumbent(id_vertices=self.id_vertices,num_subcircuit=self.num_subcircuit,
+                    partition=self.partition,num_cuts=self.num_cuts,runtime=time.time()-begin))
+        self.runtime = time.time()-begin
+        if best_partition is None:
+            return False
+        self.partition, num_cuts = best_partition
+        self.optimal = False
+        self.node_count = None
+        self.mip_gap = None
+        self.objective = num_cuts
+        self.subcircuits = [[self.id_vertices[vertex] for vertex in range(self.n_vertices) if self.partition[vertex]==subcircuit]
+        for subcircuit in range(self.num_subcircuit)]
+        self.cut_edges = [(self.id_vertices[u],self.id_vertices[v]) for u, v in self.edges if self.partition[u]!=self.partition[v]]
+        return True
+
 def read_circ(circuit):
-    dag = circuit_to_dag(circuit)
-    edges = []
-    node_name_ids = {}
-    id_node_names = {}
-    vertex_ids = {}
-    curr_node_id = 0
-    qubit_gate_counter = {}
-    for qubit in dag.qubits:
-        qubit_gate_counter[qubit] = 0
-    for vertex in dag.topological_op_nodes():
-        if len(vertex.qargs) != 2:
-            raise Exception('vertex does not have 2 qargs!')
-        arg0, arg1 = vertex.qargs
-        vertex_name = '%s[%d]%d %s[%d]%d' % (arg0.register.name, arg0.index, qubit_gate_counter[arg0],
-                                             arg1.register.name, arg1.index, qubit_gate_counter[arg1])
-        qubit_gate_counter[arg0] += 1
-        qubit_gate_counter[arg1] += 1
-        # print(vertex.op.label,vertex_name,curr_node_id)
-        if vertex_name not in node_name_ids and id(vertex) not in vertex_ids:
-            node_name_ids[vertex_name] = curr_node_id
-            id_node_names[curr_node_id] = vertex_name
-            vertex_ids[id(vertex)] = curr_node_id
-            curr_node_id += 1
-
-    for u, v, _ in dag.edges():
-        if u.type == 'op' and v.type == 'op':
-            u_id = vertex_ids[id(u)]
-            v_id = vertex_ids[id(v)]
-            edges.append((u_id, v_id))
-            
-    n_vertices = dag.size()
-    return n_vertices, edges, node_name_ids, id_node_names
+    '''
+    Gate graph of the two-qubit gates, see CircuitIR
+    '''
+    return CircuitIR(circuit=circuit).get_gate_graph()
 
-def cuts_parser(cuts, circ):
-    dag = circuit_to_dag(circ)
+def cuts_parser(cuts, circuit_ir):
+    '''
+    Convert the cut edges of the gate graph to (wire, position of the op right before the cut on the wire)
+    '''
     positions = []
     for position in cuts:
         source, dest = position
-        source_qargs = [(x.split(']')[0]+']',int(x.split(']')[1])) for x in source.split(' ')]
-        dest_qargs = [(x.split(']')[0]+']',int(x.split(']')[1])) for x in dest.split(' ')]
-        qubit_cut = []
-        for source_qarg in source_qargs:
-            source_qubit, source_multi_Q_gate_idx = source_qarg
-            for dest_qarg in dest_qargs:
-                dest_qubit, dest_multi_Q_gate_idx = dest_qarg
-                if source_qubit==dest_qubit and dest_multi_Q_gate_idx == source_multi_Q_gate_idx+1:
-                    qubit_cut.append(source_qubit)
-        # if len(qubit_cut)>1:
-        #     raise Exception('one cut is cutting on multiple qubits')
-        for x in source.split(' '):
-            if x.split(']')[0]+']' == qubit_cut[0]:
-                source_idx = int(x.split(']')[1])
-        for x in dest.split(' '):
-            if x.split(']')[0]+']' == qubit_cut[0]:
-                dest_idx = int(x.split(']')[1])
-        multi_Q_gate_idx = max(source_idx, dest_idx)
-        
-        wire = None
-        for qubit in circ.qubits:
-            if qubit.register.name == qubit_cut[0].split('[')[0] and qubit.index == int(qubit_cut[0].split('[')[1].split(']')[0]):
-                wire = qubit
-        tmp = 0
-        all_Q_gate_idx = None
-        for gate_idx, gate in enumerate(list(dag.nodes_on_wire(wire=wire, only_ops=True))):
-            if len(gate.qargs)>1:
-                tmp += 1
-                if tmp == multi_Q_gate_idx:
-                    all_Q_gate_idx = gate_idx
-        positions.append((wire, all_Q_gate_idx))
+        source_vertex = circuit_ir.vertex_ids[source]
+        dest_vertex = circuit_ir.vertex_ids[dest]
+        source_qubits = list(circuit_ir.vertex_qubits[source_vertex])
+        dest_qubits = list(circuit_ir.vertex_qubits[dest_vertex])
+        cut_qarg = None
+        for source_qarg, qubit in enumerate(source_qubits):
+            if qubit in dest_qubits and \
+                circuit_ir.vertex_wire_positions[dest_vertex][dest_qubits.index(qubit)] == circuit_ir.vertex_wire_positions[source_vertex][source_qarg]+1:
+                cut_qarg = source_qarg
+                break
+        # if the two gates share multiple qubits, the cut is on the first one
+        qubit = source_qubits[cut_qarg]
+        all_Q_gate_idx = circuit_ir.op_wire_positions[circuit_ir.vertex_ops[source_vertex]][cut_qarg]
+        positions.append((circuit_ir.qubits[qubit], all_Q_gate_idx))
     positions = sorted(positions, reverse=True, key=lambda cut: cut[1])
     return positions
 
-def subcircuits_parser(subcircuit_gates, circuit):
+def subcircuits_parser(subcircuit_gates, circuit_ir):
     '''
     Assign the single qubit gates to the closest two-qubit gates
+    subcircuit_gates: vertex names of the two-qubit gates in every subcircuit
+    An op goes to the subcircuit of the nearest two-qubit gate on its wire.
+    Ties go to the smaller subcircuit index.
     '''
-    def calculate_distance_between_gate(gate_A, gate_B):
-        if len(gate_A.split(' '))>=len(gate_B.split(' ')):
-            tmp_gate = gate_A
-            gate_A = gate_B
-            gate_B = tmp_gate
-        distance = float('inf')
-        for qarg_A in gate_A.split(' '):
-            qubit_A = qarg_A.split(']')[0]+']'
-            qgate_A = int(qarg_A.split(']')[-1])
-            for qarg_B in gate_B.split(' '):
-                qubit_B = qarg_B.split(']')[0]+']'
-                qgate_B = int(qarg_B.split(']')[-1])
-                # print('%s gate %d --> %s gate %d'%(qubit_A,qgate_A,qubit_B,qgate_B))
-                if qubit_A==qubit_B:
-                    distance = min(distance,abs(qgate_B-qgate_A))
-        # print('Distance from %s to %s = %f'%(gate_A,gate_B,distance))
-        return distance
-
-    dag = circuit_to_dag(circuit)
-    qubit_allGate_depths = {x:0 for x in circuit.qubits}
-    qubit_2qGate_depths = {x:0 for x in circuit.qubits}
-    gate_depth_encodings = {}
-    # print('Before translation :',subcircuit_gates,flush=True)
-    for op_node in dag.topological_op_nodes():
-        gate_depth_encoding = ''
-        for qarg in op_node.qargs:
-            gate_depth_encoding += '%s[%d]%d '%(qarg.register.name,qarg.index,qubit_allGate_depths[qarg])
-        gate_depth_encoding = gate_depth_encoding[:-1]
-        gate_depth_encodings[op_node] = gate_depth_encoding
-        for qarg in op_node.qargs:
-            qubit_allGate_depths[qarg] += 1
-        if len(op_node.qargs)==2:
-            MIP_gate_depth_encoding = ''
-            for qarg in op_node.qargs:
-                MIP_gate_depth_encoding += '%s[%d]%d '%(qarg.register.name,qarg.index,qubit_2qGate_depths[qarg])
-                qubit_2qGate_depths[qarg] += 1
-            MIP_gate_depth_encoding = MIP_gate_depth_encoding[:-1]
-            # print('gate_depth_encoding = %s, MIP_gate_depth_encoding = %s'%(gate_depth_encoding,MIP_gate_depth_encoding))
-            for subcircuit_idx in range(len(subcircuit_gates)):
-                for gate_idx in range(len(subcircuit_gates[subcircuit_idx])):
-                    if subcircuit_gates[subcircuit_idx][gate_idx]==MIP_gate_depth_encoding:
-                        subcircuit_gates[subcircuit_idx][gate_idx]=gate_depth_encoding
-                        break
-    # print('After translation :',subcircuit_gates,flush=True)
+    dag = circuit_ir.dag
+    vertex_subcircuits = np.full(circuit_ir.n_vertices,-1,dtype=np.int64)
+    for subcircuit_idx, subcircuit in enumerate(subcircuit_gates):
+        for gate in subcircuit:
+            vertex_subcircuits[circuit_ir.vertex_ids[gate]] = subcircuit_idx
     subcircuit_op_nodes = {x:[] for x in range(len(subcircuit_gates))}
     subcircuit_sizes = [0 for x in range(len(subcircuit_gates))]
     complete_path_map = {}
-    for circuit_qubit in dag.qubits:
+    for qubit_idx, circuit_qubit in enumerate(circuit_ir.qubits):
         complete_path_map[circuit_qubit] = []
-        qubit_ops = dag.nodes_on_wire(wire=circuit_qubit,only_ops=True)
-        for qubit_op_idx, qubit_op in enumerate(qubit_ops):
-            gate_depth_encoding = gate_depth_encodings[qubit_op]
-            nearest_subcircuit_idx = -1
-            min_distance = float('inf')
-            for subcircuit_idx in range(len(subcircuit_gates)):
-                distance = float('inf')
-                for gate in subcircuit_gates[subcircuit_idx]:
-                    if len(gate.split(' '))==1:
-                        # Do not compare against single qubit gates
-                        continue
-                    else:
-                        distance = min(distance,calculate_distance_between_gate(gate_A=gate_depth_encoding, gate_B=gate))
-                # print('Distance from %s to subcircuit %d = %f'%(gate_depth_encoding,subcircuit_idx,distance))
-                if distance<min_distance:
-                    min_distance = distance
-                    nearest_subcircuit_idx = subcircuit_idx
+        wire_ops = circuit_ir.wire_ops[qubit_idx]
+        # Distance and subcircuit of the nearest two-qubit gate at or after every position on the wire
+        next_gates = [(float('inf'),-1)]*len(wire_ops)
+        next_gate = (float('inf'),-1)
+        for wire_position in range(len(wire_ops)-1,-1,-1):
+            vertex = circuit_ir.op_vertex[wire_ops[wire_position]]
+            if vertex!=-1:
+                next_gate = (wire_position,vertex_subcircuits[vertex])
+            next_gates[wire_position] = next_gate
+        prev_gate = (float('-inf'),-1)
+        for qubit_op_idx, op_idx in enumerate(wire_ops):
+            qubit_op = circuit_ir.ops[op_idx]
+            vertex = circuit_ir.op_vertex[op_idx]
+            if vertex!=-1:
+                prev_gate = (qubit_op_idx,vertex_subcircuits[vertex])
+                nearest_subcircuit_idx = prev_gate[1]
+            else:
+                prev_distance = qubit_op_idx-prev_gate[0]
+                next_distance = next_gates[qubit_op_idx][0]-qubit_op_idx
+                if prev_distance<next_distance:
+                    nearest_subcircuit_idx = prev_gate[1]
+                elif next_distance<prev_distance:
+                    nearest_subcircuit_idx = next_gates[qubit_op_idx][1]
+                else:
+                    nearest_subcircuit_idx = min(prev_gate[1],next_gates[qubit_op_idx][1])
             assert nearest_subcircuit_idx!=-1
             path_element = {'subcircuit_idx':nearest_subcircuit_idx,
             'subcircuit_qubit':subcircuit_sizes[nearest_subcircuit_idx]}
             if len(complete_path_map[circuit_qubit])==0 or nearest_subcircuit_idx!=complete_path_map[circuit_qubit][-1]['subcircuit_idx']:
-                # print('{} op #{:d} {:s} encoding = {:s}'.format(circuit_qubit,qubit_op_idx,qubit_op.name,gate_depth_encoding),
+                # print('{} op #{:d} {:s}'.format(circuit_qubit,qubit_op_idx,qubit_op.name),
                 # 'belongs in subcircuit %d'%nearest_subcircuit_idx)
                 complete_path_map[circuit_qubit].append(path_element)
                 subcircuit_sizes[nearest_subcircuit_idx] += 1
 
             subcircuit_op_nodes[nearest_subcircuit_idx].append(qubit_op)
+    subcircuit_registers = [QuantumRegister(size=subcircuit_size,name='q') for subcircuit_size in subcircuit_sizes]
     for circuit_qubit in complete_path_map:
         # print(circuit_qubit,'-->')
         for path_element in complete_path_map[circuit_qubit]:
-            path_element_qubit = QuantumRegister(size=subcircuit_sizes[path_element['subcircuit_idx']],name='q')[path_element['subcircuit_qubit']]
+            path_element_qubit = subcircuit_registers[path_element['subcircuit_idx']][path_element['subcircuit_qubit']]
             path_element['subcircuit_qubit'] = path_element_qubit
             # print(path_element)
     subcircuits = generate_subcircuits(subcircuit_op_nodes=subcircuit_op_nodes, complete_path_map=complete_path_map, subcircuit_sizes=subcircuit_sizes, dag=dag)
@@ -348,10 +621,14 @@ def subcircuits_parser(subcircuit_gates, circuit):
 def generate_subcircuits(subcircuit_op_nodes, complete_path_map, subcircuit_sizes, dag):
     qubit_pointers = {x:0 for x in complete_path_map}
     subcircuits = [QuantumCircuit(x,name='q') for x in subcircuit_sizes]
+    op_node_subcircuits = {}
+    for subcircuit_idx in subcircuit_op_nodes:
+        for op_node in subcircuit_op_nodes[subcircuit_idx]:
+            op_node_subcircuits.setdefault(op_node,set()).add(subcircuit_idx)
     for op_node in dag.topological_op_nodes():
-        subcircuit_idx = list(filter(lambda x:op_node in subcircuit_op_nodes[x],subcircuit_op_nodes.keys()))
+        subcircuit_idx = op_node_subcircuits[op_node]
         assert len(subcircuit_idx)==1
-        subcircuit_idx = subcircuit_idx[0]
+        subcircuit_idx = subcircuit_idx.pop()
         # print('{} belongs in subcircuit {:d}'.format(op_node.qargs,subcircuit_idx))
         subcircuit_qargs = []
         for op_node_qarg in op_node.qargs:
@@ -411,13 +688,297 @@ def get_counter(subcircuits, O_rho_pairs):
         counter[rho_qubit['subcircuit_idx']]['rho'] += 1
     return counter
 
-def find_cuts(circuit, max_subcircuit_qubit, max_cuts, num_subcircuits, verbose):
-    stripped_circ = circuit_stripping(circuit=circuit)
-    n_vertices, edges, vertex_ids, id_vertices = read_circ(circuit=stripped_circ)
+def estimate_build_time(counter, build_constants):
+    '''
+    Estimated time to build all summation terms in seconds
+    '''
+    num_cuts = sum([counter[subcircuit_idx]['rho'] for subcircuit_idx in counter])
+    return build_constants['term']*4**num_cuts + build_constants['element']*cost_estimate(counter=counter)
+
+def get_reconstruction_cost(counter, build_constants):
+    '''
+    Cost used to rank cut solutions:
+    cost_estimate, or the estimated build time if build_constants are given
+    '''
+    if build_constants is None:
+        return cost_estimate(counter=counter)
+    else:
+        return estimate_build_time(counter=counter,build_constants=build_constants)
+
+def min_reconstruction_cost(num_cuts, num_qubits, build_constants=None):
+    '''
+    Lower bound of get_reconstruction_cost over all cut solutions with num_cuts cuts.
+    The last Kronecker product alone has length 2^num_qubits.
+    '''
+    if build_constants is None:
+        return 4**num_cuts*2**num_qubits
+    else:
+        return 4**num_cuts*(build_constants['term']+build_constants['element']*2**num_qubits)
+
+def get_cuts_cutoff(min_postprocessing_cost, num_qubits, build_constants=None):
+    '''
+    Solutions with num_cuts >= cutoff cannot beat min_postprocessing_cost
+    '''
+    if min_postprocessing_cost==float('inf'):
+        return float('inf')
+    num_cuts = 0
+    while min_reconstruction_cost(num_cuts=num_cuts,num_qubits=num_qubits,build_constants=build_constants)<min_postprocessing_cost:
+        num_cuts += 1
+    return num_cuts
+
+def effective_order_partition(partition, edges, vertex_weight):
+    '''
+    Relabel subcircuits in ascending order of effective qubits.
+    Satisfies the subcircuit order constraints of the build time objective.
+    '''
+    num_effective_qubits = {}
+    for vertex, subcircuit in enumerate(partition):
+        num_effective_qubits[subcircuit] = num_effective_qubits.get(subcircuit,0)+vertex_weight[vertex]
+    for u, v in edges:
+        if partition[u]!=partition[v]:
+            # effective = input + rho - O
+            num_effective_qubits[partition[u]] -= 1
+            num_effective_qubits[partition[v]] += 1
+    order = sorted(num_effective_qubits,key=lambda subcircuit:num_effective_qubits[subcircuit])
+    labels = {subcircuit:label for label, subcircuit in enumerate(order)}
+    return [labels[subcircuit] for subcircuit in partition]
+
+def canonical_partition(partition):
+    '''
+    Relabel subcircuits in order of their first vertex.
+    Satisfies the symmetry-breaking constraints of MIP_Model.
+    '''
+    labels = {}
+    for subcircuit in partition:
+        if subcircuit not in labels:
+            labels[subcircuit] = len(labels)
+    return [labels[subcircuit] for subcircuit in partition]
+
+def get_incumbent(id_vertices, num_subcircuit, partition, num_cuts, runtime):
+    '''
+    Improving solution reported to incumbent_callback
+    '''
+    subcircuits = [[] for subcircuit in range(num_subcircuit)]
+    for vertex, subcircuit in enumerate(partition):
+        subcircuits[subcircuit].append(id_vertices[vertex])
+    return {'num_subcircuit':num_subcircuit,'num_cuts':num_cuts,'subcircuits':subcircuits,'runtime':runtime}
+
+def get_cut_cache_key(cut_cache, fingerprint, max_subcircuit_qubit, max_cuts, num_subcircuit, objective):
+    return cut_cache.get_fields_key('cut_solution',fingerprint,max_subcircuit_qubit,max_cuts,num_subcircuit,objective)
+
+def get_vertex_qubits(vertex_name):
+    return set([qarg.split(']')[0] for qarg in vertex_name.split(' ')])
+
+def coarsen_graph(n_vertices, edges, id_vertices, max_subcircuit_qubit, max_vertices):
+    '''
+    Contract the gate graph by heavy-edge matching until it has at most max_vertices vertices.
+    Vertices sharing the most edges are merged first,
+    e.g. consecutive gates on the same qubit pair.
+    A cluster never spans more than max_subcircuit_qubit qubits, so that it still fits in a subcircuit.
+    Returns clusters[vertex] = coarse vertex and the coarse graph.
+    Every fine edge between two clusters is kept, so cuts and ρ/O qubits are counted exactly.
+    '''
+    clusters = list(range(n_vertices))
+    cluster_qubits = [get_vertex_qubits(id_vertices[vertex]) for vertex in range(n_vertices)]
+    cluster_weights = [get_vertex_weight(id_vertices[vertex]) for vertex in range(n_vertices)]
+    coarse_n_vertices = n_vertices
+    coarse_edges = list(edges)
+    while coarse_n_vertices>max_vertices:
+        neighbors = [{} for vertex in range(coarse_n_vertices)]
+        for u, v in coarse_edges:
+            neighbors[u][v] = neighbors[u].get(v,0)+1
+            neighbors[v][u] = neighbors[v].get(u,0)+1
+        match = [-1]*coarse_n_vertices
+        num_merges = 0
+        for u in sorted(range(coarse_n_vertices),key=lambda vertex:len(cluster_qubits[vertex])):
+            if match[u]!=-1:
+                continue
+            best_v, best_key = None, None
+            for v in neighbors[u]:
+                merged_qubits = len(cluster_qubits[u]|cluster_qubits[v])
+                if match[v]!=-1 or merged_qubits>max_subcircuit_qubit:
+                    continue
+                key = (neighbors[u][v],-merged_qubits)
+                if best_key is None or key>best_key:
+                    best_v, best_key = v, key
+            if best_v is not None:
+                match[u], match[best_v] = best_v, u
+                num_merges += 1
+                if coarse_n_vertices-num_merges<=max_vertices:
+                    break
+        if num_merges==0:
+            break
+        new_ids = [-1]*coarse_n_vertices
+        new_n_vertices = 0
+        for u in range(coarse_n_vertices):
+            if new_ids[u]==-1:
+                new_ids[u] = new_n_vertices
+                if match[u]!=-1:
+                    new_ids[match[u]] = new_n_vertices
+                new_n_vertices += 1
+        new_qubits = [set() for vertex in range(new_n_vertices)]
+        new_weights = [0]*new_n_vertices
+        for u in range(coarse_n_vertices):
+            new_qubits[new_ids[u]] |= cluster_qubits[u]
+            new_weights[new_ids[u]] += cluster_weights[u]
+        clusters = [new_ids[cluster] for cluster in clusters]
+        coarse_edges = [(new_ids[u],new_ids[v]) for u, v in coarse_edges if new_ids[u]!=new_ids[v]]
+        cluster_qubits, cluster_weights, coarse_n_vertices = new_qubits, new_weights, new_n_vertices
+    return clusters, coarse_n_vertices, coarse_edges, cluster_weights
+
+def get_coarse_kwargs(kwargs, max_vertices):
+    '''
+    Cut model arguments on the coarsened gate graph
+    '''
+    clusters, n_vertices, edges, vertex_weights = coarsen_graph(n_vertices=kwargs['n_vertices'],edges=kwargs['edges'],
+    id_vertices=kwargs['id_vertices'],max_subcircuit_qubit=kwargs['max_subcircuit_qubit'],max_vertices=max_vertices)
+    id_vertices = {}
+    for vertex, cluster in enumerate(clusters):
+        if cluster not in id_vertices:
+            id_vertices[cluster] = kwargs['id_vertices'][vertex]
+    coarse_kwargs = dict(kwargs)
+    coarse_kwargs.update(n_vertices=n_vertices,edges=edges,
+    vertex_ids={id_vertices[cluster]:cluster for cluster in id_vertices},id_vertices=id_vertices,
+    vertex_weights=vertex_weights)
+    return clusters, coarse_kwargs
+
+def coarsen_partition(partition, clusters, n_clusters):
+    '''
+    Every cluster takes the subcircuit of most of its vertices
+    '''
+    votes = [{} for cluster in range(n_clusters)]
+    for vertex, subcircuit in enumerate(partition):
+        votes[clusters[vertex]][subcircuit] = votes[clusters[vertex]].get(subcircuit,0)+1
+    return [max(vote,key=vote.get) for vote in votes]
+
+_shared_incumbent = None
+_incumbent_callback = None
+_circuit_ir = None
+def init_cut_worker(shared_incumbent, incumbent_callback=None, circuit_ir=None, incumbent_queue=None):
+    '''
+    incumbent_queue: worker processes put their incumbents on it instead of calling incumbent_callback
+    '''
+    global _shared_incumbent, _incumbent_callback, _circuit_ir
+    _shared_incumbent = shared_incumbent
+    _incumbent_callback = incumbent_queue.put if incumbent_queue is not None else incumbent_callback
+    _circuit_ir = circuit_ir
+
+def search_cuts(solver, kwargs, threads, time_limit, warm_start, incumbent_callback):
+    '''
+    Run one cut model, the Gurobi search is seeded by a short heuristic search if there is no warm start.
+    Returns the solved model, or None
+    '''
+    begin = time.time()
+    if warm_start is None and solver=='gurobi':
+        heuristic_model = Heuristic_Model(**kwargs,time_limit=min(0.1*time_limit,5),num_restarts=1)
+        if heuristic_model.solve(min_postprocessing_cost=_shared_incumbent.value,shared_incumbent=_shared_incumbent):
+            warm_start = heuristic_model.partition
+    cut_model = {'gurobi':MIP_Model,'heuristic':Heuristic_Model}[solver]
+    mip_model = cut_model(**kwargs)
+    feasible = mip_model.solve(min_postprocessing_cost=_shared_incumbent.value,shared_incumbent=_shared_incumbent,threads=threads,
+    time_limit=max(time_limit-(time.time()-begin),0),warm_start=warm_start,incumbent_callback=incumbent_callback)
+    return mip_model if feasible else None
+
+def solve_cut_candidate(solver, kwargs, threads, deadline, cut_cache, cache_key, max_mip_vertices=None):
+    '''
+    Search the cuts for one num_subcircuit, possibly in a worker process.
+    Starts from the cached solution if any.
+    Graphs with more than max_mip_vertices vertices are searched coarsened,
+    then the partition is projected back and refined by Heuristic_Model.
+    If the coarsened graph has no solution, the search retries on a graph twice as fine.
+    Publishes the reconstruction cost of the solution found to the shared incumbent.
+    '''
+    begin = time.time()
+    cached = cut_cache.get(cache_key) if cut_cache is not None else None
+    if cached is not None and cached['optimal']:
+        result = dict(cached)
+        result['runtime'] = time.time()-begin
+    else:
+        time_limit = max(deadline-begin,0) if deadline is not None else 300
+        cached_partition = None
+        if cached is not None:
+            cached_partition = [None]*kwargs['n_vertices']
+            for subcircuit_idx, subcircuit in enumerate(cached['subcircuits']):
+                for vertex_name in subcircuit:
+                    cached_partition[kwargs['vertex_ids'][vertex_name]] = subcircuit_idx
+        max_vertices = max_mip_vertices
+        while max_vertices is not None and kwargs['n_vertices']>max_vertices:
+            clusters, coarse_kwargs = get_coarse_kwargs(kwargs=kwargs,max_vertices=max_vertices)
+            warm_start = None
+            if cached_partition is not None:
+                warm_start = coarsen_partition(partition=cached_partition,clusters=clusters,n_clusters=coarse_kwargs['n_vertices'])
+            coarse_model = search_cuts(solver=solver,kwargs=coarse_kwargs,threads=threads,
+            time_limit=time_limit-(time.time()-begin),warm_start=warm_start,incumbent_callback=None)
+            if coarse_model is not None:
+                cached_partition = [coarse_model.partition[cluster] for cluster in clusters]
+                mip_model = Heuristic_Model(**kwargs,time_limit=max(min(0.1*time_limit,10),1),num_restarts=1)
+                if not mip_model.solve(min_postprocessing_cost=_shared_incumbent.value,shared_incumbent=_shared_incumbent,
+                warm_start=cached_partition,incumbent_callback=_incumbent_callback):
+                    return None
+                break
+            elif time.time()-begin>=time_limit:
+                return None
+            max_vertices *= 2
+        else:
+            mip_model = search_cuts(solver=solver,kwargs=kwargs,threads=threads,
+            time_limit=time_limit-(time.time()-begin),warm_start=cached_partition,incumbent_callback=_incumbent_callback)
+            if mip_model is None:
+                return None
+        result = {'subcircuits':mip_model.subcircuits,
+        'cut_edges':mip_model.cut_edges,
+        'objective':mip_model.objective,
+        'runtime':time.time()-begin,
+        'optimal':mip_model.optimal,
+        'mip_gap':mip_model.mip_gap}
+        if cut_cache is not None and (cached is None or mip_model.objective<=cached['objective']):
+            cut_cache.put(cache_key,result)
+    subcircuits, complete_path_map = subcircuits_parser(subcircuit_gates=result['subcircuits'], circuit_ir=_circuit_ir)
+    O_rho_pairs = get_pairs(complete_path_map=complete_path_map)
+    counter = get_counter(subcircuits=subcircuits, O_rho_pairs=O_rho_pairs)
+    reconstruction_cost = get_reconstruction_cost(counter=counter,build_constants=kwargs['build_constants'])
+    with _shared_incumbent.get_lock():
+        if reconstruction_cost < _shared_incumbent.value:
+            _shared_incumbent.value = reconstruction_cost
+    return result
+
+def find_cuts(circuit, max_subcircuit_qubit, max_cuts, num_subcircuits, verbose, solver='gurobi', num_workers=None,
+time_limit=None, cut_cache=None, incumbent_callback=None, objective='cuts', max_mip_vertices=None, circuit_ir=None, build_constants=None):
+    '''
+    solver: 'gurobi' solves the MIP model, 'heuristic' runs the Gurobi-free Heuristic_Model
+    num_workers: number of processes searching different num_subcircuit concurrently.
+    Defaults to one process per candidate, up to the number of CPUs.
+    The best reconstruction cost found so far is shared, and dominated searches terminate early.
+    time_limit: wall-clock budget of the whole search in seconds.
+    The best solutions found within the budget are returned. Defaults to 300 s per num_subcircuit.
+    cut_cache: optional ResultCache of solutions, keyed by (circuit, max_subcircuit_qubit, max_cuts, num_subcircuit).
+    Cached optimal solutions are reused, others warm start the search.
+    incumbent_callback: called with a dict of every improving solution as it appears.
+    It runs in a thread of the calling process, the worker processes send their incumbents through a queue.
+    objective: 'cuts' minimizes the number of cuts.
+    'cost' minimizes the build time estimated from build_constants, see build_kernel.calibrate_build_constants,
+    and solutions are ranked by the estimated build time instead of cost_estimate.
+    The heuristic solver still minimizes cuts, only the ranking changes.
+    max_mip_vertices: coarsen gate graphs with more vertices down to max_mip_vertices before the search,
+    see coarsen_graph. The solutions found are not guaranteed optimal.
+    circuit_ir: CircuitIR of the circuit, built if not given
+    '''
+    if solver not in ['gurobi','heuristic']:
+        raise ValueError('Illegal solver = %s'%solver)
+    if objective=='cuts':
+        build_constants = None
+    elif objective=='cost':
+        if build_constants is None:
+            raise ValueError('objective = cost requires the build_constants of this host')
+    else:
+        raise ValueError('Illegal objective = %s'%objective)
+    if circuit_ir is None:
+        circuit_ir = CircuitIR(circuit=circuit)
+    n_vertices, edges, vertex_ids, id_vertices = circuit_ir.get_gate_graph()
     num_qubits = circuit.num_qubits
     cut_solution = {}
     min_postprocessing_cost = float('inf')
     
+    candidates = []
     for num_subcircuit in num_subcircuits:
         if num_subcircuit*max_subcircuit_qubit-(num_subcircuit-1)<num_qubits \
             or num_subcircuit>num_qubits \
@@ -426,6 +987,17 @@ def find_cuts(circuit, max_subcircuit_qubit, max_cuts, num_subcircuits, verbose)
                 print('%d-qubit circuit, %d subcircuits, max size %d, max cuts %d: IMPOSSIBLE'%(
                     num_qubits,num_subcircuit,max_subcircuit_qubit,max_cuts))
             continue
+        candidates.append(num_subcircuit)
+    if len(candidates)==0:
+        return cut_solution
+    deadline = time.time()+time_limit if time_limit is not None else None
+    fingerprint = circuit_fingerprint(circuit) if cut_cache is not None else None
+
+    if num_workers is None:
+        num_workers = min(len(candidates),mp.cpu_count())
+    threads = max(1,mp.cpu_count()//num_workers) if num_workers>1 else None
+    jobs = []
+    for num_subcircuit in candidates:
         kwargs = dict(n_vertices=n_vertices,
                     edges=edges,
                     vertex_ids=vertex_ids,
@@ -433,37 +1005,75 @@ def find_cuts(circuit, max_subcircuit_qubit, max_cuts, num_subcircuits, verbose)
                     num_subcircuit=num_subcircuit,
                     max_subcircuit_qubit=max_subcircuit_qubit,
                     num_qubits=num_qubits,
-                    max_cuts=max_cuts)
+                    max_cuts=max_cuts,
+                    build_constants=build_constants)
+        cache_key = get_cut_cache_key(cut_cache=cut_cache,fingerprint=fingerprint,
+        max_subcircuit_qubit=max_subcircuit_qubit,max_cuts=max_cuts,num_subcircuit=num_subcircuit,objective=objective) if cut_cache is not None else None
+        jobs.append((solver,kwargs,threads,deadline,cut_cache,cache_key,max_mip_vertices))
+    shared_incumbent = mp.Value('d',float('inf'))
+    if num_workers>1 and incumbent_callback is not None:
+        # Only the incumbent reports need a thread
+        import threading
+        with mp.Manager() as manager:
+            incumbent_queue = manager.Queue()
+            callback_errors = []
+            def report_incumbents():
+                while True:
+                    incumbent = incumbent_queue.get()
+                    if incumbent is None:
+                        break
+                    try:
+                        incumbent_callback(incumbent)
+                    except Exception as error:
+                        callback_errors.append(error)
+            report_thread = threading.Thread(target=report_incumbents)
+            report_thread.start()
+            try:
+                with mp.Pool(processes=num_workers,initializer=init_cut_worker,initargs=(shared_incumbent,None,circuit_ir,incumbent_queue)) as pool:
+                    results = pool.starmap(solve_cut_candidate,jobs)
+            finally:
+                incumbent_queue.put(None)
+                report_thread.join()
+            if len(callback_errors)>0:
+                raise callback_errors[0]
+    elif num_workers>1:
+        with mp.Pool(processes=num_workers,initializer=init_cut_worker,initargs=(shared_incumbent,None,circuit_ir)) as pool:
+            results = pool.starmap(solve_cut_candidate,jobs)
+    else:
+        init_cut_worker(shared_incumbent,incumbent_callback,circuit_ir)
+        results = [solve_cut_candidate(*job) for job in jobs]
 
-        mip_model = MIP_Model(**kwargs)
-        feasible = mip_model.solve(min_postprocessing_cost)
-        if not feasible:
+    for num_subcircuit, result in zip(candidates,results):
+        if result is None:
             if verbose:
                 print('%d-qubit circuit, %d subcircuits, max size %d, max cuts %d: NO SOLUTIONS'%(
                     num_qubits,num_subcircuit,max_subcircuit_qubit,max_cuts))
             continue
         else:
-            min_objective = mip_model.objective
-            positions = cuts_parser(mip_model.cut_edges, circuit)
-            subcircuits, complete_path_map = subcircuits_parser(subcircuit_gates=mip_model.subcircuits, circuit=circuit)
+            positions = cuts_parser(result['cut_edges'], circuit_ir)
+            subcircuits, complete_path_map = subcircuits_parser(subcircuit_gates=result['subcircuits'], circuit_ir=circuit_ir)
             O_rho_pairs = get_pairs(complete_path_map=complete_path_map)
             counter = get_counter(subcircuits=subcircuits, O_rho_pairs=O_rho_pairs)
 
-            reconstruction_cost = cost_estimate(counter=counter)
+            reconstruction_cost = get_reconstruction_cost(counter=counter,build_constants=build_constants)
             if verbose:
                 print('-'*20)
                 print_cutter_result(num_subcircuit=num_subcircuit,
-                num_cuts=len(mip_model.cut_edges),
+                num_cuts=len(result['cut_edges']),
                 subcircuits=subcircuits,
-                counter=counter, reconstruction_cost=reconstruction_cost)
+                counter=counter, reconstruction_cost=cost_estimate(counter=counter))
+                if build_constants is not None:
+                    print('Estimated build time = %.3e s'%reconstruction_cost)
 
-                print('Model objective value = %.2e'%(mip_model.objective))
-                print('MIP runtime:', mip_model.runtime)
+                print('Model objective value = %.2e'%(result['objective']))
+                print('%s runtime:'%('MIP' if solver=='gurobi' else 'Heuristic'), result['runtime'])
 
-                if (mip_model.optimal):
-                    print('OPTIMAL, MIP gap =',mip_model.mip_gap)
+                if (result['optimal']):
+                    print('OPTIMAL, MIP gap =',result['mip_gap'])
+                elif solver=='gurobi':
+                    print('NOT OPTIMAL, MIP gap =',result['mip_gap'])
                 else:
-                    print('NOT OPTIMAL, MIP gap =',mip_model.mip_gap)
+                    print('HEURISTIC, no optimality guarantee')
                 print('-'*20)
 
             if reconstruction_cost < min_postprocessing_cost:
@@ -477,9 +1087,10 @@ def find_cuts(circuit, max_subcircuit_qubit, max_cuts, num_subcircuits, verbose)
                 'counter':counter}
     return cut_solution
 
-def cut_circuit(circuit, subcircuit_vertices, verbose):
-    stripped_circ = circuit_stripping(circuit=circuit)
-    n_vertices, edges, vertex_ids, id_vertices = read_circ(circuit=stripped_circ)
+def cut_circuit(circuit, subcircuit_vertices, verbose, circuit_ir=None):
+    if circuit_ir is None:
+        circuit_ir = CircuitIR(circuit=circuit)
+    n_vertices, edges, vertex_ids, id_vertices = circuit_ir.get_gate_graph()
 
     subcircuits = []
     for vertices in subcircuit_vertices:
@@ -489,8 +1100,14 @@ def cut_circuit(circuit, subcircuit_vertices, verbose):
         subcircuits.append(subcircuit)
     if sum([len(subcircuit) for subcircuit in subcircuits])!=n_vertices:
         raise ValueError('Not all gates are assigned into subcircuits')
+    vertex_subcircuits = {}
+    for subcircuit_idx, vertices in enumerate(subcircuit_vertices):
+        for vertex in vertices:
+            vertex_subcircuits[vertex] = subcircuit_idx
+    cut_edges = [(id_vertices[u],id_vertices[v]) for u, v in edges if vertex_subcircuits[u]!=vertex_subcircuits[v]]
+    positions = cuts_parser(cut_edges, circuit_ir)
 
-    subcircuits, complete_path_map = subcircuits_parser(subcircuit_gates=subcircuits, circuit=circuit)
+    subcircuits, complete_path_map = subcircuits_parser(subcircuit_gates=subcircuits, circuit_ir=circuit_ir)
     O_rho_pairs = get_pairs(complete_path_map=complete_path_map)
     counter = get_counter(subcircuits=subcircuits, O_rho_pairs=O_rho_pairs)
     reconstruction_cost = cost_estimate(counter=counter)
@@ -509,6 +1126,7 @@ def cut_circuit(circuit, subcircuit_vertices, verbose):
         'max_subcircuit_qubit':max_subcircuit_qubit,
         'subcircuits':subcircuits,
         'complete_path_map':complete_path_map,
+        'positions':positions,
         'counter':counter}
     return cut_solution
 
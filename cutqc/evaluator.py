@@ -1,4 +1,4 @@
-import itertools, copy, random
+import itertools, copy, random, hashlib
 import numpy as np
 from time import time
 from qiskit.converters import circuit_to_dag, dag_to_circuit
@@ -6,6 +6,8 @@ from qiskit.circuit.library.standard_gates import HGate, SGate, SdgGate, XGate
 
 from qiskit_helper_functions.non_ibmq_functions import read_dict, find_process_jobs, evaluate_circ
 
+from cutqc.helper_fun import circuit_fingerprint
+
 def generate_subcircuit_instances(subcircuits,complete_path_map):
     '''
     Generate subcircuit instances with different init, meas
@@ -15,11 +17,18 @@ def generate_subcircuit_instances(subcircuits,complete_path_map):
     subcircuit_instances = {}
     subcircuit_instances_idx = {}
     for subcircuit_idx, subcircuit in enumerate(subcircuits):
-        O_qubits, rho_qubits = find_subcircuit_O_rho_qubits(complete_path_map=complete_path_map,subcircuit_idx=subcircuit_idx)
-        combinations = find_init_meas_combinations(O_qubits=O_qubits, rho_qubits=rho_qubits, qubits=subcircuit.qubits)
-        subcircuit_instances[subcircuit_idx], subcircuit_instances_idx[subcircuit_idx] = get_one_subcircuit_instances(subcircuit=subcircuit, combinations=combinations)
+        subcircuit_instances[subcircuit_idx], subcircuit_instances_idx[subcircuit_idx] = generate_one_subcircuit_instances(
+            subcircuit=subcircuit,subcircuit_idx=subcircuit_idx,complete_path_map=complete_path_map)
     return subcircuit_instances, subcircuit_instances_idx
 
+def generate_one_subcircuit_instances(subcircuit,subcircuit_idx,complete_path_map):
+    '''
+    Instances of one subcircuit, numbered the same way for any binding of its parameters
+    '''
+    O_qubits, rho_qubits = find_subcircuit_O_rho_qubits(complete_path_map=complete_path_map,subcircuit_idx=subcircuit_idx)
+    combinations = find_init_meas_combinations(O_qubits=O_qubits, rho_qubits=rho_qubits, qubits=subcircuit.qubits)
+    return get_one_subcircuit_instances(subcircuit=subcircuit, combinations=combinations)
+
 def find_subcircuit_O_rho_qubits(complete_path_map,subcircuit_idx):
     '''
     Find the O and Rho qubits of a subcircuit
@@ -142,14 +151,16 @@ def get_one_subcircuit_instances(subcircuit, combinations):
             subcircuit_instances_idx[(tuple(inits),tuple(meas))] = subcircuit_instance_idx
     return subcircuit_instances, subcircuit_instances_idx
 
-def simulate_subcircuit(key,subcircuit_info,eval_mode):
+def simulate_subcircuit(subcircuit_info,eval_mode,result_cache=None,seed=None):
     '''
-    Simulate a subcircuit
-    Returns measured_prob (list)
+    Simulate a subcircuit instance once and measure it in all the requested bases
+    Returns subcircuit_results[meas] = measured_prob (list)
     (int state, probability weightage)
+    Results are looked up in and saved to result_cache if one is given,
+    except unseeded qasm results, which are random and always sampled afresh
+    seed: makes the qasm samples reproducible, see get_qasm_prob
     '''
     tol = 1e-12
-    circuit_name, subcircuit_idx, parent_subcircuit_instance_idx = key
     subcircuit = subcircuit_info['circuit']
     shots = subcircuit_info['shots']
     init = subcircuit_info['init']
@@ -162,19 +173,45 @@ def simulate_subcircuit(key,subcircuit_info,eval_mode):
         uniform_p = 1/2**num_effective_qubits
         for m in meas:
             measured_prob = uniform_p
-            subcircuit_results[(subcircuit_idx,init,m)] = measured_prob
+            subcircuit_results[m] = measured_prob
     else:
+        if eval_mode=='qasm' and seed is None:
+            result_cache = None
+        if result_cache is not None or seed is not None:
+            fingerprint = subcircuit_info['fingerprint'] if 'fingerprint' in subcircuit_info else circuit_fingerprint(subcircuit)
+        if result_cache is not None:
+            cache_key = result_cache.get_key(fingerprint=fingerprint,init=init,meas=meas,eval_mode=eval_mode,shots=shots)
+            cached_results = result_cache.get(cache_key)
+            if cached_results is not None:
+                for m in meas:
+                    subcircuit_results[m] = cached_results[m]
+                return subcircuit_results
         if eval_mode=='sv':
             subcircuit_inst_prob = evaluate_circ(circuit=subcircuit,backend='statevector_simulator')
-        elif eval_mode=='qasm':
+        elif eval_mode=='qasm' and seed is None:
             subcircuit_inst_prob = evaluate_circ(circuit=subcircuit,backend='noiseless_qasm_simulator',options={'num_shots':shots})
+        elif eval_mode=='qasm':
+            subcircuit_inst_prob = get_qasm_prob(circuit=subcircuit,shots=shots,seed=seed,fingerprint=fingerprint)
         else:
             raise NotImplementedError
         for m in meas:
             measured_prob = measure_prob(unmeasured_prob=subcircuit_inst_prob,meas=m)
             measured_prob[abs(measured_prob) < tol] = 0.0
-            subcircuit_results[(subcircuit_idx,init,m)] = measured_prob
-    return circuit_name, subcircuit_results
+            subcircuit_results[m] = measured_prob
+        if result_cache is not None:
+            result_cache.put(cache_key,subcircuit_results)
+    return subcircuit_results
+
+def get_qasm_prob(circuit,shots,seed,fingerprint):
+    '''
+    Noiseless qasm probabilities of shots samples drawn from the statevector distribution
+    Every subcircuit instance samples its own stream, derived from seed and its fingerprint,
+    so the samples are the same for the same seed and independent across instances.
+    '''
+    prob = np.asarray(evaluate_circ(circuit=circuit,backend='statevector_simulator'),dtype=np.float64)
+    instance_seed = int(hashlib.sha256(repr((seed,fingerprint,shots)).encode()).hexdigest()[:16],16)
+    rng = np.random.default_rng(instance_seed)
+    return rng.multinomial(shots,prob/prob.sum())/shots
 
 def measure_prob(unmeasured_prob,meas):
     if meas.count('comp')==len(meas):
@@ -1,22 +1,27 @@
-import os
+import os, hashlib, glob
 from qiskit.converters import circuit_to_dag
 import numpy as np
 
-def check_valid(circuit):
+def check_valid(circuit, circuit_ir=None):
     '''
     If the input circuit is not fully connected, it does not need CutQC to be split into smaller circuits.
     CutQC hence only cuts a circuit if it is fully connected.
     Furthermore, CutQC only supports 2-qubit gates.
+    circuit_ir: CircuitIR of the circuit, avoids another DAG conversion
     '''
     if circuit.num_unitary_factors()!=1:
         raise ValueError('Input circuit is not fully connected thus does not need cutting. Number of unitary factors = %d'%circuit.num_unitary_factors())
     if circuit.num_clbits>0:
         raise ValueError('Please remove classical bits from the circuit before cutting')
-    dag = circuit_to_dag(circuit)
-    for op_node in dag.topological_op_nodes():
-        if len(op_node.qargs)>2:
+    if circuit_ir is None:
+        dag = circuit_to_dag(circuit)
+        ops = [(len(op_node.qargs),op_node.op.name) for op_node in dag.topological_op_nodes()]
+    else:
+        ops = zip([len(op_qubits) for op_qubits in circuit_ir.op_qubits],circuit_ir.op_names)
+    for num_qargs, op_name in ops:
+        if num_qargs>2:
             raise ValueError('CutQC currently does not support >2-qubit gates')
-        if op_node.op.name=='barrier':
+        if op_name=='barrier':
             raise ValueError('Please remove barriers from the circuit before cutting')
 
 def get_dirname(circuit_name,max_subcircuit_qubit,eval_mode,num_threads,mem_limit,field):
@@ -29,6 +34,8 @@ def get_dirname(circuit_name,max_subcircuit_qubit,eval_mode,num_threads,mem_limi
         dirname = './cutqc_data/%s/qc_%d/%s'%(circuit_name,max_subcircuit_qubit,eval_mode)
     elif field=='build':
         dirname = './cutqc_data/%s/qc_%d/%s_%d_%d'%(circuit_name,max_subcircuit_qubit,eval_mode,mem_limit,num_threads)
+    elif field=='results':
+        dirname = './cutqc_data/%s/subcircuit_results'%(circuit_name)
     elif field=='slurm':
         dirname = './slurm/%s/qc_%d'%(circuit_name,max_subcircuit_qubit)
     elif field=='runtime':
@@ -46,4 +53,64 @@ def read_prob_from_txt(filename):
         prob = np.array(prob,dtype=float)
     else:
         prob = np.array([])
-    return prob
\ No newline at end of file
+    return prob
+
+def save_arrays(folder,name,arrays):
+    '''
+    Save a dict of NumPy arrays as folder/name.key.npy files
+    '''
+    for key in arrays:
+        np.save('%s/%s.%s.npy'%(folder,name,key),arrays[key])
+
+def load_arrays(folder,name,mmap_mode='r'):
+    '''
+    Load the dict of NumPy arrays saved by save_arrays.
+    Arrays are memory-mapped by default.
+    '''
+    arrays = {}
+    for filename in glob.glob('%s/%s.*.npy'%(glob.escape(folder),glob.escape(name))):
+        key = os.path.basename(filename)[len(name)+1:-len('.npy')]
+        arrays[key] = np.load(filename,mmap_mode=mmap_mode)
+    if len(arrays)==0:
+        raise FileNotFoundError('No arrays named %s in %s'%(name,folder))
+    return arrays
+
+def circuit_fingerprint(circuit):
+    '''
+    Canonical hash of the gates in a circuit.
+    Gates are identified by name, parameters and qubit positions,
+    so structurally identical circuits share a fingerprint regardless of register names or labels.
+    '''
+    qubit_indices = {qubit:qubit_idx for qubit_idx, qubit in enumerate(circuit.qubits)}
+    hasher = hashlib.sha256()
+    hasher.update(b'%d;'%circuit.num_qubits)
+    for instruction, qargs, _ in circuit.data:
+        hasher.update(instruction.name.encode())
+        for param in instruction.params:
+            if isinstance(param,np.ndarray):
+                hasher.update(np.ascontiguousarray(param).tobytes())
+            else:
+                hasher.update(repr(param).encode())
+            hasher.update(b',')
+        hasher.update(repr([qubit_indices[qarg] for qarg in qargs]).encode())
+        hasher.update(b';')
+    return hasher.hexdigest()
+
+def get_stage_fingerprint(*inputs):
+    '''
+    Hash of the inputs of a pipeline stage.
+    A stage is skipped on resume if its folder recorded the same fingerprint on completion.
+    '''
+    return hashlib.sha256(repr(inputs).encode()).hexdigest()
+
+def get_build_options(build_options=None):
+    '''
+    Build options of CutQC.evaluate, with the defaults of the options not given
+    '''
+    options = {'keep_raw_order':False,'checkpoint_interval':None,'tolerance':None,'pipeline':False}
+    if build_options is not None:
+        unknown_options = sorted(set(build_options)-set(options))
+        if len(unknown_options)>0:
+            raise ValueError('Unknown build options %s, expecting %s'%(unknown_options,sorted(options)))
+        options.update(build_options)
+    return options
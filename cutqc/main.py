@@ -1,4 +1,4 @@
-import os, subprocess, pickle, glob, random, time
+import os, subprocess, pickle, glob, random, time, threading
 import numpy as np
 import multiprocessing as mp
 from datetime import datetime
@@ -7,19 +7,25 @@ from tqdm import tqdm
 from qiskit_helper_functions.non_ibmq_functions import evaluate_circ, read_dict, find_process_jobs
 from qiskit_helper_functions.schedule import Scheduler
 
-from cutqc.helper_fun import check_valid, get_dirname
+from cutqc.helper_fun import check_valid, get_dirname, circuit_fingerprint, get_stage_fingerprint, get_build_options
+from cutqc.artifact_store import ArtifactStore, get_cut_solution_metadata
+from cutqc.cache import ResultCache, MemoryResultCache
 from cutqc.cutter import find_cuts, cut_circuit
-from cutqc.evaluator import generate_subcircuit_instances, simulate_subcircuit
-from cutqc.sampling import dummy_sample, get_subcircuit_instances_sampled, get_subcircuit_entries_sampled
-from cutqc.post_process import generate_summation_terms
-from cutqc.verify import verify
+from cutqc.circuit_ir import CircuitIR
+from cutqc.evaluator import generate_subcircuit_instances, generate_one_subcircuit_instances, simulate_subcircuit
+from cutqc.sampling import dummy_sample, get_subcircuit_instances_sampled, get_subcircuit_entries_sampled, sample_bitstrings
+from cutqc.post_process import SummationTerms, SummationTermRows, generate_summation_terms, get_csr_row, get_summation_term_magnitudes, get_entry_matrix
+from cutqc.verify import verify, get_subcircuit_out_qubits, get_subcircuit_output_qubits, get_marginal
+from cutqc.build_kernel import build_terms, sum_outputs, calibrate_build_constants
+from cutqc.pipeline import attribute_shots, run_pipeline
+from cutqc.query import get_reconstruction_terms, find_top_states, get_expectations, raw_to_circuit_states, raw_to_circuit_prob, build_prob
 
 class CutQC:
     '''
     The main module for CutQC
     cut --> evaluate results --> verify (optional)
     '''
-    def __init__(self, circuit_name, circuit, verbose):
+    def __init__(self, circuit_name, circuit, verbose, persist=True):
         '''
         Args:
         circuit: the input quantum circuit
@@ -27,15 +33,71 @@ class CutQC:
         verbose: setting verbose to True to turn on logging information.
         Useful to visualize what happens,
         but may produce very long outputs for complicated circuits.
+        persist: save the results of every stage to ./cutqc_data.
+        Set to False to pass them between stages in memory only and build with NumPy instead of the C build.
+        The folders returned by cut and evaluate then only name the results held by this CutQC.
         '''
-        check_valid(circuit=circuit)
+        self.circuit_ir = CircuitIR(circuit=circuit)
+        check_valid(circuit=circuit,circuit_ir=self.circuit_ir)
         self.circuit_name = circuit_name
         self.circuit = circuit
         self.verbose = verbose
+        self.persist = persist
+        self.memory_cache = None
+        # artifacts[(folder, name)] = stage results held in memory
+        self.artifacts = {}
+        # stores[folder] = ArtifactStore of the folder, with persist
+        self.stores = {}
+
+    def _get_store(self, folder):
+        if folder not in self.stores:
+            self.stores[folder] = ArtifactStore(folder=folder)
+        return self.stores[folder]
+
+    def _reset_folder(self, folder):
+        for key in [key for key in self.artifacts if key[0]==folder]:
+            del self.artifacts[key]
+        if self.persist:
+            self._get_store(folder).reset()
+
+    def _save(self, folder, name, value, metadata=None, memoize=True):
+        '''
+        Save a stage result to the ArtifactStore of the folder
+        metadata: recorded in the manifest of the store
+        memoize: also keep it in memory. Always the case without persist.
+        '''
+        if memoize or not self.persist:
+            self.artifacts[(folder,name)] = value
+        if self.persist:
+            self._get_store(folder).put(name=name,value=value,metadata=metadata)
+
+    def _load(self, folder, name, memoize=True):
+        if (folder,name) in self.artifacts:
+            return self.artifacts[(folder,name)]
+        if not self.persist:
+            raise FileNotFoundError('No %s in memory for %s'%(name,folder))
+        value = self._get_store(folder).get(name=name)
+        if memoize:
+            self.artifacts[(folder,name)] = value
+        return value
+
+    def _get_stage_fingerprint(self, folder, stage):
+        '''
+        Fingerprint recorded by a completed stage in its folder, None if it did not complete
+        '''
+        try:
+            return self._load(folder=folder,name='stage_%s'%stage)['fingerprint']
+        except FileNotFoundError:
+            return None
+
+    def _set_stage_fingerprint(self, folder, stage, fingerprint):
+        if fingerprint is not None:
+            self._save(folder=folder,name='stage_%s'%stage,value={'fingerprint':fingerprint})
     
     def cut(self,
     max_subcircuit_qubit=None, max_cuts=None, num_subcircuits=None,
-    subcircuit_vertices=None):
+    subcircuit_vertices=None, solver='gurobi', num_workers=None,
+    time_limit=None, cut_cache_dir=None, cut_cache_size=1, incumbent_callback=None, objective='cuts', max_mip_vertices=None, resume=False):
         '''
         Cut the given circuit
 
@@ -43,9 +105,19 @@ class CutQC:
         max_subcircuit_qubit: max number of qubits in each subcircuit
         max_cuts: max number of cuts allowed
         num_subcircuits: list of subcircuits to try, CutQC returns the best solution found among trials
+        solver: 'gurobi' for the MIP solver, 'heuristic' for the Gurobi-free heuristic searcher
+        num_workers: number of processes solving different num_subcircuits concurrently, defaults to one per candidate
+        time_limit: wall-clock budget of the cut search in seconds, the best cuts found in time are used
+        cut_cache_dir: optional directory caching cut solutions across runs on the same circuit
+        cut_cache_size: max size of the cut cache in GB, least recently used solutions are evicted beyond it
+        incumbent_callback: called with every improving cut solution found during the search
+        objective: 'cuts' to minimize the number of cuts, 'cost' to minimize the build time estimated on this host
+        max_mip_vertices: coarsen larger gate graphs to this many vertices before the search, for large circuits
 
         Else supply subcircuit_vertices manually
         Note that subcircuit_vertices override all other arguments
+
+        resume: reuse the cut solution and subcircuits of an earlier cut with the same circuit and arguments
         '''
         if self.verbose:
             print('*'*20,'Cut','*'*20)
@@ -55,68 +127,361 @@ class CutQC:
                 self.circuit.depth(),
                 self.circuit.size()))
         
+        fingerprint = get_stage_fingerprint(circuit_fingerprint(self.circuit),self.circuit_name,
+        max_subcircuit_qubit,max_cuts,num_subcircuits,subcircuit_vertices,solver,time_limit,objective,max_mip_vertices)
         if subcircuit_vertices is None:
             if max_subcircuit_qubit is None or max_cuts is None or num_subcircuits is None:
                 raise AttributeError('Check the specifications requirement of the automatic MIP cut searcher!')
+            source_folder = get_dirname(circuit_name=self.circuit_name,max_subcircuit_qubit=max_subcircuit_qubit,
+            eval_mode=None,num_threads=None,mem_limit=None,field='cutter')
+            if resume and self._get_stage_fingerprint(folder=source_folder,stage='cut')==fingerprint:
+                if self.verbose:
+                    print('--> Resume %s from the earlier cut'%source_folder,flush=True)
+                return source_folder
             cut_solution = find_cuts(circuit=self.circuit,
             max_subcircuit_qubit=max_subcircuit_qubit,
             max_cuts=max_cuts,
             num_subcircuits=num_subcircuits,
-            verbose=self.verbose)
+            verbose=self.verbose,
+            solver=solver,
+            num_workers=num_workers,
+            time_limit=time_limit,
+            cut_cache=ResultCache(cache_dir=cut_cache_dir,max_size=cut_cache_size) if cut_cache_dir is not None else None,
+            incumbent_callback=incumbent_callback,
+            objective=objective,
+            build_constants=calibrate_build_constants() if objective=='cost' else None,
+            max_mip_vertices=max_mip_vertices,
+            circuit_ir=self.circuit_ir)
         else:
-            cut_solution = cut_circuit(circuit=self.circuit,subcircuit_vertices=subcircuit_vertices,verbose=self.verbose)
+            cut_solution = cut_circuit(circuit=self.circuit,subcircuit_vertices=subcircuit_vertices,verbose=self.verbose,circuit_ir=self.circuit_ir)
 
         if len(cut_solution) > 0:
             source_folder = get_dirname(circuit_name=self.circuit_name,max_subcircuit_qubit=cut_solution['max_subcircuit_qubit'],
             eval_mode=None,num_threads=None,mem_limit=None,field='cutter')
-            if os.path.exists(source_folder):
-                subprocess.run(['rm','-r',source_folder])
-            os.makedirs(source_folder)
+            if resume and self._get_stage_fingerprint(folder=source_folder,stage='cut')==fingerprint:
+                if self.verbose:
+                    print('--> Resume %s from the earlier cut'%source_folder,flush=True)
+                return source_folder
+            self._reset_folder(folder=source_folder)
             cut_solution['circuit_name'] = self.circuit_name
-            pickle.dump(cut_solution, open('%s/cut_solution.pckl'%(source_folder),'wb'))
+            self._save(folder=source_folder,name='cut_solution',value=cut_solution,metadata=get_cut_solution_metadata(cut_solution=cut_solution))
             self._generate_subcircuits(source_folder=source_folder,cut_solution=cut_solution)
+            self._set_stage_fingerprint(folder=source_folder,stage='cut',fingerprint=fingerprint)
             return source_folder
         else:
             return None
     
-    def evaluate(self,source_folders,eval_mode,mem_limit,num_nodes,num_threads,ibmq):
+    def rebind(self, source_folder, parameter_values, cache_size=10):
+        '''
+        Bind new parameter values to a cut parameterized circuit, for variational loops
+        Cut the parameterized template circuit once, then rebind and evaluate at every parameter update.
+        The cut solution, summation terms and subcircuit entries are kept.
+        Only the instances of the subcircuits whose gates changed are regenerated,
+        and evaluate re-simulates only those, reading the others from an in-memory result cache of cache_size GB.
+
+        parameter_values: {Parameter: value}, or values in the order of circuit.parameters
+        Returns the indices of the subcircuits that changed
+        '''
+        if not isinstance(parameter_values,dict):
+            parameter_values = dict(zip(self.circuit.parameters,parameter_values))
+        cut_solution = self._load(folder=source_folder,name='cut_solution')
+        if 'template_subcircuits' not in cut_solution:
+            cut_solution['template_circuit'] = cut_solution['circuit']
+            cut_solution['template_subcircuits'] = list(cut_solution['subcircuits'])
+            cut_solution['subcircuit_fingerprints'] = [None for subcircuit in cut_solution['subcircuits']]
+            cut_solution['template_stage_fingerprint'] = self._get_stage_fingerprint(folder=source_folder,stage='cut')
+        template_circuit = cut_solution['template_circuit']
+        missing_parameters = [parameter for parameter in template_circuit.parameters if parameter not in parameter_values]
+        if len(missing_parameters)>0:
+            raise ValueError('Missing values of parameters %s'%missing_parameters)
+        cut_solution['circuit'] = template_circuit.assign_parameters({parameter:parameter_values[parameter] for parameter in template_circuit.parameters})
+
+        subcircuit_instances = self._load(folder=source_folder,name='subcircuit_instances')
+        changed_subcircuits = []
+        for subcircuit_idx, template_subcircuit in enumerate(cut_solution['template_subcircuits']):
+            subcircuit = template_subcircuit.assign_parameters({parameter:parameter_values[parameter] for parameter in template_subcircuit.parameters})
+            fingerprint = circuit_fingerprint(subcircuit)
+            if fingerprint==cut_solution['subcircuit_fingerprints'][subcircuit_idx]:
+                continue
+            changed_subcircuits.append(subcircuit_idx)
+            cut_solution['subcircuits'][subcircuit_idx] = subcircuit
+            cut_solution['subcircuit_fingerprints'][subcircuit_idx] = fingerprint
+            subcircuit_instances[subcircuit_idx], _ = generate_one_subcircuit_instances(subcircuit=subcircuit,
+            subcircuit_idx=subcircuit_idx,complete_path_map=cut_solution['complete_path_map'])
+        self._save(folder=source_folder,name='cut_solution',value=cut_solution,metadata=get_cut_solution_metadata(cut_solution=cut_solution))
+        self._save(folder=source_folder,name='subcircuit_instances',value=subcircuit_instances)
+        if cut_solution['template_stage_fingerprint'] is not None:
+            # Later stages resume only for the same binding
+            self._set_stage_fingerprint(folder=source_folder,stage='cut',
+            fingerprint=get_stage_fingerprint(cut_solution['template_stage_fingerprint'],cut_solution['subcircuit_fingerprints']))
+        if self.memory_cache is None:
+            self.memory_cache = MemoryResultCache(max_size=cache_size)
+        if self.verbose:
+            print('--> Rebind %s: subcircuits %s changed'%(source_folder,changed_subcircuits),flush=True)
+        return changed_subcircuits
+
+    def sweep(self, source_folder, parameter_bindings, eval_mode='sv', observables=None, output_qubits=None, cache_size=10):
+        '''
+        Evaluate a cut parameterized circuit at many parameter bindings, sharing one cut and one summation term structure
+        Nothing is written to disk. Subcircuit instances are simulated once per distinct binding of each subcircuit,
+        attributed with one matrix product per subcircuit and built with NumPy.
+
+        parameter_bindings: (#bindings, #parameters) values in the order of circuit.parameters, or a list of {Parameter: value}
+        observables: return expectation values of these diagonal observables instead of probabilities, see expectation
+        output_qubits: circuit qubit indices to keep, see evaluate
+        Returns a (#bindings, 2^#output qubits) array of probabilities in the circuit qubit order,
+        or a (#bindings, #observables) array of expectation values
+        '''
+        cut_solution = self._load(folder=source_folder,name='cut_solution')
+        template_circuit = cut_solution.get('template_circuit',cut_solution['circuit'])
+        template_subcircuits = cut_solution.get('template_subcircuits',cut_solution['subcircuits'])
+        complete_path_map = cut_solution['complete_path_map']
+        summation_terms = self._load_summation_terms(source_folder=source_folder)
+        smart_order = summation_terms.smart_order
+        subcircuit_instances_idx = self._load(folder=source_folder,name='subcircuit_instances_idx')
+        entry_matrices = {subcircuit_idx:get_entry_matrix(csr=self._load(folder=source_folder,name='subcircuit_entries_%d'%subcircuit_idx),
+        num_instances=len(subcircuit_instances_idx[subcircuit_idx])) for subcircuit_idx in smart_order}
+        subcircuit_out_qubits = get_subcircuit_output_qubits(full_circuit=template_circuit,complete_path_map=complete_path_map,subcircuits=template_subcircuits)
+        if output_qubits is not None:
+            output_qubits = sorted(set(output_qubits))
+        subcircuit_qubits = [[qubit for qubit in subcircuit_out_qubits[subcircuit_idx] if output_qubits is None or qubit in output_qubits]
+        for subcircuit_idx in smart_order]
+        reconstruction_terms = {'smart_order':smart_order,'term_rows':SummationTermRows(summation_terms=summation_terms),
+        'weights':np.full(len(summation_terms),0.5**len(cut_solution['positions'])),
+        'qubit_order':sum(subcircuit_qubits,[]),'subcircuit_qubits':subcircuit_qubits}
+
+        result_cache = MemoryResultCache(max_size=cache_size)
+        # entry_probs_memo[subcircuit_idx][fingerprint] = entry probabilities of one binding of the subcircuit
+        entry_probs_memo = {subcircuit_idx:{} for subcircuit_idx in smart_order}
+        results = []
+        begin = time.time()
+        for parameter_values in parameter_bindings:
+            if not isinstance(parameter_values,dict):
+                parameter_values = dict(zip(template_circuit.parameters,parameter_values))
+            reconstruction_terms['entry_probs'] = []
+            for subcircuit_idx in smart_order:
+                template_subcircuit = template_subcircuits[subcircuit_idx]
+                subcircuit = template_subcircuit.assign_parameters({parameter:parameter_values[parameter] for parameter in template_subcircuit.parameters})
+                fingerprint = circuit_fingerprint(subcircuit)
+                if fingerprint not in entry_probs_memo[subcircuit_idx]:
+                    subcircuit_instances, _ = generate_one_subcircuit_instances(subcircuit=subcircuit,subcircuit_idx=subcircuit_idx,complete_path_map=complete_path_map)
+                    instance_probs = [None for subcircuit_instance_idx in subcircuit_instances]
+                    parent_meas = {}
+                    for subcircuit_instance_idx in subcircuit_instances:
+                        parent_meas.setdefault(subcircuit_instances[subcircuit_instance_idx]['parent'],[]).append(subcircuit_instance_idx)
+                    for parent_idx in parent_meas:
+                        parent = subcircuit_instances[parent_idx]
+                        subcircuit_result = simulate_subcircuit(subcircuit_info={'circuit':parent['circuit'],'shots':parent['shots'],'init':parent['init'],
+                        'meas':[subcircuit_instances[subcircuit_instance_idx]['meas'] for subcircuit_instance_idx in parent_meas[parent_idx]]},
+                        eval_mode=eval_mode,result_cache=result_cache)
+                        for subcircuit_instance_idx in parent_meas[parent_idx]:
+                            instance_prob = subcircuit_result[subcircuit_instances[subcircuit_instance_idx]['meas']]
+                            if output_qubits is not None:
+                                instance_prob = get_marginal(prob=instance_prob,prob_qubits=subcircuit_out_qubits[subcircuit_idx],output_qubits=output_qubits)
+                            instance_probs[subcircuit_instance_idx] = instance_prob
+                    entry_probs_memo[subcircuit_idx][fingerprint] = entry_matrices[subcircuit_idx]@np.array(instance_probs)
+                reconstruction_terms['entry_probs'].append(entry_probs_memo[subcircuit_idx][fingerprint])
+            if observables is None:
+                results.append(raw_to_circuit_prob(prob=build_prob(reconstruction_terms=reconstruction_terms),qubit_order=reconstruction_terms['qubit_order']))
+            else:
+                results.append(get_expectations(reconstruction_terms=reconstruction_terms,observables=observables))
+        if self.verbose:
+            print('--> Sweep of %d bindings took %.3e seconds, %s distinct subcircuit bindings'%(
+                len(results),time.time()-begin,[len(entry_probs_memo[subcircuit_idx]) for subcircuit_idx in smart_order]),flush=True)
+        return np.array(results)
+
+    def evaluate(self,source_folders,eval_mode,mem_limit,num_nodes,num_threads,ibmq,cache_dir=None,cache_size=10,build=True,output_qubits=None,
+    resume=False,seed=None,build_options=None):
+        '''
+        Evaluate the subcircuits and reconstruct the full circuit output
+
+        cache_dir: optional directory of a persistent subcircuit result cache.
+        Subcircuit instances already simulated in an earlier run are read from it instead of re-simulated.
+        cache_size: max size of the cache in GB, least recently used results are evicted beyond it
+        seed: seed of the qasm samples, part of the cache keys.
+        qasm results are only cached with a seed, with seed=None every evaluation samples afresh.
+        build: set to False to skip building the full 2^n output, e.g. when only queries such as top_k are needed.
+        Returns None then.
+        output_qubits: circuit qubit indices to keep. Subcircuit entries are marginalized over the other qubits before the build,
+        so the build output has 2^len(output_qubits) states.
+
+        resume: skip the stages whose outputs are valid for the same cut and arguments,
+        and continue interrupted ones. Simulations are cached in ./cutqc_data/<circuit_name>/subcircuit_results unless cache_dir is given,
+        anytime builds continue from their checkpoints.
+
+        build_options: dict of the options below, see get_build_options for the defaults
+        keep_raw_order: keep reconstructed_prob in the internal kron order of the build instead of the circuit qubit order.
+        build_output['qubit_order'] lists the circuit qubit of every output bit, most significant bit first.
+        pipeline: attribute every subcircuit result as soon as it is simulated,
+        and build every summation term in num_threads threads as soon as all its subcircuit entries are complete.
+        Anytime build, enabled by checkpoint_interval or tolerance:
+        summation terms are built in descending order of their L1 norm bound.
+        checkpoint_interval: seconds between snapshots of the partial output to memory-mapped checkpoints, see read_build_checkpoint
+        tolerance: stop once the L1 distance to the full reconstruction is guaranteed within tolerance
+        '''
+        build_options = get_build_options(build_options=build_options)
+        anytime = build_options['checkpoint_interval'] is not None or build_options['tolerance'] is not None
         if self.verbose:
             print('*'*20,'evaluation mode = %s'%(eval_mode),'*'*20,flush=True)
-        self.source_folders = source_folders
+        if cache_dir is None and resume and self.persist and self.memory_cache is None:
+            cache_dir = get_dirname(circuit_name=self.circuit_name,max_subcircuit_qubit=None,eval_mode=None,num_threads=None,mem_limit=None,field='results')
+        if cache_dir is None:
+            # Results of earlier evaluations are kept in memory once the circuit is rebound
+            self.result_cache = self.memory_cache
+            if self.result_cache is not None:
+                self.result_cache.seed = seed
+        else:
+            self.result_cache = ResultCache(cache_dir=cache_dir,max_size=cache_size,seed=seed)
+        self.seed = seed
         
-        subprocess.run(['rm','./cutqc/build'])
-        build_command = 'gcc ./cutqc/build.c -L /opt/intel/mkl/lib/intel64/ -I /opt/intel/mkl/include/ -lmkl_intel_ilp64 -lmkl_gnu_thread -lmkl_core -lgomp -lpthread -lm -ldl -DMKL_ILP64 -m64 -o ./cutqc/build'
-        subprocess.run(build_command.split(' '))
+        if anytime and not self.persist:
+            raise ValueError('The anytime build checkpoints to disk and requires persist=True')
+        if build_options['pipeline'] and anytime:
+            raise ValueError('The anytime build orders the summation terms by magnitude and cannot be pipelined')
 
-        circ_dict, all_subcircuit_entries_sampled = self._gather_subcircuits(eval_mode=eval_mode)
-        subcircuit_results = self._run_subcircuits(circ_dict=circ_dict,eval_mode=eval_mode)
-        self._attribute_shots(subcircuit_results=subcircuit_results,eval_mode=eval_mode,all_subcircuit_entries_sampled=all_subcircuit_entries_sampled)
-        dest_folders = self._build(eval_mode=eval_mode,mem_limit=mem_limit,num_nodes=num_nodes,num_threads=num_threads)
-        return dest_folders
+        if output_qubits is not None:
+            output_qubits = sorted(set(output_qubits))
+            if len(output_qubits)==0 or output_qubits[0]<0 or output_qubits[-1]>=self.circuit.num_qubits:
+                raise ValueError('output_qubits must be a non-empty subset of range(%d)'%self.circuit.num_qubits)
+
+        eval_fingerprints = {}
+        self.source_folders = []
+        for source_folder in source_folders:
+            cut_fingerprint = self._get_stage_fingerprint(folder=source_folder,stage='cut')
+            eval_fingerprints[source_folder] = get_stage_fingerprint(cut_fingerprint,eval_mode,output_qubits,'dummy_sample',seed) if cut_fingerprint is not None else None
+            eval_folder = self._get_eval_folder(source_folder=source_folder,eval_mode=eval_mode)
+            if resume and eval_fingerprints[source_folder] is not None and self._get_stage_fingerprint(folder=eval_folder,stage='evaluate')==eval_fingerprints[source_folder]:
+                if self.verbose:
+                    print('--> Resume %s from the earlier evaluation'%eval_folder,flush=True)
+            else:
+                self.source_folders.append(source_folder)
+        if len(self.source_folders)>0:
+            circ_dict, all_subcircuit_entries_sampled = self._gather_subcircuits(eval_mode=eval_mode,output_qubits=output_qubits)
+            if build_options['pipeline'] and build:
+                pipelined_dest_folders = run_pipeline(cutqc=self,circ_dict=circ_dict,eval_mode=eval_mode,all_subcircuit_entries_sampled=all_subcircuit_entries_sampled,
+                eval_fingerprints=eval_fingerprints,mem_limit=mem_limit,num_threads=num_threads,keep_raw_order=build_options['keep_raw_order'],output_qubits=output_qubits)
+            else:
+                pipelined_dest_folders = {}
+                subcircuit_results = self._run_subcircuits(circ_dict=circ_dict,eval_mode=eval_mode)
+                attribute_shots(cutqc=self,subcircuit_results=subcircuit_results,eval_mode=eval_mode,all_subcircuit_entries_sampled=all_subcircuit_entries_sampled,output_qubits=output_qubits)
+                for source_folder in self.source_folders:
+                    self._set_stage_fingerprint(folder=self._get_eval_folder(source_folder=source_folder,eval_mode=eval_mode),
+                    stage='evaluate',fingerprint=eval_fingerprints[source_folder])
+        else:
+            pipelined_dest_folders = {}
+        if not build:
+            self.source_folders = source_folders
+            return None
+        # Pipelined folders are already built
+        self.source_folders = [source_folder for source_folder in source_folders if source_folder not in pipelined_dest_folders]
+        dest_folders = {}
+        if len(self.source_folders)>0:
+            dest_folders = dict(zip(self.source_folders,self._build(eval_mode=eval_mode,mem_limit=mem_limit,num_nodes=num_nodes,num_threads=num_threads,
+            build_options=build_options,resume=resume)))
+        dest_folders.update(pipelined_dest_folders)
+        self.source_folders = source_folders
+        return [dest_folders[source_folder] for source_folder in source_folders]
+
+    def top_k(self, source_folders, eval_mode, k):
+        '''
+        The k most probable states of every evaluated source folder, found from the subcircuit entries
+        without building the full output. Run evaluate first, build=False suffices.
+        Returns [(states, probabilities), ...], one per source folder.
+        states are in the circuit qubit order, most probable first.
+        '''
+        top_states = []
+        for source_folder in source_folders:
+            begin = time.time()
+            reconstruction_terms = self._get_reconstruction_terms(source_folder=source_folder,eval_mode=eval_mode)
+            states, probabilities = find_top_states(reconstruction_terms=reconstruction_terms,k=k)
+            top_states.append((states,probabilities))
+            if self.verbose:
+                print('--> Top %d states of %s took %.3e seconds'%(k,source_folder,time.time()-begin),flush=True)
+                num_qubits = len(reconstruction_terms['qubit_order'])
+                for state, probability in zip(states[:10],probabilities[:10]):
+                    print('%s %.3e'%(bin(state)[2:].zfill(num_qubits),probability),flush=True)
+        return top_states
+
+    def expectation(self, source_folders, eval_mode, observables):
+        '''
+        Expectation values of diagonal product observables of every evaluated source folder,
+        contracted against the subcircuit entries without building the full output. Run evaluate first, build=False suffices.
+        observables: list of I/Z strings, e.g. 'ZIIZ' with the leftmost character on the highest qubit,
+        or of dicts {qubit: diagonal of length 2}
+        Returns [expectations, ...], one array per source folder
+        '''
+        all_expectations = []
+        for source_folder in source_folders:
+            begin = time.time()
+            reconstruction_terms = self._get_reconstruction_terms(source_folder=source_folder,eval_mode=eval_mode)
+            expectations = get_expectations(reconstruction_terms=reconstruction_terms,observables=observables)
+            all_expectations.append(expectations)
+            if self.verbose:
+                print('--> %d expectation values of %s took %.3e seconds'%(len(observables),source_folder,time.time()-begin),flush=True)
+        return all_expectations
+
+    def sample(self, source_folders, eval_mode, shots, seed=None):
+        '''
+        Draw shots of every evaluated source folder from the subcircuit entries without building the full output.
+        Run evaluate first, build=False suffices.
+        Returns [(states, counts, info), ...], one per source folder.
+        states are in the circuit qubit order.
+        info['bias_bound'] bounds the TVD of the sampler from the reconstructed quasi-distribution caused by clipping negative probabilities.
+        '''
+        all_samples = []
+        for source_folder in source_folders:
+            begin = time.time()
+            reconstruction_terms = self._get_reconstruction_terms(source_folder=source_folder,eval_mode=eval_mode)
+            raw_states, counts, info = sample_bitstrings(reconstruction_terms=reconstruction_terms,shots=shots,seed=seed)
+            states = raw_to_circuit_states(raw_states=raw_states,qubit_order=reconstruction_terms['qubit_order'])
+            all_samples.append((states,counts,info))
+            if self.verbose:
+                print('--> %d shots of %s took %.3e seconds, %d distinct states, bias bound = %.1e +- %.1e'%(
+                    shots,source_folder,time.time()-begin,len(states),info['bias_bound'],info['bias_bound_std']),flush=True)
+        return all_samples
+
+    def _get_eval_folder(self, source_folder, eval_mode):
+        cut_solution = self._load(folder=source_folder,name='cut_solution')
+        return get_dirname(circuit_name=cut_solution['circuit_name'],max_subcircuit_qubit=cut_solution['max_subcircuit_qubit'],
+        eval_mode=eval_mode,num_threads=None,mem_limit=None,field='evaluator')
+
+    def _load_summation_terms(self, source_folder):
+        return SummationTerms.from_record(self._load(folder=source_folder,name='summation_terms'))
+
+    def _get_reconstruction_terms(self, source_folder, eval_mode):
+        cut_solution = self._load(folder=source_folder,name='cut_solution')
+        eval_folder = self._get_eval_folder(source_folder=source_folder,eval_mode=eval_mode)
+        return get_reconstruction_terms(cut_solution=cut_solution,
+        summation_terms=self._load_summation_terms(source_folder=source_folder),
+        summation_terms_sampled=self._load(folder=eval_folder,name='summation_terms_sampled'),
+        output_qubits=self._load(folder=eval_folder,name='output_qubits'),
+        subcircuit_entry_probs={subcircuit_idx:self._load(folder=eval_folder,name='subcircuit_entry_probs_%d'%subcircuit_idx)
+        for subcircuit_idx in range(len(cut_solution['subcircuits']))})
 
     def verify(self, source_folders, dest_folders):
         if self.verbose:
             print('*'*20,'Verify','*'*20,flush=True)
-        row_format = '{:<20} {:<10} {:<30}'
+        row_format = '{:<20} {:<10} {:<10} {:<10} {:<10}'
         if self.verbose:
-            print(row_format.format('Circuit Name','QPU','Error'),flush=True)
+            print(row_format.format('Circuit Name','QPU','MSE','Fidelity','TVD'),flush=True)
         for source_folder, dest_folder in zip(source_folders,dest_folders):
-            cut_solution = read_dict(filename='%s/cut_solution.pckl'%source_folder)
+            cut_solution = self._load(folder=source_folder,name='cut_solution')
             circuit = cut_solution['circuit']
             circuit_name = cut_solution['circuit_name']
             complete_path_map = cut_solution['complete_path_map']
             subcircuits = cut_solution['subcircuits']
             max_subcircuit_qubit = cut_solution['max_subcircuit_qubit']
-            summation_terms = pickle.load(open('%s/summation_terms.pckl'%source_folder,'rb'))
-            smart_order = [x[0] for x in summation_terms[0]]
+            smart_order = self._load_summation_terms(source_folder=source_folder).smart_order
 
-            build_output = read_dict(filename='%s/build_output.pckl'%dest_folder)
+            build_output = self._load(folder=dest_folder,name='build_output',memoize=False)
             reconstructed_prob = build_output['reconstructed_prob']
             eval_mode = build_output['eval_mode']
             
-            squared_error = verify(full_circuit=circuit,unordered=reconstructed_prob,complete_path_map=complete_path_map,subcircuits=subcircuits,smart_order=smart_order)
+            errors = verify(full_circuit=circuit,unordered=reconstructed_prob,complete_path_map=complete_path_map,subcircuits=subcircuits,smart_order=smart_order,
+            qubit_order=build_output.get('qubit_order',None))
+            self._save(folder=dest_folder,name='errors',value=errors)
             if self.verbose:
-                print(row_format.format(circuit_name,eval_mode,'%.1e'%squared_error),flush=True)
+                print(row_format.format(circuit_name,eval_mode,'%.1e'%errors['mse'],'%.4f'%errors['fidelity'],'%.1e'%errors['tvd']),flush=True)
     
     def _generate_subcircuits(self,source_folder,cut_solution):
         '''
@@ -130,11 +495,12 @@ class CutQC:
         subcircuit_instances, subcircuit_instances_idx = generate_subcircuit_instances(subcircuits=subcircuits,complete_path_map=complete_path_map)
         summation_terms, subcircuit_entries, subcircuit_instance_attribution = generate_summation_terms(full_circuit=full_circuit,subcircuits=subcircuits,complete_path_map=complete_path_map,subcircuit_instances_idx=subcircuit_instances_idx,counter=counter)
 
-        pickle.dump(subcircuit_instances, open('%s/subcircuit_instances.pckl'%(source_folder),'wb'))
-        pickle.dump(subcircuit_instances_idx, open('%s/subcircuit_instances_idx.pckl'%(source_folder),'wb'))
-        pickle.dump(subcircuit_instance_attribution, open('%s/subcircuit_instance_attribution.pckl'%(source_folder),'wb'))
-        pickle.dump(summation_terms, open('%s/summation_terms.pckl'%(source_folder),'wb'))
-        pickle.dump(subcircuit_entries, open('%s/subcircuit_entries.pckl'%(source_folder),'wb'))
+        self._save(folder=source_folder,name='subcircuit_instances',value=subcircuit_instances)
+        self._save(folder=source_folder,name='subcircuit_instances_idx',value=subcircuit_instances_idx)
+        for subcircuit_idx in subcircuit_entries:
+            self._save(folder=source_folder,name='subcircuit_entries_%d'%subcircuit_idx,value=subcircuit_entries[subcircuit_idx])
+            self._save(folder=source_folder,name='subcircuit_instance_attribution_%d'%subcircuit_idx,value=subcircuit_instance_attribution[subcircuit_idx])
+        self._save(folder=source_folder,name='summation_terms',value=summation_terms.get_record())
 
         if self.verbose:
             print('--> %s subcircuit_instances:'%self.circuit_name,flush=True)
@@ -153,29 +519,26 @@ class CutQC:
             row_format = '{:<30} {:<30}'
             for subcircuit_idx in subcircuit_entries:
                 print(row_format.format('subcircuit_%d_entry_idx'%subcircuit_idx,'kronecker term (coeff, instance)'),flush=True)
-                ctr = 0
-                for subcircuit_entry_idx in subcircuit_entries[subcircuit_idx]:
-                    if type(subcircuit_entry_idx) is int:
-                        ctr += 1
-                        if ctr<=10:
-                            print(row_format.format(subcircuit_entry_idx,str(subcircuit_entries[subcircuit_idx][subcircuit_entry_idx])[:30]))
-                print('... Total %d subcircuit entries\n'%ctr,flush=True)
+                num_entries = len(subcircuit_entries[subcircuit_idx]['indptr'])-1
+                for subcircuit_entry_idx in range(min(num_entries,10)):
+                    kronecker_term = get_csr_row(csr=subcircuit_entries[subcircuit_idx],row_idx=subcircuit_entry_idx,key='instance_indices')
+                    print(row_format.format(subcircuit_entry_idx,str(kronecker_term)[:30]))
+                print('... Total %d subcircuit entries\n'%num_entries,flush=True)
         
             print('--> %s subcircuit_instance_attribution:'%self.circuit_name,flush=True)
             row_format = '{:<30} {:<50}'
             for subcircuit_idx in subcircuit_instance_attribution:
                 print(row_format.format('subcircuit_%d_instance_idx'%subcircuit_idx,'coefficient, subcircuit_entry_idx'),flush=True)
-                ctr = 0
-                for subcircuit_instance_idx in subcircuit_instance_attribution[subcircuit_idx]:
-                    ctr += 1
-                    if ctr>10:
-                        break
-                    print(row_format.format(subcircuit_instance_idx,str(subcircuit_instance_attribution[subcircuit_idx][subcircuit_instance_idx])[:50]),flush=True)
-                print('... Total %d subcircuit instances to attribute\n'%len(subcircuit_instance_attribution[subcircuit_idx]))
+                attribution_lengths = np.diff(subcircuit_instance_attribution[subcircuit_idx]['indptr'])
+                attributed_instances = np.flatnonzero(attribution_lengths)
+                for subcircuit_instance_idx in attributed_instances[:10]:
+                    attributions = get_csr_row(csr=subcircuit_instance_attribution[subcircuit_idx],row_idx=subcircuit_instance_idx,key='entry_indices')
+                    print(row_format.format(subcircuit_instance_idx,str(attributions)[:50]),flush=True)
+                print('... Total %d subcircuit instances to attribute\n'%len(attributed_instances))
         
             print('--> %s summation_terms:'%self.circuit_name)
             row_format = '{:<10}'*len(subcircuits)
-            for summation_term in summation_terms[:10]:
+            for summation_term in summation_terms[:min(len(summation_terms),10)]:
                 row = []
                 for subcircuit_entry in summation_term:
                     subcircuit_idx, subcircuit_entry_idx = subcircuit_entry
@@ -183,27 +546,34 @@ class CutQC:
                 print(row_format.format(*row))
             print('... Total %d summations\n'%len(summation_terms),flush=True)
 
-    def _gather_subcircuits(self,eval_mode):
+    def _gather_subcircuits(self,eval_mode,output_qubits=None):
+        '''
+        Gather the subcircuit instances to run from all source_folders
+        Structurally identical instances are simulated only once:
+        circ_dict[(fingerprint,shots)] = circuit, shots, init, meas, owners
+        owners = [(source_folder, subcircuit_idx, init, meas), ...] receive the results
+        '''
         circ_dict = {}
+        fingerprints = {}
+        num_instances = 0
         all_subcircuit_entries_sampled = {}
         for source_folder in self.source_folders:
-            cut_solution = read_dict(filename='%s/cut_solution.pckl'%source_folder)
-            subcircuit_instances = read_dict(filename='%s/subcircuit_instances.pckl'%source_folder)
-            summation_terms = pickle.load(open('%s/summation_terms.pckl'%source_folder,'rb'))
-            subcircuit_entries = read_dict(filename='%s/subcircuit_entries.pckl'%source_folder)
+            cut_solution = self._load(folder=source_folder,name='cut_solution')
+            subcircuit_instances = self._load(folder=source_folder,name='subcircuit_instances')
+            summation_terms = self._load_summation_terms(source_folder=source_folder)
+            subcircuit_entries = {subcircuit_idx:self._load(folder=source_folder,name='subcircuit_entries_%d'%subcircuit_idx)
+            for subcircuit_idx in range(len(cut_solution['subcircuits']))}
             max_subcircuit_qubit = cut_solution['max_subcircuit_qubit']
             circuit_name = cut_solution['circuit_name']
             
             eval_folder = get_dirname(circuit_name=circuit_name,max_subcircuit_qubit=max_subcircuit_qubit,
             num_threads=None,eval_mode=eval_mode,mem_limit=None,field='evaluator')
-            if os.path.exists(eval_folder):
-                subprocess.run(['rm','-r',eval_folder])
-            os.makedirs(eval_folder)
+            self._reset_folder(folder=eval_folder)
             
-            summation_terms_sampled = dummy_sample(summation_terms=summation_terms)
-            subcircuit_entries_sampled = get_subcircuit_entries_sampled(summation_terms=summation_terms_sampled)
+            summation_terms_sampled = dummy_sample(num_summation_terms=len(summation_terms))
+            subcircuit_entries_sampled = get_subcircuit_entries_sampled(summation_terms=summation_terms,summation_terms_sampled=summation_terms_sampled)
             
-            all_subcircuit_entries_sampled[circuit_name] = subcircuit_entries_sampled
+            all_subcircuit_entries_sampled[source_folder] = subcircuit_entries_sampled
             subcircuit_instances_sampled = get_subcircuit_instances_sampled(subcircuit_entries=subcircuit_entries,subcircuit_entry_samples=subcircuit_entries_sampled)
             for subcircuit_instance in subcircuit_instances_sampled:
                 subcircuit_idx, subcircuit_instance_idx = subcircuit_instance
@@ -212,17 +582,34 @@ class CutQC:
                 shots = subcircuit_instances[subcircuit_idx][parent_subcircuit_instance_idx]['shots']
                 init = subcircuit_instances[subcircuit_idx][subcircuit_instance_idx]['init']
                 meas = subcircuit_instances[subcircuit_idx][subcircuit_instance_idx]['meas']
-                circ_dict_key = (circuit_name,subcircuit_idx,parent_subcircuit_instance_idx)
-                if circ_dict_key in circ_dict:
-                    assert circ_dict[circ_dict_key]['init'] == init
-                    circ_dict[circ_dict_key]['meas'].append(meas)
-                else:
+                owner_key = (source_folder,subcircuit_idx,parent_subcircuit_instance_idx)
+                if owner_key not in fingerprints:
+                    fingerprints[owner_key] = circuit_fingerprint(circuit)
+                    num_instances += 1
+                circ_dict_key = (fingerprints[owner_key],shots)
+                if circ_dict_key not in circ_dict:
                     circ_dict[circ_dict_key] = {
                         'circuit':circuit,
+                        'fingerprint':fingerprints[owner_key],
                         'shots':shots,
                         'init':init,
-                        'meas':[meas]}
-            pickle.dump(summation_terms_sampled, open('%s/summation_terms_sampled.pckl'%(eval_folder),'wb'))
+                        'meas':[],
+                        'owners':{}}
+                if meas not in circ_dict[circ_dict_key]['meas']:
+                    circ_dict[circ_dict_key]['meas'].append(meas)
+                if owner_key in circ_dict[circ_dict_key]['owners']:
+                    assert circ_dict[circ_dict_key]['owners'][owner_key][0] == init
+                    circ_dict[circ_dict_key]['owners'][owner_key][1].append(meas)
+                else:
+                    circ_dict[circ_dict_key]['owners'][owner_key] = (init,[meas])
+            self._save(folder=eval_folder,name='summation_terms_sampled',value=summation_terms_sampled)
+            self._save(folder=eval_folder,name='output_qubits',value=output_qubits)
+        for circ_dict_key in circ_dict:
+            owners = circ_dict[circ_dict_key]['owners']
+            circ_dict[circ_dict_key]['owners'] = [(owner_key[0],owner_key[1],owners[owner_key][0],owners[owner_key][1]) for owner_key in owners]
+        if self.verbose:
+            print('--> Gather subcircuits',flush=True)
+            print('%d unique subcircuit instances out of %d'%(len(circ_dict),num_instances),flush=True)
         return circ_dict, all_subcircuit_entries_sampled
     
     def _run_subcircuits(self,circ_dict,eval_mode):
@@ -235,147 +622,187 @@ class CutQC:
         if eval_mode=='sv' or eval_mode=='qasm' or eval_mode=='runtime':
             subcircuit_results = {}
             for key in list(circ_dict.keys()):
-                circuit_name, subcircuit_result = simulate_subcircuit(key=key,subcircuit_info=circ_dict[key],eval_mode=eval_mode)
-                if circuit_name in subcircuit_results:
-                    subcircuit_results[circuit_name].update(subcircuit_result)
-                else:
-                    subcircuit_results[circuit_name] = subcircuit_result
+                subcircuit_result = simulate_subcircuit(subcircuit_info=circ_dict[key],eval_mode=eval_mode,result_cache=self.result_cache,seed=self.seed)
+                # Fan the results out to every owner of this instance
+                for owner in circ_dict[key]['owners']:
+                    source_folder, subcircuit_idx, init, meas = owner
+                    if source_folder not in subcircuit_results:
+                        subcircuit_results[source_folder] = {}
+                    for m in meas:
+                        subcircuit_results[source_folder][(subcircuit_idx,init,m)] = subcircuit_result[m]
         else:
             raise NotImplementedError
+        if self.verbose and self.result_cache is not None:
+            cache_stats = self.result_cache.get_stats()
+            print('Result cache: %d hits, %d misses, %d evictions, hit rate = %.2f'%(
+                cache_stats['hits'],cache_stats['misses'],cache_stats['evictions'],cache_stats['hit_rate']),flush=True)
         return subcircuit_results
     
-    def _attribute_shots(self,subcircuit_results,eval_mode,all_subcircuit_entries_sampled):
+    def _get_build_fingerprints(self, eval_folder, num_threads, mem_limit, keep_raw_order, tolerance):
         '''
-        Attribute the shots into respective subcircuit entries
+        Returns the fingerprints of the build checkpoints and of the build output
         '''
-        row_format = '{:<15} {:<15} {:<25} {:<30}'
-        if self.verbose:
-            print('--> Attribute shots',flush=True)
-            print(row_format.format('circuit_name','subcircuit_idx','subcircuit_instance_idx','coefficient, subcircuit_entry_idx'),flush=True)
-        for source_folder in self.source_folders:
-            ctr = 0
-            subcircuit_entry_probs = {}
-            cut_solution = read_dict(filename='%s/cut_solution.pckl'%source_folder)
-            subcircuit_instances_idx = read_dict(filename='%s/subcircuit_instances_idx.pckl'%source_folder)
-            subcircuit_instance_attribution = read_dict(filename='%s/subcircuit_instance_attribution.pckl'%source_folder)
-            max_subcircuit_qubit = cut_solution['max_subcircuit_qubit']
-            circuit_name = cut_solution['circuit_name']
-            subcircuit_entries_sampled = all_subcircuit_entries_sampled[circuit_name]
-            eval_folder = get_dirname(circuit_name=circuit_name,max_subcircuit_qubit=max_subcircuit_qubit,
-            eval_mode=eval_mode,num_threads=None,mem_limit=None,field='evaluator')
+        eval_fingerprint = self._get_stage_fingerprint(folder=eval_folder,stage='evaluate')
+        if eval_fingerprint is None:
+            return None, None
+        # Checkpoints hold the raw order output in descending term magnitude, whatever the tolerance
+        checkpoint_fingerprint = get_stage_fingerprint(eval_fingerprint,num_threads,mem_limit)
+        build_fingerprint = get_stage_fingerprint(checkpoint_fingerprint,keep_raw_order,tolerance)
+        return checkpoint_fingerprint, build_fingerprint
 
-            for key in subcircuit_results[circuit_name]:
-                ctr += 1
-                subcircuit_idx, init, meas = key
-                subcircuit_instance_idx = subcircuit_instances_idx[subcircuit_idx][(init,meas)]
-                subcircuit_instance_prob = subcircuit_results[circuit_name][key]
-                attributions = subcircuit_instance_attribution[subcircuit_idx][subcircuit_instance_idx]
-                if self.verbose and ctr<=10:
-                    print(row_format.format(circuit_name,subcircuit_idx,subcircuit_instance_idx,str(attributions)[:30]),flush=True)
-
-                for item in attributions:
-                    coefficient, subcircuit_entry_idx = item
-                    if (subcircuit_idx,subcircuit_entry_idx) not in subcircuit_entries_sampled:
-                        continue
-                    subcircuit_entry_prob_key = (eval_folder,subcircuit_idx,subcircuit_entry_idx)
-                    if subcircuit_entry_prob_key in subcircuit_entry_probs:
-                        subcircuit_entry_probs[subcircuit_entry_prob_key] += coefficient*subcircuit_instance_prob
-                    else:
-                        subcircuit_entry_probs[subcircuit_entry_prob_key] = coefficient*subcircuit_instance_prob
-            for subcircuit_entry_prob_key in subcircuit_entry_probs:
-                subcircuit_entry_prob = subcircuit_entry_probs[subcircuit_entry_prob_key]
-                eval_folder,subcircuit_idx,subcircuit_entry_idx = subcircuit_entry_prob_key
-                subcircuit_entry_file = open('%s/%d_%d.txt'%(eval_folder,subcircuit_idx,subcircuit_entry_idx),'w')
-                [subcircuit_entry_file.write('%e '%x) for x in subcircuit_entry_prob]
-                subcircuit_entry_file.close()
-            if self.verbose:
-                print('... Total %d subcircuit results attributed\n'%ctr,flush=True)
-    
-    def _build(self, eval_mode, mem_limit, num_nodes, num_threads):
+    def _build(self, eval_mode, mem_limit, num_nodes, num_threads, build_options, resume=False):
+        '''
+        build_options: see get_build_options, the pipeline option is ignored
+        '''
+        keep_raw_order = build_options['keep_raw_order']
+        checkpoint_interval = build_options['checkpoint_interval']
+        tolerance = build_options['tolerance']
         if self.verbose:
             print('--> Build')
             row_format = '{:<15} {:<20} {:<30}'
             print(row_format.format('circuit_name','summation_term_idx','summation_term'))
         dest_folders = []
         for source_folder in self.source_folders:
-            cut_solution = read_dict(filename='%s/cut_solution.pckl'%source_folder)
+            cut_solution = self._load(folder=source_folder,name='cut_solution')
             max_subcircuit_qubit = cut_solution['max_subcircuit_qubit']
             circuit_name = cut_solution['circuit_name']
-            summation_terms = pickle.load(open('%s/summation_terms.pckl'%source_folder,'rb'))
+            summation_terms = self._load_summation_terms(source_folder=source_folder)
+            smart_order = summation_terms.smart_order
             eval_folder = get_dirname(circuit_name=circuit_name,max_subcircuit_qubit=max_subcircuit_qubit,
             eval_mode=eval_mode,num_threads=None,mem_limit=None,field='evaluator')
-            summation_terms_sampled = pickle.load(open('%s/summation_terms_sampled.pckl'%eval_folder,'rb'))
+            summation_terms_sampled = self._load(folder=eval_folder,name='summation_terms_sampled')
+            num_summation_terms_sampled = len(summation_terms_sampled['summation_term_idx'])
             
             if self.verbose:
-                [print(row_format.format(circuit_name,x['summation_term_idx'],str(x['summation_term'])[:30])) for x in summation_terms_sampled[:10]]
-                print('... Total %d summation terms sampled\n'%len(summation_terms_sampled))
-            cut_solution = read_dict(filename='%s/cut_solution.pckl'%source_folder)
+                for summation_term_idx in summation_terms_sampled['summation_term_idx'][:10]:
+                    summation_term = summation_terms[int(summation_term_idx)]
+                    print(row_format.format(circuit_name,summation_term_idx,str(summation_term)[:30]))
+                print('... Total %d summation terms sampled\n'%num_summation_terms_sampled)
             full_circuit = cut_solution['circuit']
             subcircuits = cut_solution['subcircuits']
             complete_path_map = cut_solution['complete_path_map']
-            counter = cut_solution['counter']
+            output_qubits = self._load(folder=eval_folder,name='output_qubits')
+            raw_qubit_order = get_subcircuit_out_qubits(full_circuit=full_circuit,complete_path_map=complete_path_map,subcircuits=subcircuits,
+            smart_order=smart_order,output_qubits=output_qubits)
+            if keep_raw_order:
+                qubit_order = raw_qubit_order
+            else:
+                qubit_order = sorted(raw_qubit_order,reverse=True)
 
             dest_folder = get_dirname(circuit_name=circuit_name,max_subcircuit_qubit=max_subcircuit_qubit,
             eval_mode=eval_mode,num_threads=num_threads,mem_limit=mem_limit,field='build')
             dest_folders.append(dest_folder)
-            if os.path.exists(dest_folder):
-                subprocess.run(['rm','-r',dest_folder])
-            os.makedirs(dest_folder)
-
-            '''
-            TODO: handle the new summation_terms_sampled format
-            1. Get rid of repeated summation term computations
-            '''
-            num_samples = 1
-            child_processes = []
-            for rank in range(num_threads):
-                rank_summation_terms = find_process_jobs(jobs=summation_terms_sampled,rank=rank,num_workers=num_threads)
-                build_command = './cutqc/build %d %s %s %d %d %d %d %d'%(
-                    rank,eval_folder,dest_folder,int(2**full_circuit.num_qubits),len(cut_solution['positions']),len(rank_summation_terms),len(subcircuits),num_samples)
-                build_command_file = open('%s/build_command_%d.txt'%(dest_folder,rank),'w')
-                for rank_summation_term in rank_summation_terms:
-                    build_command_file.write('%e '%rank_summation_term['sampling_prob'])
-                    build_command_file.write('%d '%rank_summation_term['frequency'])
-                    for item in rank_summation_term['summation_term']:
-                        subcircuit_idx, subcircuit_entry_idx = item
-                        build_command_file.write('%d %d %d '%(subcircuit_idx,subcircuit_entry_idx,int(2**counter[subcircuit_idx]['effective'])))
-                build_command_file.close()
-                p = subprocess.Popen(args=build_command.split(' '))
-                child_processes.append(p)
-            for rank in range(num_threads):
-                cp = child_processes[rank]
-                cp.wait()
-            
-            time.sleep(1)
+            checkpoint_fingerprint, build_fingerprint = self._get_build_fingerprints(eval_folder=eval_folder,num_threads=num_threads,mem_limit=mem_limit,
+            keep_raw_order=keep_raw_order,tolerance=tolerance)
+            if resume and build_fingerprint is not None and self._get_stage_fingerprint(folder=dest_folder,stage='build')==build_fingerprint:
+                if self.verbose:
+                    print('--> Resume %s from the earlier build'%dest_folder,flush=True)
+                continue
+            if not self.persist:
+                begin = time.time()
+                self._reset_folder(folder=dest_folder)
+                reconstruction_terms = self._get_reconstruction_terms(source_folder=source_folder,eval_mode=eval_mode)
+                reconstructed_prob = build_prob(reconstruction_terms=reconstruction_terms)
+                if not keep_raw_order:
+                    reconstructed_prob = raw_to_circuit_prob(prob=reconstructed_prob,qubit_order=raw_qubit_order)
+                if self.verbose:
+                    print('%s _build took %.3e seconds'%(circuit_name,time.time()-begin),flush=True)
+                    print('Sampled %d/%d summation terms'%(num_summation_terms_sampled,len(summation_terms)))
+                self._save(folder=dest_folder,name='build_output',value={'reconstructed_prob':reconstructed_prob,
+                'eval_mode':eval_mode,
+                'qubit_order':qubit_order,
+                'num_summation_terms_sampled':num_summation_terms_sampled,
+                'num_summation_terms_built':num_summation_terms_sampled,
+                'remaining_bound':0,
+                'num_summation_terms':len(summation_terms)})
+                self._set_stage_fingerprint(folder=dest_folder,stage='build',fingerprint=build_fingerprint)
+                continue
+            anytime = checkpoint_interval is not None or tolerance is not None
+            resume_build = False
+            if resume and anytime and os.path.exists(dest_folder):
+                # Only continue checkpoints of the same build
+                try:
+                    resume_build = self._load(folder=dest_folder,name='checkpoint_info',memoize=False).get('fingerprint',None)==checkpoint_fingerprint
+                except FileNotFoundError:
+                    pass
+            if not resume_build:
+                self._reset_folder(folder=dest_folder)
+            self._save(folder=dest_folder,name='checkpoint_info',value={'raw_qubit_order':raw_qubit_order,'num_threads':num_threads,'fingerprint':checkpoint_fingerprint},memoize=False)
+
+            subcircuit_entry_probs = {subcircuit_idx:self._load(folder=eval_folder,name='subcircuit_entry_probs_%d'%subcircuit_idx) for subcircuit_idx in smart_order}
+            def get_term_rows(summation_term_indices):
+                # Row of every factor in the subcircuit_entry_probs matrices, computed from the summation term structure
+                terms = summation_terms.get_rows(summation_term_indices=summation_term_indices)
+                term_rows = np.zeros(terms.shape,dtype=np.int64)
+                for subcircuit_ctr, subcircuit_idx in enumerate(smart_order):
+                    term_rows[:,subcircuit_ctr] = np.searchsorted(subcircuit_entry_probs[subcircuit_idx]['entry_indices'],terms[:,subcircuit_ctr])
+                return term_rows
+            weights = 0.5**len(cut_solution['positions'])*summation_terms_sampled['frequency']/summation_terms_sampled['sampling_prob']
+            if anytime:
+                # Largest terms first, dealt round robin so that every rank builds in descending order
+                magnitudes = get_summation_term_magnitudes(subcircuit_entry_probs=subcircuit_entry_probs,smart_order=smart_order,
+                terms=summation_terms.get_rows(summation_term_indices=summation_terms_sampled['summation_term_idx']),weights=weights)
+                magnitude_order = np.argsort(-magnitudes,kind='stable')
+            entry_probs = [subcircuit_entry_probs[subcircuit_idx]['probs'] for subcircuit_idx in smart_order]
+            rank_outputs = [None for rank in range(num_threads)]
+            rank_errors = []
+            def build_rank_terms(rank):
+                if anytime:
+                    # Checkpoints count the terms of one build call, so anytime ranks build all their terms at once
+                    rank_sampled_indices = magnitude_order[rank::num_threads]
+                    rank_magnitudes = magnitudes[rank_sampled_indices]
+                    remaining_bounds = np.cumsum(rank_magnitudes[::-1])[::-1]-rank_magnitudes
+                    return build_terms(entry_probs=entry_probs,term_rows=get_term_rows(summation_terms_sampled['summation_term_idx'][rank_sampled_indices]),
+                    weights=weights[rank_sampled_indices],remaining_bounds=remaining_bounds,rank=rank,dest_folder=dest_folder,
+                    checkpoint_interval=checkpoint_interval,tolerance=tolerance/num_threads if tolerance is not None else None,resume=resume_build,
+                    verbose=self.verbose)
+                rank_sampled_indices = np.array(find_process_jobs(jobs=range(num_summation_terms_sampled),rank=rank,num_workers=num_threads),dtype=np.int64)
+                # Index a chunk of terms at a time into the same output, ranks without terms build an empty one
+                chunk_size = 2**16
+                rank_reconstructed_prob = None
+                rank_progress = {'num_built':0,'remaining_bound':0,'elapsed':0}
+                for start in range(0,max(1,len(rank_sampled_indices)),chunk_size):
+                    chunk_sampled_indices = rank_sampled_indices[start:start+chunk_size]
+                    rank_reconstructed_prob, progress = build_terms(entry_probs=entry_probs,term_rows=get_term_rows(summation_terms_sampled['summation_term_idx'][chunk_sampled_indices]),
+                    weights=weights[chunk_sampled_indices],rank=rank,reconstructed_prob=rank_reconstructed_prob,verbose=self.verbose)
+                    for key in rank_progress:
+                        rank_progress[key] += progress[key]
+                return rank_reconstructed_prob, rank_progress
+            def build_rank(rank):
+                try:
+                    rank_outputs[rank] = build_rank_terms(rank)
+                except Exception as error:
+                    rank_errors.append(error)
+            # The kernel releases the GIL, every rank builds in a thread of this process
+            rank_threads = [threading.Thread(target=build_rank,args=(rank,)) for rank in range(num_threads)]
+            for rank_thread in rank_threads:
+                rank_thread.start()
+            for rank_thread in rank_threads:
+                rank_thread.join()
+            if len(rank_errors)>0:
+                raise rank_errors[0]
+
             elapsed = []
-            reconstructed_prob = None
-            for rank in range(num_threads):
-                rank_logs = open('%s/rank_%d_summary.txt'%(dest_folder,rank), 'r')
-                lines = rank_logs.readlines()
-                assert lines[-2].split(' = ')[0]=='Total build time' and lines[-1] == 'DONE\n'
-                elapsed.append(float(lines[-2].split(' = ')[1]))
-
-                fp = open('%s/build_%d.txt'%(dest_folder,rank), 'r')
-                for i, line in enumerate(fp):
-                    rank_reconstructed_prob = line.split(' ')[:-1]
-                    rank_reconstructed_prob = np.array(rank_reconstructed_prob)
-                    rank_reconstructed_prob = rank_reconstructed_prob.astype(np.float)
-                    if i>0:
-                        raise Exception('C build_output should not have more than 1 line')
-                fp.close()
-                subprocess.run(['rm','%s/build_%d.txt'%(dest_folder,rank)])
-                if isinstance(reconstructed_prob,np.ndarray):
-                    reconstructed_prob += rank_reconstructed_prob
-                else:
-                    reconstructed_prob = rank_reconstructed_prob
+            num_summation_terms_built = 0
+            remaining_bound = 0
+            for rank_reconstructed_prob, progress in rank_outputs:
+                elapsed.append(progress['elapsed'])
+                num_summation_terms_built += progress['num_built']
+                remaining_bound += progress['remaining_bound']
+            reconstructed_prob = sum_outputs(raw_probs=[rank_output[0] for rank_output in rank_outputs],raw_qubit_order=None if keep_raw_order else raw_qubit_order)
             elapsed = np.array(elapsed)
             if self.verbose:
                 print('%s _build took %.3e seconds'%(circuit_name,np.mean(elapsed)),flush=True)
-                print('Sampled %d/%d summation terms'%(len(summation_terms_sampled),len(summation_terms)))
-            pickle.dump(
-                {'reconstructed_prob':reconstructed_prob,
+                print('Sampled %d/%d summation terms'%(num_summation_terms_sampled,len(summation_terms)))
+                if anytime:
+                    print('Built %d/%d sampled summation terms, remaining L1 bound = %.3e'%(num_summation_terms_built,num_summation_terms_sampled,remaining_bound),flush=True)
+            self._save(folder=dest_folder,name='build_output',value={'reconstructed_prob':reconstructed_prob,
                 'eval_mode':eval_mode,
-                'num_summation_terms_sampled':len(summation_terms_sampled),
+                'qubit_order':qubit_order,
+                'num_summation_terms_sampled':num_summation_terms_sampled,
+                'num_summation_terms_built':num_summation_terms_built,
+                'remaining_bound':remaining_bound,
                 'num_summation_terms':len(summation_terms)
-                },open('%s/build_output.pckl'%(dest_folder),'wb'))
+                },memoize=False)
+            self._set_stage_fingerprint(folder=dest_folder,stage='build',fingerprint=build_fingerprint)
         return dest_folders
\ No newline at end of file
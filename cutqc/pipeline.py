@@ -0,0 +1,260 @@
+import time, threading, queue
+import numpy as np
+
+from cutqc.helper_fun import get_dirname
+from cutqc.evaluator import simulate_subcircuit
+from cutqc.post_process import get_csr_row
+from cutqc.verify import get_subcircuit_out_qubits, get_subcircuit_output_qubits, get_marginal
+from cutqc.build_kernel import build_terms, sum_outputs
+
+def attribute_shots(cutqc,subcircuit_results,eval_mode,all_subcircuit_entries_sampled,output_qubits=None):
+    '''
+    Attribute the shots into respective subcircuit entries
+    cutqc: the CutQC evaluating its source_folders
+    output_qubits: marginalize the subcircuit results over the other qubits first
+    '''
+    row_format = '{:<15} {:<15} {:<25} {:<30}'
+    if cutqc.verbose:
+        print('--> Attribute shots',flush=True)
+        print(row_format.format('circuit_name','subcircuit_idx','subcircuit_instance_idx','coefficient, subcircuit_entry_idx'),flush=True)
+    for source_folder in cutqc.source_folders:
+        ctr = 0
+        subcircuit_entry_probs = {}
+        cut_solution = cutqc._load(folder=source_folder,name='cut_solution')
+        subcircuit_instances_idx = cutqc._load(folder=source_folder,name='subcircuit_instances_idx')
+        subcircuit_instance_attribution = {subcircuit_idx:cutqc._load(folder=source_folder,name='subcircuit_instance_attribution_%d'%subcircuit_idx)
+        for subcircuit_idx in range(len(cut_solution['subcircuits']))}
+        max_subcircuit_qubit = cut_solution['max_subcircuit_qubit']
+        circuit_name = cut_solution['circuit_name']
+        subcircuit_entries_sampled = {subcircuit_idx:set(subcircuit_entry_indices.tolist())
+        for subcircuit_idx, subcircuit_entry_indices in all_subcircuit_entries_sampled[source_folder].items()}
+        eval_folder = get_dirname(circuit_name=circuit_name,max_subcircuit_qubit=max_subcircuit_qubit,
+        eval_mode=eval_mode,num_threads=None,mem_limit=None,field='evaluator')
+        if output_qubits is not None:
+            subcircuit_out_qubits = get_subcircuit_output_qubits(full_circuit=cut_solution['circuit'],
+            complete_path_map=cut_solution['complete_path_map'],subcircuits=cut_solution['subcircuits'])
+
+        for key in subcircuit_results[source_folder]:
+            ctr += 1
+            subcircuit_idx, init, meas = key
+            subcircuit_instance_idx = subcircuit_instances_idx[subcircuit_idx][(init,meas)]
+            subcircuit_instance_prob = subcircuit_results[source_folder][key]
+            if output_qubits is not None:
+                subcircuit_instance_prob = get_marginal(prob=subcircuit_instance_prob,prob_qubits=subcircuit_out_qubits[subcircuit_idx],output_qubits=output_qubits)
+            attributions = get_csr_row(csr=subcircuit_instance_attribution[subcircuit_idx],row_idx=subcircuit_instance_idx,key='entry_indices')
+            if cutqc.verbose and ctr<=10:
+                print(row_format.format(circuit_name,subcircuit_idx,subcircuit_instance_idx,str(attributions)[:30]),flush=True)
+
+            for item in attributions:
+                coefficient, subcircuit_entry_idx = item
+                if subcircuit_entry_idx not in subcircuit_entries_sampled[subcircuit_idx]:
+                    continue
+                subcircuit_entry_prob_key = (eval_folder,subcircuit_idx,subcircuit_entry_idx)
+                if subcircuit_entry_prob_key in subcircuit_entry_probs:
+                    subcircuit_entry_probs[subcircuit_entry_prob_key] += coefficient*subcircuit_instance_prob
+                else:
+                    subcircuit_entry_probs[subcircuit_entry_prob_key] = coefficient*subcircuit_instance_prob
+        # One (#entries, 2^effective) matrix per subcircuit, rows in ascending subcircuit_entry_idx
+        for subcircuit_idx in range(len(cut_solution['subcircuits'])):
+            subcircuit_entry_indices = sorted([key[2] for key in subcircuit_entry_probs if key[1]==subcircuit_idx])
+            probs = np.array([subcircuit_entry_probs[(eval_folder,subcircuit_idx,subcircuit_entry_idx)] for subcircuit_entry_idx in subcircuit_entry_indices],dtype=np.float64)
+            cutqc._save(folder=eval_folder,name='subcircuit_entry_probs_%d'%subcircuit_idx,
+            value={'entry_indices':np.array(subcircuit_entry_indices,dtype=np.int64),'probs':probs},
+            metadata={'eval_mode':eval_mode,'precision':'float64'},memoize=False)
+        if cutqc.verbose:
+            print('... Total %d subcircuit results attributed\n'%ctr,flush=True)
+
+def run_pipeline(cutqc, circ_dict, eval_mode, all_subcircuit_entries_sampled, eval_fingerprints, mem_limit, num_threads, keep_raw_order=False, output_qubits=None):
+    '''
+    Run, attribute and build concurrently
+    A thread simulates the subcircuits while this thread attributes their results.
+    A subcircuit entry is complete once all its subcircuit instances are attributed,
+    a summation term is built by one of num_threads build threads once all its subcircuit entries are complete.
+    cutqc: the CutQC evaluating its source_folders
+    Returns dest_folders[source_folder]
+    '''
+    if eval_mode!='sv' and eval_mode!='qasm' and eval_mode!='runtime':
+        raise NotImplementedError
+    if cutqc.verbose:
+        print('--> Pipeline',flush=True)
+        print('%d subcircuits to run, %d build threads'%(len(circ_dict),num_threads),flush=True)
+    begin = time.time()
+    pipeline_states = {}
+    for source_folder in cutqc.source_folders:
+        cut_solution = cutqc._load(folder=source_folder,name='cut_solution')
+        circuit_name = cut_solution['circuit_name']
+        eval_folder = cutqc._get_eval_folder(source_folder=source_folder,eval_mode=eval_mode)
+        summation_terms = cutqc._load_summation_terms(source_folder=source_folder)
+        smart_order = summation_terms.smart_order
+        summation_terms_sampled = cutqc._load(folder=eval_folder,name='summation_terms_sampled')
+        terms = summation_terms.get_rows(summation_term_indices=summation_terms_sampled['summation_term_idx'])
+        subcircuit_entries_sampled = all_subcircuit_entries_sampled[source_folder]
+        raw_qubit_order = get_subcircuit_out_qubits(full_circuit=cut_solution['circuit'],complete_path_map=cut_solution['complete_path_map'],
+        subcircuits=cut_solution['subcircuits'],smart_order=smart_order,output_qubits=output_qubits)
+        subcircuit_out_qubits = get_subcircuit_output_qubits(full_circuit=cut_solution['circuit'],
+        complete_path_map=cut_solution['complete_path_map'],subcircuits=cut_solution['subcircuits'])
+        pipeline_state = {'source_folder':source_folder,'eval_folder':eval_folder,'cut_solution':cut_solution,
+        'num_summation_terms':len(summation_terms),'smart_order':smart_order,'raw_qubit_order':raw_qubit_order,
+        'subcircuit_out_qubits':subcircuit_out_qubits,'subcircuit_entries_sampled':subcircuit_entries_sampled,
+        'subcircuit_instances_idx':cutqc._load(folder=source_folder,name='subcircuit_instances_idx'),
+        'subcircuit_instance_attribution':{},'entry_rows':{},'entry_probs':{},'entry_probs_float32':[],
+        'pending_attributions':{},'term_indices':{},
+        'pending_entries':np.full(len(terms),len(smart_order),dtype=np.int64),
+        'term_rows':np.zeros(terms.shape,dtype=np.int64),
+        'weights':0.5**len(cut_solution['positions'])*summation_terms_sampled['frequency']/summation_terms_sampled['sampling_prob'],
+        'build_outputs':[]}
+        for subcircuit_ctr, subcircuit_idx in enumerate(smart_order):
+            subcircuit_entry_indices = subcircuit_entries_sampled[subcircuit_idx]
+            subcircuit_entries = cutqc._load(folder=source_folder,name='subcircuit_entries_%d'%subcircuit_idx)
+            pipeline_state['subcircuit_instance_attribution'][subcircuit_idx] = cutqc._load(folder=source_folder,name='subcircuit_instance_attribution_%d'%subcircuit_idx)
+            pipeline_state['entry_rows'][subcircuit_idx] = {subcircuit_entry_idx:row for row, subcircuit_entry_idx in enumerate(subcircuit_entry_indices.tolist())}
+            num_effective = len([qubit for qubit in subcircuit_out_qubits[subcircuit_idx] if output_qubits is None or qubit in output_qubits])
+            pipeline_state['entry_probs'][subcircuit_idx] = np.zeros((len(subcircuit_entry_indices),2**num_effective),dtype=np.float64)
+            pipeline_state['entry_probs_float32'].append(np.zeros((len(subcircuit_entry_indices),2**num_effective),dtype=np.float32))
+            # The attribution is the transpose of subcircuit_entries, so an entry is attributed once per item of its row
+            pipeline_state['pending_attributions'][subcircuit_idx] = np.diff(subcircuit_entries['indptr'])[subcircuit_entry_indices]
+            pipeline_state['term_rows'][:,subcircuit_ctr] = np.searchsorted(subcircuit_entry_indices,terms[:,subcircuit_ctr])
+            # Sampled terms of every entry, grouped by row
+            term_order = np.argsort(pipeline_state['term_rows'][:,subcircuit_ctr],kind='stable')
+            term_bounds = np.searchsorted(pipeline_state['term_rows'][term_order,subcircuit_ctr],np.arange(len(subcircuit_entry_indices)+1))
+            pipeline_state['term_indices'][subcircuit_idx] = (term_order,term_bounds)
+        pipeline_states[source_folder] = pipeline_state
+
+    subcircuit_queue = queue.Queue()
+    build_queue = queue.Queue()
+    errors = []
+    stopped = threading.Event()
+    def run_subcircuits():
+        try:
+            for key in circ_dict:
+                if stopped.is_set():
+                    break
+                subcircuit_queue.put((key,simulate_subcircuit(subcircuit_info=circ_dict[key],eval_mode=eval_mode,result_cache=cutqc.result_cache,seed=cutqc.seed)))
+        except Exception as error:
+            errors.append(error)
+        subcircuit_queue.put(None)
+    def build_summation_terms():
+        # One float32 output per circuit and thread, the kernel releases the GIL
+        build_outputs = {}
+        while True:
+            item = build_queue.get()
+            if item is None:
+                break
+            source_folder, term_indices = item
+            pipeline_state = pipeline_states[source_folder]
+            if stopped.is_set() or len(errors)>0:
+                continue
+            try:
+                if source_folder not in build_outputs:
+                    build_outputs[source_folder] = np.zeros(2**len(pipeline_state['raw_qubit_order']),dtype=np.float32)
+                    pipeline_state['build_outputs'].append(build_outputs[source_folder])
+                build_terms(entry_probs=pipeline_state['entry_probs_float32'],term_rows=pipeline_state['term_rows'][term_indices],
+                weights=pipeline_state['weights'][term_indices],reconstructed_prob=build_outputs[source_folder])
+            except Exception as error:
+                errors.append(error)
+    def complete_entry(source_folder, subcircuit_idx, row):
+        # Publish the entry to the build threads and queue the summation terms it completes
+        pipeline_state = pipeline_states[source_folder]
+        subcircuit_ctr = pipeline_state['smart_order'].index(subcircuit_idx)
+        pipeline_state['entry_probs_float32'][subcircuit_ctr][row] = pipeline_state['entry_probs'][subcircuit_idx][row]
+        term_order, term_bounds = pipeline_state['term_indices'][subcircuit_idx]
+        term_indices = term_order[term_bounds[row]:term_bounds[row+1]]
+        pipeline_state['pending_entries'][term_indices] -= 1
+        ready_term_indices = term_indices[pipeline_state['pending_entries'][term_indices]==0]
+        if len(ready_term_indices)>0:
+            for term_batch in np.array_split(ready_term_indices,min(num_threads,len(ready_term_indices))):
+                build_queue.put((source_folder,term_batch))
+
+    build_threads = [threading.Thread(target=build_summation_terms) for rank in range(num_threads)]
+    for build_thread in build_threads:
+        build_thread.start()
+    run_thread = threading.Thread(target=run_subcircuits)
+    ctr = 0
+    try:
+        # Entries without any attribution are complete from the start
+        for source_folder in pipeline_states:
+            for subcircuit_idx in pipeline_states[source_folder]['smart_order']:
+                for row in np.flatnonzero(pipeline_states[source_folder]['pending_attributions'][subcircuit_idx]==0):
+                    complete_entry(source_folder=source_folder,subcircuit_idx=subcircuit_idx,row=row)
+        run_thread.start()
+        while True:
+            item = subcircuit_queue.get()
+            if item is None:
+                break
+            key, subcircuit_result = item
+            # Fan the results out to every owner of this instance
+            for owner in circ_dict[key]['owners']:
+                source_folder, subcircuit_idx, init, meas = owner
+                pipeline_state = pipeline_states[source_folder]
+                for m in meas:
+                    ctr += 1
+                    subcircuit_instance_idx = pipeline_state['subcircuit_instances_idx'][subcircuit_idx][(init,m)]
+                    subcircuit_instance_prob = subcircuit_result[m]
+                    if output_qubits is not None:
+                        subcircuit_instance_prob = get_marginal(prob=subcircuit_instance_prob,prob_qubits=pipeline_state['subcircuit_out_qubits'][subcircuit_idx],output_qubits=output_qubits)
+                    attributions = get_csr_row(csr=pipeline_state['subcircuit_instance_attribution'][subcircuit_idx],row_idx=subcircuit_instance_idx,key='entry_indices')
+                    for coefficient, subcircuit_entry_idx in attributions:
+                        row = pipeline_state['entry_rows'][subcircuit_idx].get(subcircuit_entry_idx,None)
+                        if row is None:
+                            continue
+                        pipeline_state['entry_probs'][subcircuit_idx][row] += coefficient*subcircuit_instance_prob
+                        pipeline_state['pending_attributions'][subcircuit_idx][row] -= 1
+                        if pipeline_state['pending_attributions'][subcircuit_idx][row]==0:
+                            complete_entry(source_folder=source_folder,subcircuit_idx=subcircuit_idx,row=row)
+    except BaseException:
+        stopped.set()
+        raise
+    finally:
+        if run_thread.is_alive():
+            run_thread.join()
+        for build_thread in build_threads:
+            build_queue.put(None)
+        for build_thread in build_threads:
+            build_thread.join()
+    if len(errors)>0:
+        raise errors[0]
+    if cutqc.verbose and cutqc.result_cache is not None:
+        cache_stats = cutqc.result_cache.get_stats()
+        print('Result cache: %d hits, %d misses, %d evictions, hit rate = %.2f'%(
+            cache_stats['hits'],cache_stats['misses'],cache_stats['evictions'],cache_stats['hit_rate']),flush=True)
+
+    dest_folders = {}
+    for source_folder in pipeline_states:
+        pipeline_state = pipeline_states[source_folder]
+        circuit_name = pipeline_state['cut_solution']['circuit_name']
+        if np.any(pipeline_state['pending_entries']>0):
+            raise Exception('%s pipeline finished with %d summation terms not built'%(circuit_name,np.sum(pipeline_state['pending_entries']>0)))
+        eval_folder = pipeline_state['eval_folder']
+        for subcircuit_idx in pipeline_state['smart_order']:
+            cutqc._save(folder=eval_folder,name='subcircuit_entry_probs_%d'%subcircuit_idx,
+            value={'entry_indices':np.array(pipeline_state['subcircuit_entries_sampled'][subcircuit_idx],dtype=np.int64),'probs':pipeline_state['entry_probs'][subcircuit_idx]},
+            metadata={'eval_mode':eval_mode,'precision':'float64'},memoize=False)
+        cutqc._set_stage_fingerprint(folder=eval_folder,stage='evaluate',fingerprint=eval_fingerprints[source_folder])
+
+        cut_solution = pipeline_state['cut_solution']
+        raw_qubit_order = pipeline_state['raw_qubit_order']
+        if keep_raw_order:
+            qubit_order = raw_qubit_order
+        else:
+            qubit_order = sorted(raw_qubit_order,reverse=True)
+        reconstructed_prob = sum_outputs(raw_probs=pipeline_state['build_outputs'],raw_qubit_order=None if keep_raw_order else raw_qubit_order)
+        dest_folder = get_dirname(circuit_name=circuit_name,max_subcircuit_qubit=cut_solution['max_subcircuit_qubit'],
+        eval_mode=eval_mode,num_threads=num_threads,mem_limit=mem_limit,field='build')
+        checkpoint_fingerprint, build_fingerprint = cutqc._get_build_fingerprints(eval_folder=eval_folder,num_threads=num_threads,mem_limit=mem_limit,
+        keep_raw_order=keep_raw_order,tolerance=None)
+        cutqc._reset_folder(folder=dest_folder)
+        num_summation_terms_sampled = len(pipeline_state['weights'])
+        cutqc._save(folder=dest_folder,name='build_output',value={'reconstructed_prob':reconstructed_prob,
+            'eval_mode':eval_mode,
+            'qubit_order':qubit_order,
+            'num_summation_terms_sampled':num_summation_terms_sampled,
+            'num_summation_terms_built':num_summation_terms_sampled,
+            'remaining_bound':0,
+            'num_summation_terms':pipeline_state['num_summation_terms']
+            },memoize=False)
+        cutqc._set_stage_fingerprint(folder=dest_folder,stage='build',fingerprint=build_fingerprint)
+        dest_folders[source_folder] = dest_folder
+    if cutqc.verbose:
+        print('Pipelined %d subcircuit results and %d summation terms in %.3e seconds'%(
+            ctr,sum([len(pipeline_states[source_folder]['weights']) for source_folder in pipeline_states]),time.time()-begin),flush=True)
+    return dest_folders
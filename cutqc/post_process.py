@@ -1,51 +1,169 @@
 import itertools, copy, pickle
+import numpy as np
 from qiskit_helper_functions.non_ibmq_functions import read_dict
 
-def find_init_meas(combination, O_rho_pairs, subcircuits):
-    # print('Finding init_meas for',combination)
-    all_init_meas = {}
-    for subcircuit_idx, subcircuit in enumerate(subcircuits):
-        init = ['zero' for q in range(subcircuit.num_qubits)]
-        meas = ['comp' for q in range(subcircuit.num_qubits)]
-        all_init_meas[subcircuit_idx] = [init,meas]
-    for s, pair in zip(combination, O_rho_pairs):
-        O_qubit, rho_qubit = pair
-        O_qubit_subcircuit_qubits = subcircuits[O_qubit['subcircuit_idx']].qubits
-        rho_qubit_subcircuit_qubits = subcircuits[rho_qubit['subcircuit_idx']].qubits
-        all_init_meas[rho_qubit['subcircuit_idx']][0][rho_qubit_subcircuit_qubits.index(rho_qubit['subcircuit_qubit'])] = s
-        all_init_meas[O_qubit['subcircuit_idx']][1][O_qubit_subcircuit_qubits.index(O_qubit['subcircuit_qubit'])] = s
-    # print(all_init_meas)
-    for subcircuit_idx in all_init_meas:
-        init = all_init_meas[subcircuit_idx][0]
-        init_combinations = []
+
+class SummationTerms:
+    '''
+    Lazy, indexable sequence of the 4^K summation terms
+    summation_terms[summation_term_idx] = [(subcircuit_idx, subcircuit_entry_idx), ...] in smart_order
+
+    The cut bases of a summation term are the base-4 digits of summation_term_idx,
+    with the first cut being the most significant digit.
+    A subcircuit entry only depends on the bases of the cuts incident to the subcircuit,
+    so subcircuit_entry_idx is the number formed by those digits.
+    '''
+    def __init__(self, num_cuts, smart_order, subcircuit_cuts):
+        self.num_cuts = num_cuts
+        self.smart_order = smart_order
+        self.subcircuit_cuts = subcircuit_cuts
+
+    def __len__(self):
+        return 4**self.num_cuts
+
+    def __iter__(self):
+        for summation_term_idx in range(len(self)):
+            yield self.get_summation_term(summation_term_idx)
+
+    def __getitem__(self, summation_term_idx):
+        if isinstance(summation_term_idx,slice):
+            return [self.get_summation_term(x) for x in range(*summation_term_idx.indices(len(self)))]
+        if summation_term_idx<0:
+            summation_term_idx += len(self)
+        if summation_term_idx<0 or summation_term_idx>=len(self):
+            raise IndexError('summation_term_idx %d out of range for %d summation terms'%(summation_term_idx,len(self)))
+        return self.get_summation_term(summation_term_idx)
+
+    def get_summation_term(self, summation_term_idx):
+        cut_bases = [(summation_term_idx>>(2*(self.num_cuts-1-cut_idx)))&3 for cut_idx in range(self.num_cuts)]
+        summation_term = []
+        for subcircuit_idx in self.smart_order:
+            subcircuit_entry_idx = 0
+            for cut_idx in self.subcircuit_cuts[subcircuit_idx]:
+                subcircuit_entry_idx = 4*subcircuit_entry_idx + cut_bases[cut_idx]
+            summation_term.append((subcircuit_idx,subcircuit_entry_idx))
+        return summation_term
+
+    def get_array(self, start=0, stop=None):
+        '''
+        Summation terms [start, stop) as a (#terms, #subcircuits) int32 matrix
+        array[i][j] = subcircuit_entry_idx of subcircuit smart_order[j] in summation term start+i
+        '''
+        if stop is None:
+            stop = len(self)
+        return self.get_rows(summation_term_indices=np.arange(start,stop,dtype=np.int64))
+
+    def get_rows(self, summation_term_indices):
+        '''
+        Summation terms at summation_term_indices as a (#indices, #subcircuits) int32 matrix, see get_array
+        '''
+        summation_term_indices = np.asarray(summation_term_indices,dtype=np.int64)
+        cut_bases = [(summation_term_indices>>(2*(self.num_cuts-1-cut_idx)))&3 for cut_idx in range(self.num_cuts)]
+        array = np.zeros((len(summation_term_indices),len(self.smart_order)),dtype=np.int32)
+        for subcircuit_ctr, subcircuit_idx in enumerate(self.smart_order):
+            for cut_idx in self.subcircuit_cuts[subcircuit_idx]:
+                array[:,subcircuit_ctr] = 4*array[:,subcircuit_ctr] + cut_bases[cut_idx]
+        return array
+
+    def get_record(self):
+        '''
+        The structure saved in place of the 4^K summation terms, see from_record
+        subcircuit_cuts[subcircuit_idx] = indices of the cuts incident to the subcircuit
+        '''
+        return {'num_cuts':self.num_cuts,'smart_order':np.array(self.smart_order,dtype=np.int32),
+        'subcircuit_cuts':[list(self.subcircuit_cuts[subcircuit_idx]) for subcircuit_idx in range(len(self.smart_order))]}
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(num_cuts=int(record['num_cuts']),smart_order=record['smart_order'].tolist(),subcircuit_cuts=record['subcircuit_cuts'])
+
+class SummationTermRows:
+    '''
+    Lazy (4^K, #subcircuits) term_rows of every summation term, see query.get_reconstruction_terms
+    Valid when every subcircuit entry is attributed, the row of an entry is then its subcircuit_entry_idx.
+    Only slices of whole terms are computed, as read a chunk at a time by query.build_prob and query.get_expectations.
+    '''
+    def __init__(self, summation_terms):
+        self.summation_terms = summation_terms
+
+    def __len__(self):
+        return len(self.summation_terms)
+
+    def __getitem__(self, term_slice):
+        if not isinstance(term_slice,slice) or term_slice.step not in [None,1]:
+            raise TypeError('SummationTermRows only supports contiguous slices of terms')
+        start, stop, _ = term_slice.indices(len(self))
+        return self.summation_terms.get_array(start=start,stop=max(start,stop)).astype(np.int64)
+
+def find_init_meas(subcircuit_combination, subcircuit_idx, subcircuit_cuts, O_rho_pairs, subcircuits):
+    '''
+    Find the init, meas of one subcircuit given the bases of its incident cuts
+    subcircuit_combination[i] is the basis of cut subcircuit_cuts[subcircuit_idx][i]
+    '''
+    subcircuit = subcircuits[subcircuit_idx]
+    init = ['zero' for q in range(subcircuit.num_qubits)]
+    meas = ['comp' for q in range(subcircuit.num_qubits)]
+    for s, cut_idx in zip(subcircuit_combination, subcircuit_cuts[subcircuit_idx]):
+        O_qubit, rho_qubit = O_rho_pairs[cut_idx]
+        if rho_qubit['subcircuit_idx']==subcircuit_idx:
+            init[subcircuit.qubits.index(rho_qubit['subcircuit_qubit'])] = s
+        if O_qubit['subcircuit_idx']==subcircuit_idx:
+            meas[subcircuit.qubits.index(O_qubit['subcircuit_qubit'])] = s
+    init_combinations = []
+    for idx, x in enumerate(init):
+        if x == 'zero':
+            init_combinations.append(['zero'])
+        elif x == 'I':
+            init_combinations.append(['+zero','+one'])
+        elif x == 'X':
+            init_combinations.append(['2plus','-zero','-one'])
+        elif x == 'Y':
+            init_combinations.append(['2plusI','-zero','-one'])
+        elif x == 'Z':
+            init_combinations.append(['+zero','-one'])
+        else:
+            raise Exception('Illegal initilization symbol :',x)
+    init_combinations = list(itertools.product(*init_combinations))
+    subcircuit_init_meas = []
+    for init in init_combinations:
+        subcircuit_init_meas.append((tuple(init),tuple(meas)))
+    return subcircuit_init_meas
+
+def get_kronecker_term(subcircuit_init_meas, subcircuit_instances_idx):
+    '''
+    kronecker_term : ((coefficient,subcircuit_instance_idx), ...)
+    '''
+    kronecker_term = ()
+    for init_meas in subcircuit_init_meas:
+        coefficient = 1
+        init = list(init_meas[0])
         for idx, x in enumerate(init):
             if x == 'zero':
-                init_combinations.append(['zero'])
-            elif x == 'I':
-                init_combinations.append(['+zero','+one'])
-            elif x == 'X':
-                init_combinations.append(['2plus','-zero','-one'])
-            elif x == 'Y':
-                init_combinations.append(['2plusI','-zero','-one'])
-            elif x == 'Z':
-                init_combinations.append(['+zero','-one'])
+                continue
+            elif x == '+zero':
+                init[idx] = 'zero'
+            elif x == '+one':
+                init[idx] = 'one'
+            elif x == '2plus':
+                init[idx] = 'plus'
+                coefficient *= 2
+            elif x == '-zero':
+                init[idx] = 'zero'
+                coefficient *= -1
+            elif x == '-one':
+                init[idx] = 'one'
+                coefficient *= -1
+            elif x =='2plusI':
+                init[idx] = 'plusI'
+                coefficient *= 2
             else:
                 raise Exception('Illegal initilization symbol :',x)
-        init_combinations = list(itertools.product(*init_combinations))
-        meas = all_init_meas[subcircuit_idx][1]
-        meas_combinations = []
-        for x in meas:
-            meas_combinations.append(['%s'%x])
-        meas_combinations = list(itertools.product(*meas_combinations))
-        subcircuit_init_meas = []
-        for init in init_combinations:
-            for meas in meas_combinations:
-                subcircuit_init_meas.append((tuple(init),tuple(meas)))
-        all_init_meas[subcircuit_idx] = subcircuit_init_meas
-    # [print('subcircuit_%d'%subcircuit_idx,all_init_meas[subcircuit_idx]) for subcircuit_idx in all_init_meas]
-    return all_init_meas
-
-def get_combinations(complete_path_map):
+        meas = list(init_meas[1])
+        subcircuit_instance_idx = subcircuit_instances_idx[tuple(init),tuple(meas)]
+        kronecker_term += ((coefficient,subcircuit_instance_idx),)
+    return kronecker_term
+
+def get_O_rho_pairs(complete_path_map):
     O_rho_pairs = []
     for input_qubit in complete_path_map:
         path = complete_path_map[input_qubit]
@@ -54,88 +172,108 @@ def get_combinations(complete_path_map):
                 O_qubit_tuple = item
                 rho_qubit_tuple = path[path_ctr+1]
                 O_rho_pairs.append((O_qubit_tuple, rho_qubit_tuple))
-    basis = ['I','X','Y','Z']
-    combinations = list(itertools.product(basis,repeat=len(O_rho_pairs)))
-    return O_rho_pairs, combinations
+    return O_rho_pairs
+
+def get_subcircuit_cuts(O_rho_pairs, num_subcircuits):
+    '''
+    subcircuit_cuts[subcircuit_idx] = indices of the cuts incident to the subcircuit, ascending
+    '''
+    subcircuit_cuts = {subcircuit_idx:[] for subcircuit_idx in range(num_subcircuits)}
+    for cut_idx, pair in enumerate(O_rho_pairs):
+        O_qubit, rho_qubit = pair
+        subcircuit_cuts[O_qubit['subcircuit_idx']].append(cut_idx)
+        subcircuit_cuts[rho_qubit['subcircuit_idx']].append(cut_idx)
+    return subcircuit_cuts
 
 def generate_summation_terms(full_circuit, subcircuits, complete_path_map, subcircuit_instances_idx, counter):
     '''
     Final CutQC reconstruction result = Sum(summation_terms)
 
-    summation_terms (list) : [summation_term_0, summation_term_1, ...] --> 4^K elements
+    summation_terms (SummationTerms) : [summation_term_0, summation_term_1, ...] --> 4^K elements, computed lazily
     
     summation_term[subcircuit_idx] = subcircuit_entry_idx
     E.g. summation_term = {0:0,1:13,2:7} = Kron(subcircuit_0_entry_0, subcircuit_1_entry_13, subcircuit_2_entry_7)
 
-    subcircuit_entries[subcircuit_idx][subcircuit_entry_idx] = kronecker_term
-    subcircuit_entries[subcircuit_idx][kronecker_term] = subcircuit_entry_idx
+    subcircuit_entries[subcircuit_idx] : CSR table of the kronecker_terms, one row per subcircuit_entry_idx
     kronecker_term : ((coefficient,subcircuit_instance_idx), ...)
+    = zip(coefficients[indptr[subcircuit_entry_idx]:indptr[subcircuit_entry_idx+1]],
+    instance_indices[indptr[subcircuit_entry_idx]:indptr[subcircuit_entry_idx+1]])
 
-    subcircuit_instance_attribution[subcircuit_idx][subcircuit_instance_idx] = [coefficient,subcircuit_entry_idx]
+    subcircuit_instance_attribution[subcircuit_idx] : CSR table, one row per subcircuit_instance_idx
+    (coefficient,subcircuit_entry_idx) = zip(coefficients[indptr[i]:indptr[i+1]],entry_indices[indptr[i]:indptr[i+1]])
     Add coefficient*subcircuit_instance to subcircuit_entry
     '''
-    summation_terms = []
-    subcircuit_entries = {subcircuit_idx:{} for subcircuit_idx in range(len(subcircuits))}
-    O_rho_pairs, combinations = get_combinations(complete_path_map=complete_path_map)
+    subcircuit_entries = {}
+    subcircuit_instance_attribution = {}
+    O_rho_pairs = get_O_rho_pairs(complete_path_map=complete_path_map)
+    subcircuit_cuts = get_subcircuit_cuts(O_rho_pairs=O_rho_pairs,num_subcircuits=len(subcircuits))
     smart_order = sorted(range(len(subcircuits)),key=lambda subcircuit_idx:counter[subcircuit_idx]['effective'])
-    for i, combination in enumerate(combinations):
-        # print('%d/%d combinations:'%(i+1,len(combinations)),combination)
-        summation_term = []
-        all_init_meas = find_init_meas(combination, O_rho_pairs, subcircuits)
-        for subcircuit_idx in smart_order:
-            kronecker_term = ()
-            for init_meas in all_init_meas[subcircuit_idx]:
-                # print('Subcircuit_%d init_meas ='%subcircuit_idx,init_meas)
-                coefficient = 1
-                init = list(init_meas[0])
-                for idx, x in enumerate(init):
-                    if x == 'zero':
-                        continue
-                    elif x == '+zero':
-                        init[idx] = 'zero'
-                    elif x == '+one':
-                        init[idx] = 'one'
-                    elif x == '2plus':
-                        init[idx] = 'plus'
-                        coefficient *= 2
-                    elif x == '-zero':
-                        init[idx] = 'zero'
-                        coefficient *= -1
-                    elif x == '-one':
-                        init[idx] = 'one'
-                        coefficient *= -1
-                    elif x =='2plusI':
-                        init[idx] = 'plusI'
-                        coefficient *= 2
-                    else:
-                        raise Exception('Illegal initilization symbol :',x)
-                meas = list(init_meas[1])
-                subcircuit_instance_idx = subcircuit_instances_idx[subcircuit_idx][tuple(init),tuple(meas)]
-                kronecker_term += ((coefficient,subcircuit_instance_idx),)
-            if kronecker_term in subcircuit_entries[subcircuit_idx]:
-                subcircuit_entry_idx = subcircuit_entries[subcircuit_idx][kronecker_term]
-            else:
-                subcircuit_entry_idx = int(len(subcircuit_entries[subcircuit_idx])/2)
-                subcircuit_entries[subcircuit_idx][subcircuit_entry_idx] = kronecker_term
-                subcircuit_entries[subcircuit_idx][kronecker_term] = subcircuit_entry_idx
-            summation_term.append((subcircuit_idx,subcircuit_entry_idx))
-        #     print('subcircuit_{:d} kronecker_term = {} --> record as entry {:d}'.format(subcircuit_idx,kronecker_term,subcircuit_entry_idx))
-        # print('summation term =',summation_term)
-        # print()
-        summation_terms.append(summation_term)
-    subcircuit_instance_attribution = {subcircuit_idx:{} for subcircuit_idx in range(len(subcircuits))}
-    for subcircuit_idx in subcircuit_entries:
-        for subcircuit_entry_idx in subcircuit_entries[subcircuit_idx]:
-            if type(subcircuit_entry_idx) is int:
-                kronecker_term = subcircuit_entries[subcircuit_idx][subcircuit_entry_idx]
-                for item in kronecker_term:
-                    coefficient, subcircuit_instance_idx = item
-                    if subcircuit_instance_idx in subcircuit_instance_attribution[subcircuit_idx]:
-                        subcircuit_instance_attribution[subcircuit_idx][subcircuit_instance_idx].append((coefficient,subcircuit_entry_idx))
-                    else:
-                        subcircuit_instance_attribution[subcircuit_idx][subcircuit_instance_idx] = [(coefficient,subcircuit_entry_idx)]
+    for subcircuit_idx in range(len(subcircuits)):
+        indptr = [0]
+        instance_indices = []
+        coefficients = []
+        # Entries are numbered by the bases of the incident cuts, first cut most significant
+        for subcircuit_combination in itertools.product(['I','X','Y','Z'],repeat=len(subcircuit_cuts[subcircuit_idx])):
+            subcircuit_init_meas = find_init_meas(subcircuit_combination=subcircuit_combination,subcircuit_idx=subcircuit_idx,
+            subcircuit_cuts=subcircuit_cuts,O_rho_pairs=O_rho_pairs,subcircuits=subcircuits)
+            kronecker_term = get_kronecker_term(subcircuit_init_meas=subcircuit_init_meas,subcircuit_instances_idx=subcircuit_instances_idx[subcircuit_idx])
+            for coefficient, subcircuit_instance_idx in kronecker_term:
+                coefficients.append(coefficient)
+                instance_indices.append(subcircuit_instance_idx)
+            indptr.append(len(instance_indices))
+        subcircuit_entries[subcircuit_idx] = {
+            'indptr':np.array(indptr,dtype=np.int64),
+            'instance_indices':np.array(instance_indices,dtype=np.int32),
+            'coefficients':np.array(coefficients,dtype=np.float64)}
+        subcircuit_instance_attribution[subcircuit_idx] = transpose_csr(csr=subcircuit_entries[subcircuit_idx],num_columns=len(subcircuit_instances_idx[subcircuit_idx]))
+    summation_terms = SummationTerms(num_cuts=len(O_rho_pairs),smart_order=smart_order,subcircuit_cuts=subcircuit_cuts)
     return summation_terms, subcircuit_entries, subcircuit_instance_attribution
 
+def get_summation_term_magnitudes(subcircuit_entry_probs, smart_order, terms, weights):
+    '''
+    L1 norm bound of every summation term = |weight| * product of the L1 norms of its subcircuit entries
+    subcircuit_entry_probs[subcircuit_idx] = {'entry_indices', 'probs'} as saved by pipeline.attribute_shots
+    terms: (#terms, #subcircuits) subcircuit_entry_idx matrix, columns in smart_order
+    The L1 distance between a partial and the full reconstruction is at most the sum over the terms left out.
+    '''
+    magnitudes = np.abs(np.asarray(weights,dtype=np.float64))
+    for subcircuit_ctr, subcircuit_idx in enumerate(smart_order):
+        entry_norms = np.abs(subcircuit_entry_probs[subcircuit_idx]['probs']).sum(axis=1)
+        magnitudes *= entry_norms[np.searchsorted(subcircuit_entry_probs[subcircuit_idx]['entry_indices'],terms[:,subcircuit_ctr])]
+    return magnitudes
+
+def get_entry_matrix(csr, num_instances):
+    '''
+    Dense (#entries, #instances) coefficient matrix of a subcircuit_entries CSR table
+    subcircuit entry probabilities = matrix @ (#instances, #states) subcircuit instance probabilities
+    '''
+    num_rows = len(csr['indptr'])-1
+    matrix = np.zeros((num_rows,num_instances))
+    row_indices = np.repeat(np.arange(num_rows),np.diff(csr['indptr']))
+    np.add.at(matrix,(row_indices,csr['instance_indices']),csr['coefficients'])
+    return matrix
+
+def transpose_csr(csr, num_columns):
+    '''
+    Turn the subcircuit_entries CSR table (rows = entries, columns = instances)
+    into the subcircuit_instance_attribution CSR table (rows = instances, columns = entries)
+    '''
+    num_rows = len(csr['indptr'])-1
+    row_indices = np.repeat(np.arange(num_rows,dtype=np.int32),np.diff(csr['indptr']))
+    order = np.argsort(csr['instance_indices'],kind='stable')
+    indptr = np.zeros(num_columns+1,dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(csr['instance_indices'],minlength=num_columns))
+    return {'indptr':indptr,
+    'entry_indices':row_indices[order],
+    'coefficients':csr['coefficients'][order]}
+
+def get_csr_row(csr, row_idx, key):
+    '''
+    Returns (coefficient, index) pairs of one row of a CSR table
+    '''
+    row = slice(csr['indptr'][row_idx],csr['indptr'][row_idx+1])
+    return list(zip(csr['coefficients'][row].tolist(),csr[key][row].tolist()))
+
 def distribute_load(total_load,capacities):
     assert total_load<=sum(capacities)
     loads = [0 for x in capacities]
@@ -0,0 +1,251 @@
+import heapq, os
+import numpy as np
+
+from cutqc.helper_fun import get_dirname
+from cutqc.artifact_store import ArtifactStore
+from cutqc.post_process import SummationTerms
+from cutqc.verify import get_subcircuit_output_qubits, reorder_prob
+
+def load_reconstruction_terms(source_folder, eval_mode):
+    '''
+    Load the attributed subcircuit entries of an evaluated cut solution, without building the full output
+    See get_reconstruction_terms
+    '''
+    source_store = ArtifactStore(folder=source_folder)
+    cut_solution = source_store.get(name='cut_solution')
+    eval_store = ArtifactStore(folder=get_dirname(circuit_name=cut_solution['circuit_name'],max_subcircuit_qubit=cut_solution['max_subcircuit_qubit'],
+    eval_mode=eval_mode,num_threads=None,mem_limit=None,field='evaluator'))
+    return get_reconstruction_terms(cut_solution=cut_solution,summation_terms=SummationTerms.from_record(source_store.get(name='summation_terms')),
+    summation_terms_sampled=eval_store.get(name='summation_terms_sampled'),output_qubits=eval_store.get(name='output_qubits'),
+    subcircuit_entry_probs={subcircuit_idx:eval_store.get(name='subcircuit_entry_probs_%d'%subcircuit_idx)
+    for subcircuit_idx in range(len(cut_solution['subcircuits']))})
+
+def get_reconstruction_terms(cut_solution, summation_terms, summation_terms_sampled, output_qubits, subcircuit_entry_probs):
+    '''
+    reconstructed_prob = sum_t weights[t] * Kron(entry_probs[0][term_rows[t,0]], entry_probs[1][term_rows[t,1]], ...)
+    summation_terms: SummationTerms, only the sampled terms are indexed
+    subcircuit_entry_probs[subcircuit_idx] = {'entry_indices': ascending subcircuit_entry_idx, 'probs': attributed probabilities of every entry}
+
+    Returns a dict:
+    entry_probs[j]: (#entries used, 2^effective) matrix of the subcircuit smart_order[j]
+    term_rows: (#terms sampled, #subcircuits) row of every factor in entry_probs
+    weights: 0.5^K * frequency/sampling_prob of every sampled term
+    qubit_order: circuit qubit of every bit of the raw kron order, most significant bit first.
+    Only the output_qubits of evaluate are kept.
+    subcircuit_qubits[j]: circuit qubit of every bit of entry_probs[j], most significant bit first
+    '''
+    smart_order = summation_terms.smart_order
+    terms = summation_terms.get_rows(summation_term_indices=summation_terms_sampled['summation_term_idx'])
+
+    entry_probs = []
+    term_rows = np.zeros(terms.shape,dtype=np.int64)
+    for subcircuit_ctr, subcircuit_idx in enumerate(smart_order):
+        subcircuit_entry_indices, term_rows[:,subcircuit_ctr] = np.unique(terms[:,subcircuit_ctr],return_inverse=True)
+        entry_rows = np.searchsorted(subcircuit_entry_probs[subcircuit_idx]['entry_indices'],subcircuit_entry_indices)
+        entry_probs.append(np.asarray(subcircuit_entry_probs[subcircuit_idx]['probs'][entry_rows],dtype=np.float64))
+    weights = 0.5**len(cut_solution['positions'])*summation_terms_sampled['frequency']/summation_terms_sampled['sampling_prob']
+    subcircuit_out_qubits = get_subcircuit_output_qubits(full_circuit=cut_solution['circuit'],complete_path_map=cut_solution['complete_path_map'],
+    subcircuits=cut_solution['subcircuits'])
+    subcircuit_qubits = [[qubit for qubit in subcircuit_out_qubits[subcircuit_idx] if output_qubits is None or qubit in output_qubits]
+    for subcircuit_idx in smart_order]
+    qubit_order = sum(subcircuit_qubits,[])
+    return {'smart_order':smart_order,'entry_probs':entry_probs,'term_rows':term_rows,
+    'weights':np.asarray(weights,dtype=np.float64),'qubit_order':qubit_order,'subcircuit_qubits':subcircuit_qubits}
+
+def read_build_checkpoint(dest_folder, keep_raw_order=False):
+    '''
+    Latest snapshot of an anytime build, readable while the build runs
+    Returns the partial reconstructed_prob, in the circuit qubit order unless keep_raw_order, and
+    progress = {'num_built': terms built, 'remaining_bound': L1 bound of the distance to the full reconstruction, 'elapsed'}
+    '''
+    checkpoint_info = ArtifactStore(folder=dest_folder).get(name='checkpoint_info')
+    raw_qubit_order = checkpoint_info['raw_qubit_order']
+    reconstructed_prob = np.zeros(2**len(raw_qubit_order),dtype=np.float32)
+    progress = {'num_built':0,'remaining_bound':0.0,'elapsed':0.0}
+    for rank in range(checkpoint_info['num_threads']):
+        progress_file = '%s/checkpoint_%d.txt'%(dest_folder,rank)
+        if not os.path.isfile(progress_file):
+            raise FileNotFoundError('Rank %d has no checkpoint in %s yet'%(rank,dest_folder))
+        num_built, remaining_bound, elapsed, slot = open(progress_file,'r').read().split()
+        reconstructed_prob += np.memmap('%s/checkpoint_%d_%s.bin'%(dest_folder,rank,slot),dtype=np.float32,mode='r',shape=reconstructed_prob.shape)
+        progress['num_built'] += int(num_built)
+        progress['remaining_bound'] += float(remaining_bound)
+        progress['elapsed'] = max(progress['elapsed'],float(elapsed))
+    if not keep_raw_order:
+        reconstructed_prob = raw_to_circuit_prob(prob=reconstructed_prob,qubit_order=raw_qubit_order)
+    return reconstructed_prob, progress
+
+def raw_to_circuit_prob(prob, qubit_order):
+    '''
+    Reorder a raw kron order output to the circuit qubit order
+    Marginal outputs only hold the kept qubits, in ascending significance.
+    '''
+    qubit_ranks = {qubit:rank for rank, qubit in enumerate(sorted(qubit_order))}
+    return reorder_prob(unordered=prob,unordered_qubit=[qubit_ranks[qubit] for qubit in qubit_order])
+
+def build_prob(reconstruction_terms, chunk_size=2**22):
+    '''
+    NumPy build of the raw kron order output, the Kronecker products of a chunk of terms at a time
+    '''
+    entry_probs = reconstruction_terms['entry_probs']
+    term_rows = reconstruction_terms['term_rows']
+    weights = reconstruction_terms['weights']
+    num_states = int(np.prod([entry_probs[subcircuit_ctr].shape[1] for subcircuit_ctr in range(len(entry_probs))]))
+    chunk_len = max(1,chunk_size//num_states)
+    prob = np.zeros(num_states)
+    for start in range(0,len(weights),chunk_len):
+        rows = term_rows[start:start+chunk_len]
+        kron_terms = np.asarray(weights[start:start+chunk_len])[:,None]
+        for subcircuit_ctr in range(len(entry_probs)):
+            factors = entry_probs[subcircuit_ctr][rows[:,subcircuit_ctr]]
+            kron_terms = (kron_terms[:,:,None]*factors[:,None,:]).reshape(len(rows),-1)
+        prob += kron_terms.sum(axis=0)
+    return prob
+
+def raw_to_circuit_states(raw_states, qubit_order):
+    '''
+    Convert states of the raw kron order to the circuit qubit order
+    Marginal states only hold the kept qubits, in ascending significance.
+    '''
+    raw_states = np.asarray(raw_states,dtype=np.int64)
+    num_qubits = len(qubit_order)
+    qubit_ranks = {qubit:rank for rank, qubit in enumerate(sorted(qubit_order))}
+    states = np.zeros(raw_states.shape,dtype=np.int64)
+    for bit_ctr, qubit in enumerate(qubit_order):
+        states |= ((raw_states>>(num_qubits-1-bit_ctr))&1)<<qubit_ranks[qubit]
+    return states
+
+def get_suffix_intervals(reconstruction_terms):
+    '''
+    suffix_intervals[j] = per term lower and upper bounds of the product of the factors j, j+1, ...
+    '''
+    entry_probs = reconstruction_terms['entry_probs']
+    term_rows = reconstruction_terms['term_rows']
+    num_terms = len(term_rows)
+    lower = np.ones(num_terms)
+    upper = np.ones(num_terms)
+    suffix_intervals = [(lower,upper)]
+    for subcircuit_ctr in range(len(entry_probs)-1,-1,-1):
+        factor_lower = entry_probs[subcircuit_ctr].min(axis=1)[term_rows[:,subcircuit_ctr]]
+        factor_upper = entry_probs[subcircuit_ctr].max(axis=1)[term_rows[:,subcircuit_ctr]]
+        products = np.array([factor_lower*lower,factor_lower*upper,factor_upper*lower,factor_upper*upper])
+        lower, upper = products.min(axis=0), products.max(axis=0)
+        suffix_intervals.append((lower,upper))
+    return suffix_intervals[::-1]
+
+def get_children_bounds(prefix, factors, suffix_interval, chunk_size=2**22):
+    '''
+    Upper bound of the probability of every completion of each child prefix
+    prefix: (#terms,) weighted product of the factors fixed so far
+    factors: (#terms, #children) next factor of every term
+    '''
+    lower, upper = suffix_interval
+    num_children = factors.shape[1]
+    chunk_len = max(1,chunk_size//max(1,len(prefix)))
+    bounds = np.zeros(num_children)
+    for start in range(0,num_children,chunk_len):
+        children = prefix[:,None]*factors[:,start:start+chunk_len]
+        bounds[start:start+chunk_len] = np.maximum(children*lower[:,None],children*upper[:,None]).sum(axis=0)
+    return bounds
+
+def find_top_states(reconstruction_terms, k):
+    '''
+    Best-first search for the k most probable states, without building the full output
+    A node fixes the outputs of the first few subcircuits in smart_order.
+    The product of the remaining factors of every term lies in a suffix interval,
+    which bounds the probability of any completion of the node.
+    Children are sorted by their bounds once and pushed lazily, one sibling at a time.
+    Returns states in the circuit qubit order and their probabilities, most probable first.
+    '''
+    entry_probs = reconstruction_terms['entry_probs']
+    term_rows = reconstruction_terms['term_rows']
+    num_subcircuits = len(entry_probs)
+    subcircuit_widths = [int(np.log2(entry_probs[subcircuit_ctr].shape[1])) for subcircuit_ctr in range(num_subcircuits)]
+    suffix_intervals = get_suffix_intervals(reconstruction_terms=reconstruction_terms)
+
+    # expansions[i] = (prefix, depth, raw state prefix, children sorted by bound, their bounds)
+    expansions = []
+    heap = []
+    def expand(prefix, depth, raw_state):
+        factors = entry_probs[depth][term_rows[:,depth]]
+        bounds = get_children_bounds(prefix=prefix,factors=factors,suffix_interval=suffix_intervals[depth+1])
+        order = np.argsort(-bounds,kind='stable')
+        expansions.append((prefix,depth,raw_state,order,bounds[order]))
+        heapq.heappush(heap,(-bounds[order[0]],len(expansions)-1,0))
+
+    expand(prefix=reconstruction_terms['weights'],depth=0,raw_state=0)
+    raw_states = []
+    probabilities = []
+    while len(heap)>0 and len(raw_states)<k:
+        _, expansion_idx, rank = heapq.heappop(heap)
+        prefix, depth, raw_state, order, bounds = expansions[expansion_idx]
+        if rank+1<len(order):
+            heapq.heappush(heap,(-bounds[rank+1],expansion_idx,rank+1))
+        child = int(order[rank])
+        child_prefix = prefix*entry_probs[depth][term_rows[:,depth],child]
+        child_raw_state = (raw_state<<subcircuit_widths[depth])|child
+        if depth+1==num_subcircuits:
+            # The bound of a complete state is its probability
+            raw_states.append(child_raw_state)
+            probabilities.append(bounds[rank])
+        else:
+            expand(prefix=child_prefix,depth=depth+1,raw_state=child_raw_state)
+    states = raw_to_circuit_states(raw_states=raw_states,qubit_order=reconstruction_terms['qubit_order'])
+    return states, np.array(probabilities)
+
+def get_observable_diagonals(observable, qubits):
+    '''
+    Per qubit diagonal of a product observable
+    observable: a string of I and Z, the leftmost character acting on the highest qubit as in qiskit,
+    or a dict {qubit: diagonal of length 2}. Qubits not in the dict get the identity.
+    Returns {qubit: diagonal} over qubits
+    '''
+    diagonals = {qubit:np.ones(2) for qubit in qubits}
+    if isinstance(observable,str):
+        if len(observable)!=len(qubits):
+            raise ValueError('Observable %s should act on all %d output qubits'%(observable,len(qubits)))
+        for qubit, pauli in zip(sorted(qubits,reverse=True),observable.upper()):
+            if pauli=='Z':
+                diagonals[qubit] = np.array([1.0,-1.0])
+            elif pauli!='I':
+                raise ValueError('Only diagonal observables are supported, got %s'%pauli)
+    else:
+        for qubit in observable:
+            if qubit not in diagonals:
+                raise ValueError('Observable acts on qubit %s outside the output qubits'%qubit)
+            diagonal = np.asarray(observable[qubit],dtype=np.float64)
+            if diagonal.shape!=(2,):
+                raise ValueError('Expecting a diagonal of length 2 for qubit %s'%qubit)
+            diagonals[qubit] = diagonal
+    return diagonals
+
+def get_expectations(reconstruction_terms, observables, chunk_size=2**16):
+    '''
+    Expectation values of diagonal product observables, without building the full output
+    A product observable factorizes across the subcircuits,
+    so every subcircuit entry contracts to one scalar and every summation term to a product of scalars.
+    Energies of diagonal Hamiltonians are the coefficient weighted sums of the returned values.
+    '''
+    entry_probs = reconstruction_terms['entry_probs']
+    term_rows = reconstruction_terms['term_rows']
+    weights = reconstruction_terms['weights']
+    subcircuit_qubits = reconstruction_terms['subcircuit_qubits']
+    all_diagonals = [get_observable_diagonals(observable=observable,qubits=reconstruction_terms['qubit_order']) for observable in observables]
+    # entry_scalars[j][row,observable_idx] = contraction of the entry with the observable on the subcircuit qubits
+    entry_scalars = []
+    for subcircuit_ctr in range(len(entry_probs)):
+        kron_diagonals = []
+        for diagonals in all_diagonals:
+            kron_diagonal = np.ones(1)
+            for qubit in subcircuit_qubits[subcircuit_ctr]:
+                kron_diagonal = np.kron(kron_diagonal,diagonals[qubit])
+            kron_diagonals.append(kron_diagonal)
+        entry_scalars.append(entry_probs[subcircuit_ctr]@np.array(kron_diagonals).T)
+    expectations = np.zeros(len(observables))
+    for start in range(0,len(weights),chunk_size):
+        products = np.array(weights[start:start+chunk_size])[:,None]
+        rows = term_rows[start:start+chunk_size]
+        for subcircuit_ctr in range(len(entry_probs)):
+            products = products*entry_scalars[subcircuit_ctr][rows[:,subcircuit_ctr]]
+        expectations += products.sum(axis=0)
+    return expectations
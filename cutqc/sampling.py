@@ -1,38 +1,110 @@
 import numpy as np
 import glob
-from gurobipy import *
 
 from cutqc.helper_fun import read_prob_from_txt
 
-def dummy_sample(summation_terms):
+def dummy_sample(num_summation_terms):
     '''
     A dummy sampler that samples all summation_terms
     Just to keep the same format of codes with other sampling methods
+    summation_terms_sampled = {'summation_term_idx','sampling_prob','frequency'}, one array element per sampled term
     '''
-    summation_terms_sampled = []
-    sampling_prob = 1
-    for sample_summation_term_idx, sample_summation_term in enumerate(summation_terms):
-        summation_terms_sampled.append({'summation_term_idx':sample_summation_term_idx,'summation_term':sample_summation_term,'sampling_prob':sampling_prob,'frequency':1})
+    summation_terms_sampled = {
+        'summation_term_idx':np.arange(num_summation_terms,dtype=np.int64),
+        'sampling_prob':np.ones(num_summation_terms,dtype=np.float64),
+        'frequency':np.ones(num_summation_terms,dtype=np.int32)}
     return summation_terms_sampled
 
 def get_subcircuit_instances_sampled(subcircuit_entries,subcircuit_entry_samples):
+    '''
+    Returns [(subcircuit_idx, subcircuit_instance_idx), ...] needed by the sampled subcircuit entries
+    '''
     subcircuit_instances_sampled = []
-    for subcircuit_entry_sample in subcircuit_entry_samples:
-        subcircuit_idx, subcircuit_entry_idx = subcircuit_entry_sample
-        kronecker_term = subcircuit_entries[subcircuit_idx][subcircuit_entry_idx]
-        for item in kronecker_term:
-            coefficient, subcircuit_instance_idx = item
-            if (subcircuit_idx,subcircuit_instance_idx) not in subcircuit_instances_sampled:
-                subcircuit_instances_sampled.append((subcircuit_idx,subcircuit_instance_idx))
+    for subcircuit_idx in subcircuit_entry_samples:
+        indptr = subcircuit_entries[subcircuit_idx]['indptr']
+        instance_indices = subcircuit_entries[subcircuit_idx]['instance_indices']
+        entry_sampled = np.zeros(len(indptr)-1,dtype=bool)
+        entry_sampled[subcircuit_entry_samples[subcircuit_idx]] = True
+        row_sampled = np.repeat(entry_sampled,np.diff(indptr))
+        for subcircuit_instance_idx in np.unique(instance_indices[row_sampled]):
+            subcircuit_instances_sampled.append((subcircuit_idx,int(subcircuit_instance_idx)))
     return subcircuit_instances_sampled
 
-def get_subcircuit_entries_sampled(summation_terms):
-    subcircuit_entries_sampled = []
-    for summation_term in summation_terms:
-        sampling_prob = summation_term['sampling_prob']
-        summation_term = summation_term['summation_term']
-        for subcircuit_entry in summation_term:
-            subcircuit_idx, subcircuit_entry_idx = subcircuit_entry
-            if (subcircuit_idx,subcircuit_entry_idx) not in subcircuit_entries_sampled:
-                subcircuit_entries_sampled.append((subcircuit_idx,subcircuit_entry_idx))
-    return subcircuit_entries_sampled
\ No newline at end of file
+def get_subcircuit_entries_sampled(summation_terms,summation_terms_sampled,chunk_size=2**16):
+    '''
+    summation_terms : SummationTerms, indexed chunk_size sampled terms at a time
+    Returns subcircuit_entries_sampled[subcircuit_idx] = sorted array of the sampled subcircuit_entry_idx
+    '''
+    summation_term_indices = summation_terms_sampled['summation_term_idx']
+    entry_sampled = [np.zeros(4**len(summation_terms.subcircuit_cuts[subcircuit_idx]),dtype=bool) for subcircuit_idx in summation_terms.smart_order]
+    for start in range(0,len(summation_term_indices),chunk_size):
+        terms = summation_terms.get_rows(summation_term_indices=summation_term_indices[start:start+chunk_size])
+        for subcircuit_ctr in range(len(summation_terms.smart_order)):
+            entry_sampled[subcircuit_ctr][terms[:,subcircuit_ctr]] = True
+    subcircuit_entries_sampled = {}
+    for subcircuit_ctr, subcircuit_idx in enumerate(summation_terms.smart_order):
+        subcircuit_entries_sampled[int(subcircuit_idx)] = np.flatnonzero(entry_sampled[subcircuit_ctr]).astype(np.int32)
+    return subcircuit_entries_sampled
+
+def get_suffix_totals(reconstruction_terms):
+    '''
+    suffix_totals[j][t] = product of the total mass of the factors j, j+1, ... of term t
+    '''
+    entry_probs = reconstruction_terms['entry_probs']
+    term_rows = reconstruction_terms['term_rows']
+    totals = np.ones(len(term_rows))
+    suffix_totals = [totals]
+    for subcircuit_ctr in range(len(entry_probs)-1,-1,-1):
+        totals = totals*entry_probs[subcircuit_ctr].sum(axis=1)[term_rows[:,subcircuit_ctr]]
+        suffix_totals.append(totals)
+    return suffix_totals[::-1]
+
+def sample_bitstrings(reconstruction_terms, shots, seed=None):
+    '''
+    Draw shots from the reconstructed quasi-distribution without building it
+    Subcircuit outputs are sampled one at a time in smart_order, each from its distribution conditioned on the outputs drawn so far.
+    Shots sharing a prefix are drawn together from one multinomial.
+    Negative conditional probabilities are clipped to 0. Clipping a conditional with negative mass m moves it by m in TVD,
+    so the sum of m along the path of a shot bounds the TVD between the sampler and the quasi-distribution.
+
+    Returns raw kron order states, their counts and
+    info = {'bias_bound': mean TVD bound over the shots, 'bias_bound_std': its standard error}
+    '''
+    rng = np.random.default_rng(seed)
+    entry_probs = reconstruction_terms['entry_probs']
+    term_rows = reconstruction_terms['term_rows']
+    num_subcircuits = len(entry_probs)
+    subcircuit_widths = [int(np.log2(entry_probs[subcircuit_ctr].shape[1])) for subcircuit_ctr in range(num_subcircuits)]
+    suffix_totals = get_suffix_totals(reconstruction_terms=reconstruction_terms)
+    total_mass = np.dot(reconstruction_terms['weights'],suffix_totals[0])
+    if total_mass<=0:
+        raise ValueError('The reconstructed quasi-distribution has no positive mass to sample from')
+
+    raw_states = []
+    counts = []
+    path_biases = []
+    # Stack of (prefix, depth, raw state prefix, number of shots, bias so far)
+    stack = [(np.asarray(reconstruction_terms['weights'],dtype=np.float64),0,0,shots,0.0)]
+    while len(stack)>0:
+        prefix, depth, raw_state, num_shots, bias = stack.pop()
+        factors = entry_probs[depth][term_rows[:,depth]]
+        conditional = (prefix*suffix_totals[depth+1])@factors
+        negative_mass = -conditional[conditional<0].sum()
+        conditional = np.clip(conditional,0,None)
+        positive_mass = conditional.sum()
+        bias += negative_mass/(positive_mass-negative_mass)
+        child_counts = rng.multinomial(num_shots,conditional/positive_mass)
+        for child in np.flatnonzero(child_counts):
+            child_raw_state = (raw_state<<subcircuit_widths[depth])|int(child)
+            if depth+1==num_subcircuits:
+                raw_states.append(child_raw_state)
+                counts.append(child_counts[child])
+                path_biases.append(bias)
+            else:
+                stack.append((prefix*factors[:,child],depth+1,child_raw_state,child_counts[child],bias))
+    counts = np.array(counts,dtype=np.int64)
+    path_biases = np.array(path_biases)
+    bias_bound = np.dot(counts,path_biases)/shots
+    bias_bound_std = np.sqrt(max(0,np.dot(counts,path_biases**2)/shots-bias_bound**2)/shots)
+    info = {'bias_bound':bias_bound,'bias_bound_std':bias_bound_std}
+    return np.array(raw_states,dtype=np.int64), counts, info
@@ -5,9 +5,11 @@ import numpy as np
 
 from qiskit_helper_functions.non_ibmq_functions import evaluate_circ
 
-def verify(full_circuit,unordered,complete_path_map,subcircuits,smart_order):
-    ground_truth = evaluate_circ(circuit=full_circuit,backend='statevector_simulator')
-    subcircuit_out_qubits = {subcircuit_idx:[] for subcircuit_idx in smart_order}
+def get_subcircuit_output_qubits(full_circuit,complete_path_map,subcircuits):
+    '''
+    subcircuit_out_qubits[subcircuit_idx] = full circuit qubit index of every bit of the subcircuit entries, most significant bit first
+    '''
+    subcircuit_out_qubits = {subcircuit_idx:[] for subcircuit_idx in range(len(subcircuits))}
     for input_qubit in complete_path_map:
         path = complete_path_map[input_qubit]
         output_qubit = path[-1]
@@ -16,18 +18,87 @@ def verify(full_circuit,unordered,complete_path_map,subcircuits,smart_order):
         subcircuit_out_qubits[subcircuit_idx] = sorted(subcircuit_out_qubits[subcircuit_idx],
         key=lambda x:subcircuits[subcircuit_idx].qubits.index(x[0]),reverse=True)
         subcircuit_out_qubits[subcircuit_idx] = [x[1] for x in subcircuit_out_qubits[subcircuit_idx]]
-    # print('subcircuit_out_qubits:',subcircuit_out_qubits)
+    return subcircuit_out_qubits
+
+def get_subcircuit_out_qubits(full_circuit,complete_path_map,subcircuits,smart_order,output_qubits=None):
+    '''
+    Full circuit qubit index of every bit of the CutQC output, most significant bit first
+    output_qubits: only keep these qubits, for marginal outputs
+    '''
+    subcircuit_out_qubits = get_subcircuit_output_qubits(full_circuit=full_circuit,complete_path_map=complete_path_map,subcircuits=subcircuits)
     unordered_qubit = []
     for subcircuit_idx in smart_order:
         unordered_qubit += subcircuit_out_qubits[subcircuit_idx]
-    # print('CutQC out qubits:',unordered_qubit)
+    if output_qubits is not None:
+        unordered_qubit = [qubit for qubit in unordered_qubit if qubit in output_qubits]
+    return unordered_qubit
+
+def get_marginal(prob,prob_qubits,output_qubits):
+    '''
+    Marginal of prob over the qubits not in output_qubits
+    prob_qubits: qubit of every bit of prob, most significant bit first
+    '''
+    summed_axes = tuple([axis for axis, qubit in enumerate(prob_qubits) if qubit not in output_qubits])
+    if len(summed_axes)==0:
+        return prob
+    return np.asarray(prob).reshape((2,)*len(prob_qubits)).sum(axis=summed_axes).reshape(-1)
+
+def get_reorder_view(unordered,unordered_qubit):
+    '''
+    View the CutQC output as an n-axis tensor, transposed so that axis j is qubit n-1-j.
+    Flattening the view gives the probabilities in the qubit order of the full circuit.
+    No data is copied.
+    '''
+    num_qubits = len(unordered_qubit)
+    if len(unordered)!=2**num_qubits:
+        raise ValueError('Expecting %d probabilities for %d qubits, got %d'%(2**num_qubits,num_qubits,len(unordered)))
+    axis = {qubit:axis for axis, qubit in enumerate(unordered_qubit)}
+    perm = [axis[num_qubits-1-j] for j in range(num_qubits)]
+    return np.asarray(unordered).reshape((2,)*num_qubits).transpose(perm)
+
+def reorder_prob(unordered,unordered_qubit):
+    '''
+    CutQC output in the qubit order of the full circuit
+    '''
+    return get_reorder_view(unordered=unordered,unordered_qubit=unordered_qubit).reshape(-1)
+
+def get_errors(ground_truth,unordered,unordered_qubit,chunk_size=2**20):
+    '''
+    MSE, fidelity and total variation distance of the CutQC output against the ground truth,
+    one chunk of at most chunk_size states at a time
+    Fidelity clips the negative probabilities of noisy reconstructions to 0.
+    '''
+    view = get_reorder_view(unordered=unordered,unordered_qubit=unordered_qubit)
+    num_qubits = len(unordered_qubit)
+    # Chunk over the leading axes of the view, i.e. the most significant bits of the ordered states
+    num_chunk_qubits = max(0,num_qubits-max(0,int(np.log2(chunk_size))))
+    chunk_len = 2**(num_qubits-num_chunk_qubits)
     squared_error = 0
-    for unordered_state, unordered_p in enumerate(unordered):
-        bin_unordered_state = bin(unordered_state)[2:].zfill(full_circuit.num_qubits)
-        _, ordered_bin_state = zip(*sorted(zip(unordered_qubit, bin_unordered_state),reverse=True))
-        ordered_bin_state = ''.join([str(x) for x in ordered_bin_state])
-        ordered_state = int(ordered_bin_state,2)
-        ordered_p = ground_truth[ordered_state]
-        squared_error_contribution = np.power(ordered_p-unordered_p,2)
-        squared_error += squared_error_contribution
-    return squared_error/len(unordered)
\ No newline at end of file
+    fidelity = 0
+    absolute_error = 0
+    for chunk_idx in range(2**num_chunk_qubits):
+        prefix = tuple([(chunk_idx>>(num_chunk_qubits-1-bit))&1 for bit in range(num_chunk_qubits)])
+        ordered_p = view[prefix].reshape(-1)
+        ground_truth_p = ground_truth[chunk_idx*chunk_len:(chunk_idx+1)*chunk_len]
+        diff = ordered_p-ground_truth_p
+        squared_error += np.dot(diff,diff)
+        absolute_error += np.sum(np.abs(diff))
+        fidelity += np.sum(np.sqrt(np.clip(ordered_p,0,None)*ground_truth_p))
+    return {'mse':squared_error/2**num_qubits,'fidelity':fidelity**2,'tvd':absolute_error/2}
+
+def verify(full_circuit,unordered,complete_path_map,subcircuits,smart_order,chunk_size=2**20,qubit_order=None):
+    '''
+    Errors of the CutQC output against the statevector simulation of the full circuit
+    qubit_order: circuit qubit of every output bit as saved by the build, defaults to the raw kron order
+    '''
+    ground_truth = evaluate_circ(circuit=full_circuit,backend='statevector_simulator')
+    if qubit_order is None:
+        unordered_qubit = get_subcircuit_out_qubits(full_circuit=full_circuit,complete_path_map=complete_path_map,subcircuits=subcircuits,smart_order=smart_order)
+    else:
+        unordered_qubit = list(qubit_order)
+    ground_truth = np.asarray(ground_truth)
+    if len(unordered_qubit)<full_circuit.num_qubits:
+        # Marginal output, compare against the marginal of the ground truth
+        ground_truth = get_marginal(prob=ground_truth,prob_qubits=list(range(full_circuit.num_qubits-1,-1,-1)),output_qubits=unordered_qubit)
+        unordered_qubit = [sorted(unordered_qubit).index(qubit) for qubit in unordered_qubit]
+    return get_errors(ground_truth=ground_truth,unordered=unordered,unordered_qubit=unordered_qubit,chunk_size=chunk_size)
@@ -0,0 +1,42 @@
+import os, sys
+import numpy as np
+import pytest
+from qiskit import QuantumCircuit
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qiskit_helper_functions.non_ibmq_functions import evaluate_circ
+
+def make_circuit(num_qubits=6, num_layers=2, seed=3):
+    '''
+    Ladder of CX and random rotations, cheap to cut along the chain
+    '''
+    circuit = QuantumCircuit(num_qubits)
+    rng = np.random.default_rng(seed)
+    for qubit in range(num_qubits):
+        circuit.h(qubit)
+    for layer in range(num_layers):
+        for qubit in range(num_qubits-1):
+            circuit.cx(qubit,qubit+1)
+            circuit.ry(rng.random(),qubit+1)
+            circuit.rz(rng.random(),qubit)
+    return circuit
+
+def get_ground_truth(circuit):
+    '''
+    Statevector probabilities of circuit, in the circuit qubit order
+    '''
+    return np.array(evaluate_circ(circuit=circuit,backend='statevector_simulator'))
+
+def get_build_output(cutqc, dest_folder):
+    return cutqc._load(folder=dest_folder,name='build_output',memoize=False)
+
+EVALUATE_KWARGS = {'eval_mode':'sv','mem_limit':24,'num_nodes':1,'num_threads':2,'ibmq':None}
+CUT_KWARGS = {'max_subcircuit_qubit':4,'max_cuts':4,'num_subcircuits':[2,3],'solver':'heuristic'}
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, tmp_path_factory, monkeypatch):
+    # CutQC writes to ./cutqc_data, every test runs in its own folder
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('CUTQC_KERNEL_DIR',str(tmp_path_factory.getbasetemp()/'kernel'))
+    return tmp_path
@@ -0,0 +1,37 @@
+import json, os, pickle
+import numpy as np
+import pytest
+
+from cutqc.artifact_store import ArtifactStore
+
+def test_records_and_pickles():
+    os.makedirs('store')
+    store = ArtifactStore(folder='store')
+    store.put('entries',{'probs':np.arange(6,dtype=np.float32).reshape(2,3),'indices':np.array([3,5]),'num_cuts':2,'cuts':[[0],[0,1]]},
+    metadata={'eval_mode':'sv'})
+    store.put('pairs',{'pair':(1,2)})
+    # The manifest describes the arrays without loading them
+    manifest = json.load(open('store/manifest.json'))
+    assert manifest['entries']['kind']=='record'
+    assert manifest['entries']['arrays']['probs']=={'shape':[2,3],'dtype':np.dtype(np.float32).str}
+    assert manifest['entries']['metadata']=={'eval_mode':'sv'}
+    assert manifest['pairs']['kind']=='pickle'
+
+    store = ArtifactStore(folder='store')
+    entries = store.get('entries')
+    assert isinstance(entries['probs'],np.memmap)
+    assert np.array_equal(entries['probs'],np.arange(6).reshape(2,3)) and np.array_equal(entries['indices'],[3,5])
+    assert entries['num_cuts']==2 and entries['cuts']==[[0],[0,1]]
+    assert set(store.get('entries',keys=['indices']))=={'indices','num_cuts','cuts'}
+    assert store.get('pairs')=={'pair':(1,2)}
+    assert 'entries' in store and 'missing' not in store
+    with pytest.raises(KeyError):
+        store.get_metadata('missing')
+
+def test_legacy_folder():
+    # Folders written before the manifest only hold pickles
+    os.makedirs('legacy')
+    pickle.dump({'circuit_name':'old'},open('legacy/cut_solution.pckl','wb'))
+    store = ArtifactStore(folder='legacy')
+    assert 'cut_solution' in store
+    assert store.get('cut_solution')=={'circuit_name':'old'}
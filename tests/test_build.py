@@ -0,0 +1,76 @@
+import os
+import numpy as np
+import pytest
+
+from cutqc.main import CutQC
+from cutqc.build_kernel import build_terms, reorder_output
+from conftest import make_circuit, get_ground_truth, get_build_output, EVALUATE_KWARGS, CUT_KWARGS
+
+def get_terms(num_terms=12, seed=0):
+    rng = np.random.default_rng(seed)
+    entry_probs = [rng.random((3,4)),rng.random((2,8))]
+    term_rows = np.stack([rng.integers(3,size=num_terms),rng.integers(2,size=num_terms)],axis=1)
+    weights = rng.normal(size=num_terms)
+    return entry_probs, term_rows, weights
+
+def test_build_terms_matches_numpy():
+    entry_probs, term_rows, weights = get_terms()
+    reconstructed_prob, progress = build_terms(entry_probs=entry_probs,term_rows=term_rows,weights=weights)
+    expected = sum([weight*np.kron(entry_probs[0][row[0]],entry_probs[1][row[1]]) for row, weight in zip(term_rows,weights)])
+    assert np.allclose(reconstructed_prob,expected,atol=1e-5)
+    assert progress['num_built']==len(weights)
+
+def test_resumed_build_matches_uninterrupted(tmp_path, capfd):
+    entry_probs, term_rows, weights = get_terms()
+    remaining_bounds = np.arange(len(weights))[::-1].astype(float)
+    uninterrupted, _ = build_terms(entry_probs=entry_probs,term_rows=term_rows,weights=weights,remaining_bounds=remaining_bounds)
+    # Stop halfway through a checkpointed build, then resume it from the checkpoints
+    _, progress = build_terms(entry_probs=entry_probs,term_rows=term_rows,weights=weights,remaining_bounds=remaining_bounds,
+    dest_folder=str(tmp_path),checkpoint_interval=1e-9,tolerance=5.5)
+    assert progress['num_built']==len(weights)-5
+    assert capfd.readouterr().out==''
+    resumed, progress = build_terms(entry_probs=entry_probs,term_rows=term_rows,weights=weights,remaining_bounds=remaining_bounds,
+    dest_folder=str(tmp_path),checkpoint_interval=1e-9,resume=True,verbose=True)
+    assert progress['num_built']==len(weights)
+    assert 'Rank 0 resumed after %d/%d summation terms'%(len(weights)-5,len(weights)) in capfd.readouterr().out
+    assert np.array_equal(resumed,uninterrupted)
+
+def test_resumed_evaluate_matches_statevector():
+    circuit = make_circuit(num_qubits=6)
+    cutqc = CutQC(circuit_name='ladder',circuit=circuit,verbose=False)
+    source_folder = cutqc.cut(**CUT_KWARGS)
+    dest_folder = cutqc.evaluate(source_folders=[source_folder],build_options={'tolerance':0.5,'checkpoint_interval':1e-9},**EVALUATE_KWARGS)[0]
+    partial = get_build_output(cutqc,dest_folder)
+    assert partial['num_summation_terms_built']<partial['num_summation_terms_sampled']
+    assert np.abs(partial['reconstructed_prob']-get_ground_truth(circuit)).sum()<=partial['remaining_bound']+1e-6
+    dest_folder = cutqc.evaluate(source_folders=[source_folder],resume=True,build_options={'checkpoint_interval':1e-9},**EVALUATE_KWARGS)[0]
+    resumed = get_build_output(cutqc,dest_folder)
+    assert resumed['num_summation_terms_built']==resumed['num_summation_terms_sampled']
+    assert np.allclose(resumed['reconstructed_prob'],get_ground_truth(circuit),atol=1e-6)
+
+def test_raw_order_matches_circuit_order():
+    circuit = make_circuit(num_qubits=6)
+    cutqc = CutQC(circuit_name='ladder',circuit=circuit,verbose=False)
+    source_folder = cutqc.cut(**CUT_KWARGS)
+    with pytest.raises(ValueError):
+        cutqc.evaluate(source_folders=[source_folder],build_options={'keep_raw_orders':True},**EVALUATE_KWARGS)
+    dest_folder = cutqc.evaluate(source_folders=[source_folder],build_options={'keep_raw_order':True},**EVALUATE_KWARGS)[0]
+    raw = get_build_output(cutqc,dest_folder)
+    dest_folder = cutqc.evaluate(source_folders=[source_folder],**EVALUATE_KWARGS)[0]
+    ordered = get_build_output(cutqc,dest_folder)
+    assert ordered['qubit_order']==list(range(6))[::-1]
+    assert np.allclose(ordered['reconstructed_prob'],get_ground_truth(circuit),atol=1e-6)
+    assert np.allclose(reorder_output(raw_prob=raw['reconstructed_prob'],raw_qubit_order=raw['qubit_order']),ordered['reconstructed_prob'],atol=1e-6)
+
+def test_in_memory_matches_persisted():
+    circuit = make_circuit(num_qubits=6)
+    outputs = []
+    for persist in [True,False]:
+        cutqc = CutQC(circuit_name='ladder_%s'%persist,circuit=circuit,verbose=False,persist=persist)
+        source_folder = cutqc.cut(**CUT_KWARGS)
+        dest_folder = cutqc.evaluate(source_folders=[source_folder],**EVALUATE_KWARGS)[0]
+        outputs.append(get_build_output(cutqc,dest_folder)['reconstructed_prob'])
+    # Only the persisted CutQC writes to ./cutqc_data
+    assert os.listdir('cutqc_data')==['ladder_True']
+    assert np.allclose(outputs[1],get_ground_truth(circuit),atol=1e-6)
+    assert np.allclose(outputs[0],outputs[1],atol=1e-6)
@@ -0,0 +1,76 @@
+import os
+import numpy as np
+from qiskit import QuantumCircuit
+
+from cutqc.cache import ResultCache, MemoryResultCache
+from cutqc.evaluator import simulate_subcircuit
+
+def get_entry(num_states=1000):
+    return {('comp',):np.zeros(num_states)}
+
+def test_key_covers_simulation_inputs():
+    cache = ResultCache(cache_dir='cache',max_size=1)
+    key = cache.get_key(fingerprint='f',init=['zero'],meas=[('comp',)],eval_mode='qasm',shots=10)
+    assert key==cache.get_key(fingerprint='f',init=('zero',),meas=(['comp'],),eval_mode='qasm',shots=10)
+    assert key!=cache.get_key(fingerprint='f',init=['zero'],meas=[('comp',)],eval_mode='qasm',shots=11)
+    assert key!=cache.get_key(fingerprint='f',init=['zero'],meas=[('I',)],eval_mode='qasm',shots=10)
+    assert key!=ResultCache(cache_dir='cache',max_size=1,seed=1).get_key(fingerprint='f',init=['zero'],meas=[('comp',)],eval_mode='qasm',shots=10)
+
+def test_lru_eviction():
+    cache = ResultCache(cache_dir='cache',max_size=1)
+    cache.put('a',get_entry())
+    entry_size = cache.total_size
+    cache.max_size = int(2.5*entry_size)
+    cache.put('b',get_entry())
+    # a is older than b, then read again
+    os.utime('cache/a.pckl',(1,1))
+    os.utime('cache/b.pckl',(2,2))
+    assert cache.get('a') is not None
+    cache.put('c',get_entry())
+    assert sorted(os.listdir('cache'))==['a.pckl','c.pckl']
+    assert cache.get_stats()['evictions']==1
+    assert cache.total_size==2*entry_size
+
+def test_overwrite_size():
+    cache = ResultCache(cache_dir='cache',max_size=1)
+    cache.put('a',get_entry())
+    entry_size = cache.total_size
+    cache.put('a',get_entry())
+    assert cache.total_size==entry_size
+    assert ResultCache(cache_dir='cache',max_size=1).total_size==entry_size
+
+def test_memory_lru_eviction():
+    cache = MemoryResultCache(max_size=1)
+    entry_size = cache.get_entry_size(get_entry())
+    cache.max_size = int(2.5*entry_size)
+    cache.put('a',get_entry())
+    cache.put('b',get_entry())
+    assert cache.get('a') is not None
+    cache.put('c',get_entry())
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.total_size==2*entry_size
+
+def get_subcircuit_info():
+    circuit = QuantumCircuit(2)
+    circuit.h(0)
+    circuit.cx(0,1)
+    return {'circuit':circuit,'shots':100,'init':('zero','zero'),'meas':[('comp','comp')]}
+
+def test_seeded_qasm_is_cached():
+    cache = ResultCache(cache_dir='cache',max_size=1,seed=7)
+    first = simulate_subcircuit(subcircuit_info=get_subcircuit_info(),eval_mode='qasm',result_cache=cache,seed=7)
+    assert len(os.listdir('cache'))==1
+    second = simulate_subcircuit(subcircuit_info=get_subcircuit_info(),eval_mode='qasm',result_cache=cache,seed=7)
+    assert cache.get_stats()['hits']==1
+    # The same seed samples the same shots without a cache
+    uncached = simulate_subcircuit(subcircuit_info=get_subcircuit_info(),eval_mode='qasm',seed=7)
+    for meas in first:
+        assert np.array_equal(first[meas],second[meas]) and np.array_equal(first[meas],uncached[meas])
+
+def test_unseeded_qasm_is_not_cached():
+    cache = ResultCache(cache_dir='cache',max_size=1)
+    simulate_subcircuit(subcircuit_info=get_subcircuit_info(),eval_mode='qasm',result_cache=cache)
+    simulate_subcircuit(subcircuit_info=get_subcircuit_info(),eval_mode='qasm',result_cache=cache)
+    assert os.listdir('cache')==[]
+    assert cache.get_stats()['hits']==0
@@ -0,0 +1,75 @@
+import os, pickle, socket, subprocess, sys
+import numpy as np
+import pytest
+
+import cutqc.cutter
+from cutqc.main import CutQC
+from cutqc.cache import ResultCache
+from cutqc.build_kernel import calibrate_build_constants
+from cutqc.cutter import find_cuts, estimate_build_time
+from conftest import make_circuit, get_ground_truth, get_build_output, EVALUATE_KWARGS, CUT_KWARGS
+
+BUILD_CONSTANTS = {'term':1e-3,'element':1e-9}
+
+def test_cutter_does_not_load_the_kernel():
+    loaded = subprocess.run([sys.executable,'-c','import sys, cutqc.cutter; print("cutqc.build_kernel" in sys.modules)'],
+    capture_output=True,text=True,cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),check=True)
+    assert loaded.stdout.strip()=='False'
+
+def test_calibration_cached_per_host(tmp_path):
+    pickle.dump(BUILD_CONSTANTS,open(tmp_path/('build_kernel_constants_%s.pckl'%socket.gethostname()),'wb'))
+    assert calibrate_build_constants(cache_folder=str(tmp_path))==BUILD_CONSTANTS
+
+def test_cost_objective_ranks_by_build_time():
+    circuit = make_circuit(num_qubits=6)
+    kwargs = {'circuit':circuit,'max_subcircuit_qubit':5,'max_cuts':6,'verbose':False,'solver':'heuristic','num_workers':1}
+    with pytest.raises(ValueError):
+        find_cuts(num_subcircuits=[2],objective='cost',**kwargs)
+    build_times = []
+    for num_subcircuit in [2,3]:
+        cut_solution = find_cuts(num_subcircuits=[num_subcircuit],objective='cost',build_constants=BUILD_CONSTANTS,**kwargs)
+        build_times.append(estimate_build_time(counter=cut_solution['counter'],build_constants=BUILD_CONSTANTS))
+    cut_solution = find_cuts(num_subcircuits=[2,3],objective='cost',build_constants=BUILD_CONSTANTS,**kwargs)
+    assert estimate_build_time(counter=cut_solution['counter'],build_constants=BUILD_CONSTANTS)==min(build_times)
+
+def test_coarsened_search():
+    circuit = make_circuit(num_qubits=6)
+    cutqc = CutQC(circuit_name='ladder',circuit=circuit,verbose=False)
+    num_vertices = cutqc.circuit_ir.get_gate_graph()[0]
+    source_folder = cutqc.cut(**dict(CUT_KWARGS,max_mip_vertices=num_vertices//3))
+    dest_folder = cutqc.evaluate(source_folders=[source_folder],**EVALUATE_KWARGS)[0]
+    assert np.allclose(get_build_output(cutqc,dest_folder)['reconstructed_prob'],get_ground_truth(circuit),atol=1e-6)
+
+@pytest.mark.skipif(cutqc.cutter.gp is None,reason='requires gurobipy')
+def test_gurobi_errors_propagate(monkeypatch):
+    # A failed search must not be reported as an infeasible one
+    def get_cuts_cutoff(**kwargs):
+        raise cutqc.cutter.gp.GurobiError(10001,'failed search')
+    monkeypatch.setattr(cutqc.cutter,'get_cuts_cutoff',get_cuts_cutoff)
+    with pytest.raises(cutqc.cutter.gp.GurobiError):
+        find_cuts(circuit=make_circuit(num_qubits=6),max_subcircuit_qubit=4,max_cuts=4,num_subcircuits=[2],verbose=False,solver='gurobi',num_workers=1)
+
+@pytest.mark.parametrize('max_subcircuit_qubit',[4,5])
+def test_heuristic_cuts(max_subcircuit_qubit):
+    circuit = make_circuit(num_qubits=6)
+    kwargs = {'circuit':circuit,'max_subcircuit_qubit':max_subcircuit_qubit,'max_cuts':6,'num_subcircuits':[2,3],'verbose':False,'num_workers':1}
+    cut_solution = find_cuts(solver='heuristic',**kwargs)
+    assert len(cut_solution['positions'])<=6
+    assert all([counter['d']<=max_subcircuit_qubit for counter in cut_solution['counter'].values()])
+    if cutqc.cutter.gp is not None:
+        # Optimal on this small circuit
+        assert len(cut_solution['positions'])==len(find_cuts(solver='gurobi',**kwargs)['positions'])
+
+def test_worker_incumbents_and_cut_cache():
+    circuit = make_circuit(num_qubits=6)
+    kwargs = {'circuit':circuit,'max_subcircuit_qubit':4,'max_cuts':6,'num_subcircuits':[2,3],'verbose':False,'solver':'heuristic'}
+    incumbents = []
+    # The workers report their incumbents to the callback in this process
+    cut_solution = find_cuts(num_workers=2,incumbent_callback=incumbents.append,**kwargs)
+    assert len(incumbents)>0
+    assert set([incumbent['num_subcircuit'] for incumbent in incumbents])<=set(kwargs['num_subcircuits'])
+    assert min([incumbent['num_cuts'] for incumbent in incumbents])==len(cut_solution['positions'])
+    cut_cache = ResultCache(cache_dir='cut_cache',max_size=1)
+    cached_solution = find_cuts(num_workers=1,cut_cache=cut_cache,**kwargs)
+    assert len(os.listdir('cut_cache'))>0
+    assert find_cuts(num_workers=1,cut_cache=cut_cache,**kwargs)['positions']==cached_solution['positions']
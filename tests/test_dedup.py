@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import cutqc.main
+from cutqc.main import CutQC
+from conftest import make_circuit, get_ground_truth, get_build_output, EVALUATE_KWARGS, CUT_KWARGS
+
+@pytest.mark.parametrize('pipeline',[False,True])
+def test_same_circuit_at_two_sizes(pipeline):
+    # Both folders have the same circuit_name, their results must not mix
+    circuit = make_circuit(num_qubits=6)
+    cutqc = CutQC(circuit_name='ladder',circuit=circuit,verbose=False)
+    source_folders = [cutqc.cut(**dict(CUT_KWARGS,max_subcircuit_qubit=max_subcircuit_qubit,max_cuts=6,num_subcircuits=[num_subcircuits]))
+    for max_subcircuit_qubit, num_subcircuits in [(4,3),(5,2)]]
+    assert source_folders[0]!=source_folders[1]
+    dest_folders = cutqc.evaluate(source_folders=source_folders,build_options={'pipeline':pipeline},**EVALUATE_KWARGS)
+    ground_truth = get_ground_truth(circuit)
+    for dest_folder in dest_folders:
+        assert np.allclose(get_build_output(cutqc,dest_folder)['reconstructed_prob'],ground_truth,atol=1e-6)
+
+def test_identical_instances_simulated_once(monkeypatch):
+    circuit = make_circuit(num_qubits=6)
+    source_folders = [CutQC(circuit_name=circuit_name,circuit=circuit,verbose=False).cut(**CUT_KWARGS) for circuit_name in ['a','b']]
+    simulated = []
+    simulate_subcircuit = cutqc.main.simulate_subcircuit
+    def count_simulations(**kwargs):
+        simulated.append(kwargs['subcircuit_info']['fingerprint'])
+        return simulate_subcircuit(**kwargs)
+    monkeypatch.setattr(cutqc.main,'simulate_subcircuit',count_simulations)
+
+    single = CutQC(circuit_name='a',circuit=circuit,verbose=False)
+    single.evaluate(source_folders=source_folders[:1],**EVALUATE_KWARGS)
+    num_single = len(simulated)
+    simulated.clear()
+    batch = CutQC(circuit_name='a',circuit=circuit,verbose=False)
+    dest_folders = batch.evaluate(source_folders=source_folders,**EVALUATE_KWARGS)
+    # The second circuit only reuses the instances of the first, each result is fanned out to both
+    assert len(simulated)==num_single==len(set(simulated))
+    ground_truth = get_ground_truth(circuit)
+    for dest_folder in dest_folders:
+        assert np.allclose(get_build_output(batch,dest_folder)['reconstructed_prob'],ground_truth,atol=1e-6)
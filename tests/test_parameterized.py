@@ -0,0 +1,59 @@
+import numpy as np
+from qiskit import QuantumCircuit
+from qiskit.circuit import ParameterVector
+
+from cutqc.main import CutQC
+from conftest import get_ground_truth, get_build_output, EVALUATE_KWARGS, CUT_KWARGS
+
+def make_template(num_qubits=6):
+    '''
+    Ladder circuit of make_circuit with one parameter per rotation
+    '''
+    parameters = ParameterVector('theta',2*num_qubits)
+    circuit = QuantumCircuit(num_qubits)
+    for qubit in range(num_qubits):
+        circuit.h(qubit)
+    for qubit in range(num_qubits-1):
+        circuit.cx(qubit,qubit+1)
+        circuit.ry(parameters[qubit],qubit+1)
+        circuit.rz(parameters[num_qubits+qubit],qubit)
+    return circuit
+
+def bind(circuit, parameter_values):
+    return circuit.assign_parameters(dict(zip(circuit.parameters,parameter_values)))
+
+def test_rebind_resimulates_changed_subcircuits():
+    template = make_template()
+    cutqc = CutQC(circuit_name='template',circuit=template,verbose=False)
+    source_folder = cutqc.cut(**CUT_KWARGS)
+    parameter_values = np.random.default_rng(0).random(len(template.parameters))
+    assert cutqc.rebind(source_folder=source_folder,parameter_values=parameter_values)==list(range(len(cutqc._load(folder=source_folder,name='cut_solution')['subcircuits'])))
+    dest_folder = cutqc.evaluate(source_folders=[source_folder],**EVALUATE_KWARGS)[0]
+    assert np.allclose(get_build_output(cutqc,dest_folder)['reconstructed_prob'],get_ground_truth(bind(template,parameter_values)),atol=1e-6)
+    assert cutqc.rebind(source_folder=source_folder,parameter_values=parameter_values)==[]
+
+    # One rotation lives in one subcircuit, the instances of the others are read from the cache
+    parameter_values[2] += 0.5
+    assert len(cutqc.rebind(source_folder=source_folder,parameter_values=parameter_values))==1
+    hits = cutqc.memory_cache.get_stats()['hits']
+    dest_folder = cutqc.evaluate(source_folders=[source_folder],**EVALUATE_KWARGS)[0]
+    assert cutqc.memory_cache.get_stats()['hits']>hits
+    assert np.allclose(get_build_output(cutqc,dest_folder)['reconstructed_prob'],get_ground_truth(bind(template,parameter_values)),atol=1e-6)
+
+def test_sweep_matches_statevector():
+    template = make_template()
+    cutqc = CutQC(circuit_name='template',circuit=template,verbose=False)
+    source_folder = cutqc.cut(**CUT_KWARGS)
+    parameter_bindings = np.tile(np.random.default_rng(1).random(len(template.parameters)),(4,1))
+    parameter_bindings[2:,0] += 0.5
+    parameter_bindings[3,7] -= 1.0
+    probs = cutqc.sweep(source_folder=source_folder,parameter_bindings=parameter_bindings)
+    ground_truth = np.array([get_ground_truth(bind(template,parameter_values)) for parameter_values in parameter_bindings])
+    assert np.allclose(probs,ground_truth,atol=1e-6)
+    parities = np.array([(-1)**bin(state).count('1') for state in range(2**6)])
+    expectations = cutqc.sweep(source_folder=source_folder,parameter_bindings=parameter_bindings,observables=['Z'*6,{0:[1,-1]}])
+    assert np.allclose(expectations[:,0],ground_truth@parities,atol=1e-6)
+    assert np.allclose(expectations[:,1],ground_truth@(1-2*(np.arange(2**6)&1)),atol=1e-6)
+    marginals = cutqc.sweep(source_folder=source_folder,parameter_bindings=parameter_bindings,output_qubits=[1,4])
+    # Axis 1+j of the tensor is qubit 5-j
+    assert np.allclose(marginals,ground_truth.reshape(4,*(2,)*6).sum(axis=(1,3,4,6)).reshape(4,-1),atol=1e-6)
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from cutqc import main
+from cutqc.main import CutQC
+from conftest import make_circuit, get_ground_truth, get_build_output, EVALUATE_KWARGS, CUT_KWARGS
+
+@pytest.mark.parametrize('build_options,output_qubits',[({},None),({},[0,2,3]),({'keep_raw_order':True},None)])
+def test_pipeline_matches_sequential(monkeypatch, build_options, output_qubits):
+    pipelined = []
+    run_pipeline = main.run_pipeline
+    def count_pipelines(**kwargs):
+        pipelined.append(kwargs['num_threads'])
+        return run_pipeline(**kwargs)
+    monkeypatch.setattr(main,'run_pipeline',count_pipelines)
+    circuit = make_circuit(num_qubits=6)
+    cutqc = CutQC(circuit_name='ladder',circuit=circuit,verbose=False)
+    source_folder = cutqc.cut(**CUT_KWARGS)
+    outputs = []
+    for pipeline in [False,True]:
+        dest_folder = cutqc.evaluate(source_folders=[source_folder],output_qubits=output_qubits,
+        build_options=dict(build_options,pipeline=pipeline),**EVALUATE_KWARGS)[0]
+        # Both builds write to the same folder, keep a copy of the first
+        build_output = get_build_output(cutqc,dest_folder)
+        outputs.append(dict(build_output,reconstructed_prob=np.array(build_output['reconstructed_prob'])))
+    assert pipelined==[EVALUATE_KWARGS['num_threads']]
+    sequential, threaded = outputs
+    assert threaded['qubit_order']==sequential['qubit_order']
+    assert threaded['num_summation_terms_built']==sequential['num_summation_terms_built']
+    # The build threads add the summation terms in another order
+    assert np.allclose(threaded['reconstructed_prob'],sequential['reconstructed_prob'],atol=1e-6)
+    if not build_options and output_qubits is None:
+        assert np.allclose(threaded['reconstructed_prob'],get_ground_truth(circuit),atol=1e-6)
@@ -0,0 +1,69 @@
+import numpy as np
+
+from cutqc.main import CutQC
+from cutqc.sampling import sample_bitstrings
+from conftest import make_circuit, get_ground_truth, get_build_output, EVALUATE_KWARGS, CUT_KWARGS
+
+def evaluate_ladder(**kwargs):
+    '''
+    CutQC, source folder and build output of an evaluated ladder circuit, None with build=False
+    '''
+    circuit = make_circuit(num_qubits=6)
+    cutqc = CutQC(circuit_name='ladder',circuit=circuit,verbose=False)
+    source_folder = cutqc.cut(**CUT_KWARGS)
+    dest_folders = cutqc.evaluate(source_folders=[source_folder],**EVALUATE_KWARGS,**kwargs)
+    return cutqc, source_folder, get_build_output(cutqc,dest_folders[0]) if dest_folders is not None else None
+
+def test_top_k_matches_build():
+    cutqc, source_folder, build_output = evaluate_ladder()
+    reconstructed_prob = build_output['reconstructed_prob']
+    for k in [1,5,20]:
+        states, probabilities = cutqc.top_k(source_folders=[source_folder],eval_mode='sv',k=k)[0]
+        assert list(states)==np.argsort(-reconstructed_prob,kind='stable')[:k].tolist()
+        assert np.allclose(probabilities,reconstructed_prob[states],atol=1e-6)
+
+def test_marginal_matches_statevector():
+    output_qubits = [0,2,3]
+    cutqc, source_folder, build_output = evaluate_ladder(output_qubits=output_qubits)
+    ground_truth = get_ground_truth(make_circuit(num_qubits=6)).reshape((2,)*6)
+    # Axis j of the tensor is qubit 5-j, the kept qubits stay in descending order
+    marginal = ground_truth.sum(axis=tuple([5-qubit for qubit in range(6) if qubit not in output_qubits])).reshape(-1)
+    assert build_output['qubit_order']==[3,2,0]
+    assert np.allclose(build_output['reconstructed_prob'],marginal,atol=1e-6)
+
+def test_expectation_matches_statevector():
+    cutqc, source_folder, build_output = evaluate_ladder(build=False)
+    observables = ['ZIIIIZ','IIZZII','IIIIII',{1:[0.5,2.0],4:[1.0,-3.0]}]
+    expectations = cutqc.expectation(source_folders=[source_folder],eval_mode='sv',observables=observables)[0]
+    ground_truth = get_ground_truth(make_circuit(num_qubits=6))
+    states = np.arange(2**6)
+    bits = [(states>>qubit)&1 for qubit in range(6)]
+    expected = [np.dot(ground_truth,(1-2*bits[5])*(1-2*bits[0])),np.dot(ground_truth,(1-2*bits[3])*(1-2*bits[2])),1,
+    np.dot(ground_truth,np.where(bits[1],2.0,0.5)*np.where(bits[4],-3.0,1.0))]
+    assert np.allclose(expectations,expected,atol=1e-6)
+
+def test_samples_match_statevector():
+    cutqc, source_folder, build_output = evaluate_ladder(build=False)
+    shots = 20000
+    states, counts, info = cutqc.sample(source_folders=[source_folder],eval_mode='sv',shots=shots,seed=7)[0]
+    assert counts.sum()==shots
+    resampled_states, resampled_counts, _ = cutqc.sample(source_folders=[source_folder],eval_mode='sv',shots=shots,seed=7)[0]
+    assert np.array_equal(states,resampled_states) and np.array_equal(counts,resampled_counts)
+    frequencies = np.zeros(2**6)
+    frequencies[states] = counts/shots
+    assert info['bias_bound']<1e-6
+    assert np.abs(frequencies-get_ground_truth(make_circuit(num_qubits=6))).sum()/2<0.05
+
+def test_bias_bound_of_a_quasi_distribution():
+    # 0.5^0 * (Kron(a0,b0) - 0.6*Kron(a1,b1)) = [0.36,-0.06,0.22,-0.12]
+    reconstruction_terms = {'entry_probs':[np.array([[0.6,0.4],[0.5,0.5]]),np.array([[0.7,0.3],[0.2,0.8]])],
+    'term_rows':np.array([[0,0],[1,1]]),'weights':np.array([1.0,-0.6])}
+    quasi_prob = np.array([0.36,-0.06,0.22,-0.12])/0.4
+    shots = 20000
+    raw_states, counts, info = sample_bitstrings(reconstruction_terms=reconstruction_terms,shots=shots,seed=0)
+    frequencies = np.zeros(4)
+    frequencies[raw_states] = counts/shots
+    # Clipping leaves [0.75,0,0.25,0], at TVD 0.45 from the quasi-distribution
+    assert np.allclose(frequencies,[0.75,0,0.25,0],atol=0.02)
+    assert np.isclose(info['bias_bound'],0.45,atol=5*info['bias_bound_std']+1e-3)
+    assert np.abs(frequencies-quasi_prob).sum()/2<=info['bias_bound']+0.02
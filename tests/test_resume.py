@@ -0,0 +1,34 @@
+import numpy as np
+
+from cutqc import main
+from cutqc.main import CutQC
+from conftest import make_circuit, get_ground_truth, get_build_output, EVALUATE_KWARGS, CUT_KWARGS
+
+def test_resume_skips_finished_stages(monkeypatch):
+    circuit = make_circuit(num_qubits=6)
+    cutqc = CutQC(circuit_name='ladder',circuit=circuit,verbose=False)
+    source_folder = cutqc.cut(resume=True,**CUT_KWARGS)
+    dest_folder = cutqc.evaluate(source_folders=[source_folder],resume=True,**EVALUATE_KWARGS)[0]
+    reconstructed_prob = np.array(get_build_output(cutqc,dest_folder)['reconstructed_prob'])
+
+    simulated = []
+    simulate_subcircuit = main.simulate_subcircuit
+    def count_simulations(**kwargs):
+        simulated.append(kwargs['subcircuit_info'])
+        return simulate_subcircuit(**kwargs)
+    def find_cuts(**kwargs):
+        raise AssertionError('The cut should be resumed')
+    monkeypatch.setattr(main,'simulate_subcircuit',count_simulations)
+    monkeypatch.setattr(main,'find_cuts',find_cuts)
+    # A new CutQC of the same circuit and arguments reuses every stage
+    resumed = CutQC(circuit_name='ladder',circuit=circuit,verbose=False)
+    assert resumed.cut(resume=True,**CUT_KWARGS)==source_folder
+    assert resumed.evaluate(source_folders=[source_folder],resume=True,**EVALUATE_KWARGS)[0]==dest_folder
+    assert len(simulated)==0
+    assert np.array_equal(get_build_output(resumed,dest_folder)['reconstructed_prob'],reconstructed_prob)
+
+    # Other arguments evaluate again
+    dest_folder = resumed.evaluate(source_folders=[source_folder],resume=True,output_qubits=[0,1],**EVALUATE_KWARGS)[0]
+    assert len(simulated)>0
+    marginal = get_ground_truth(circuit).reshape((16,4)).sum(axis=0)
+    assert np.allclose(get_build_output(resumed,dest_folder)['reconstructed_prob'],marginal,atol=1e-6)
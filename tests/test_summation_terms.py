@@ -0,0 +1,49 @@
+import numpy as np
+
+from cutqc.main import CutQC
+from cutqc.post_process import SummationTerms, SummationTermRows, get_entry_matrix, transpose_csr
+from conftest import make_circuit, get_ground_truth, get_build_output, EVALUATE_KWARGS, CUT_KWARGS
+
+def get_summation_terms():
+    # 3 cuts: subcircuit 0 is incident to cuts 0 and 2, subcircuit 1 to cuts 0 and 1, subcircuit 2 to cuts 1 and 2
+    return SummationTerms(num_cuts=3,smart_order=[2,0,1],subcircuit_cuts={0:[0,2],1:[0,1],2:[1,2]})
+
+def test_lazy_indexing():
+    summation_terms = get_summation_terms()
+    array = summation_terms.get_array()
+    assert array.shape==(64,3)
+    for summation_term_idx in range(len(summation_terms)):
+        cut_bases = [(summation_term_idx>>(2*(2-cut_idx)))&3 for cut_idx in range(3)]
+        expected = [(2,4*cut_bases[1]+cut_bases[2]),(0,4*cut_bases[0]+cut_bases[2]),(1,4*cut_bases[0]+cut_bases[1])]
+        assert summation_terms[summation_term_idx]==expected
+        assert [(subcircuit_idx,int(entry_idx)) for subcircuit_idx, entry_idx in zip(summation_terms.smart_order,array[summation_term_idx])]==expected
+    assert summation_terms[-1]==summation_terms[63]
+    assert summation_terms[5:8]==[summation_terms[x] for x in range(5,8)]
+    summation_term_indices = np.array([63,0,17,17,40])
+    assert np.array_equal(summation_terms.get_rows(summation_term_indices=summation_term_indices),array[summation_term_indices])
+    assert np.array_equal(SummationTermRows(summation_terms=summation_terms)[10:70],array[10:])
+
+def test_record_round_trip():
+    summation_terms = get_summation_terms()
+    record = summation_terms.get_record()
+    # Only the structure is saved, not the 4^K terms
+    assert set(record)=={'num_cuts','smart_order','subcircuit_cuts'}
+    assert np.array_equal(SummationTerms.from_record(record).get_array(),summation_terms.get_array())
+
+def test_transpose_csr():
+    csr = {'indptr':np.array([0,2,2,5]),'instance_indices':np.array([1,0,3,1,0],dtype=np.int32),'coefficients':np.array([1.,2.,3.,4.,5.])}
+    transposed = transpose_csr(csr=csr,num_columns=4)
+    matrix = get_entry_matrix(csr=csr,num_instances=4)
+    transposed_matrix = np.zeros((4,3))
+    for instance_idx in range(4):
+        row = slice(transposed['indptr'][instance_idx],transposed['indptr'][instance_idx+1])
+        np.add.at(transposed_matrix[instance_idx],transposed['entry_indices'][row],transposed['coefficients'][row])
+    assert np.array_equal(transposed_matrix,matrix.T)
+
+def test_build_from_structure():
+    circuit = make_circuit(num_qubits=6)
+    cutqc = CutQC(circuit_name='ladder',circuit=circuit,verbose=False)
+    source_folder = cutqc.cut(**CUT_KWARGS)
+    assert 'terms' not in cutqc._load(folder=source_folder,name='summation_terms')
+    dest_folder = cutqc.evaluate(source_folders=[source_folder],**EVALUATE_KWARGS)[0]
+    assert np.allclose(get_build_output(cutqc,dest_folder)['reconstructed_prob'],get_ground_truth(circuit),atol=1e-6)
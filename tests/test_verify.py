@@ -0,0 +1,30 @@
+import numpy as np
+
+from cutqc.verify import reorder_prob, get_errors
+
+def naive_reorder(unordered, unordered_qubit):
+    # Raw state bit j, most significant first, is the bit of circuit qubit unordered_qubit[j]
+    num_qubits = len(unordered_qubit)
+    ordered = np.zeros(len(unordered))
+    for state in range(len(unordered)):
+        ordered_state = sum([((state>>(num_qubits-1-j))&1)<<qubit for j, qubit in enumerate(unordered_qubit)])
+        ordered[ordered_state] = unordered[state]
+    return ordered
+
+def test_reorder_and_errors_match_naive():
+    rng = np.random.default_rng(0)
+    num_qubits = 7
+    unordered_qubit = rng.permutation(num_qubits).tolist()
+    ground_truth = rng.random(2**num_qubits)
+    ground_truth /= ground_truth.sum()
+    unordered = rng.normal(scale=1e-3,size=2**num_qubits)+rng.random(2**num_qubits)/2**num_qubits
+    ordered = naive_reorder(unordered=unordered,unordered_qubit=unordered_qubit)
+    assert np.array_equal(reorder_prob(unordered=unordered,unordered_qubit=unordered_qubit),ordered)
+    expected = {'mse':np.mean((ordered-ground_truth)**2),
+    'fidelity':np.sum(np.sqrt(np.clip(ordered,0,None)*ground_truth))**2,
+    'tvd':np.sum(np.abs(ordered-ground_truth))/2}
+    # Chunks smaller than the output and a single chunk give the same errors
+    for chunk_size in [2**3,2**20]:
+        errors = get_errors(ground_truth=ground_truth,unordered=unordered,unordered_qubit=unordered_qubit,chunk_size=chunk_size)
+        for metric in expected:
+            assert np.isclose(errors[metric],expected[metric],rtol=1e-12,atol=0)